@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+"""mapanalyzer benchmark harness.
+
+Generates synthetic MAP files (see mapgen.py) and times each stage of
+mapanalyzer separately on them: reading the map, simulating the cache (and,
+within it, the probe/commit/finalize methods of each module), exporting the
+pdata files and plotting. The results are written to a JSON report, so that
+runs can be compared to track regressions.
+
+With --jobs, each map is also simulated splitting the sets of the cache
+among parallel jobs, and its metrics are checked to be the same as those of
+the single-job simulation. With --check, the same is done for the other
+paths that claim the results of simulating the map access by access: the
+vectorized direct-mapped simulation, --collapse-runs, --parse-jobs,
+reading a gzip-compressed copy of the map, and resuming a simulation
+interrupted halfway (with --resume, with and without -cp).
+
+Module methods are timed by wrapping them, which adds a small overhead to
+the simulation stage. 'simulate_self' is the simulation time not spent in
+the modules.
+"""
+import argparse, gzip, json, os, platform, shutil, subprocess, sys, tempfile
+from datetime import datetime
+from time import perf_counter
+
+from mapanalyzer.settings import Settings as st
+from mapanalyzer.cache import CacheHierarchy, collapse_runs, map_batches, \
+    split_lines
+from mapanalyzer.checkpoint import Checkpoint
+from mapanalyzer.main import simulate_checkpointed
+from mapanalyzer.ui import UI
+from mapanalyzer.util import command_line_args_parser as mapanalyzer_args
+from mapanalyzer.util import MapDataReader
+from mapanalyzer import Modules
+
+import mapgen
+
+# bump when the layout of the report changes
+report_version = 1
+module_methods = ['probe', 'commit', 'finalize']
+# alternative simulation paths checked by --check (see simulate_variant())
+check_variants = {
+    'vectorized': 'the vectorized direct-mapped simulation',
+    'collapse_runs': '--collapse-runs',
+    'parse_jobs': '--parse-jobs 2',
+    'compressed': 'a gzip-compressed copy of the map',
+    'resume': '--resume after an interruption',
+    'resume_checkpoint': '--resume -cp 3600 after an interruption',
+}
+
+class Interrupted(Exception):
+    pass
+
+class InterruptingCheckpoint(Checkpoint):
+    """checkpoint that saves a snapshot once half of the events have been
+    simulated, and then interrupts the simulation, as a crash would"""
+    def __init__(self, map_pth):
+        super().__init__(map_pth, 0)
+        return
+
+    def maybe_save(self, hierarchy, reader, done, common_time):
+        if done < st.Map.event_count // 2 or reader.file.closed:
+            return
+        self.save(hierarchy, reader.record_offset, done, common_time)
+        raise Interrupted()
+
+def time_module_methods(module_mngr):
+    """wrap the methods of each module of the manager to count their calls
+    and time. Return {module -> {method -> [calls, seconds]}}"""
+    stats = {}
+    for mod in module_mngr.available_module_instances:
+        mod_stats = stats.setdefault(mod.__class__.__name__, {})
+        for name in module_methods:
+            method = getattr(mod, name)
+            acc = mod_stats.setdefault(name, [0, 0.0])
+            def timed(*args, __method=method, __acc=acc, **kwargs):
+                t0 = perf_counter()
+                ret = __method(*args, **kwargs)
+                __acc[1] += perf_counter() - t0
+                __acc[0] += 1
+                return ret
+            setattr(mod, name, timed)
+    return stats
+
+def differing_metrics(module_mngr, other_mngr):
+    """codes of the metrics whose data differ between two managers of the
+    same metrics"""
+    computed = set(st.Metrics.enabled)
+    if st.Metrics.bg is not None:
+        computed.add(st.Metrics.bg)
+    codes = []
+    for mod,other in zip(module_mngr.available_module_instances,
+                         other_mngr.available_module_instances):
+        for code in mod.supported_metrics:
+            if code in computed and \
+               json.dumps(mod.export_data(code)) != \
+               json.dumps(other.export_data(code)):
+                codes.append(code)
+    return codes
+
+def simulate_variant(map_pth, variant=None):
+    """simulate map_pth access by access (no variant), or with one of the
+    check_variants, which must give the same results. Return the modules
+    manager, or None if the variant does not apply to the map and cache"""
+    module_mngr = Modules.Manager()
+    cache = CacheHierarchy([module_mngr])
+    if variant == 'vectorized':
+        if not cache.vectorizable() or \
+           not cache.run_vectorized(MapDataReader(map_pth),
+                                    show_progress=False):
+            return None
+        return module_mngr
+    if variant == 'resume':
+        return simulate_resumed(map_pth, None)
+    if variant == 'resume_checkpoint':
+        return simulate_resumed(map_pth, 3600)
+    if variant == 'compressed':
+        gz_pth = f'{map_pth}.gz'
+        with open(map_pth, 'rb') as map_file, \
+             gzip.open(gz_pth, 'wb') as gz_file:
+            shutil.copyfileobj(map_file, gz_file)
+        map_pth = gz_pth
+    parse_jobs = st.parse_jobs
+    if variant == 'parse_jobs':
+        st.parse_jobs = 2
+    try:
+        batches = map_batches(MapDataReader(map_pth))
+        if variant == 'collapse_runs':
+            batches = split_lines(collapse_runs(batches, st.Cache.bits_off))
+        cache.simulate_batches(batches, st.Map.event_count,
+                               show_progress=False)
+    finally:
+        st.parse_jobs = parse_jobs
+    return module_mngr
+
+def simulate_resumed(map_pth, interval):
+    """simulate map_pth until half of its events, interrupt it, and resume
+    it from the snapshot as --resume (and -cp interval, if given) would do.
+    Return the modules manager of the first level, or None if the map is too
+    short to be interrupted"""
+    module_mngrs = [Modules.Manager() for _ in st.Cache.levels]
+    try:
+        CacheHierarchy(module_mngrs).run_simulation(
+            MapDataReader(map_pth), show_progress=False,
+            checkpoint=InterruptingCheckpoint(map_pth))
+    except Interrupted:
+        pass
+    else:
+        return None
+    module_mngrs,checkpoint = simulate_checkpointed(map_pth, interval, True)
+    checkpoint.remove()
+    return module_mngrs[0]
+
+def mapanalyzer_settings(cache_pth, metrics, map_pth=None):
+    """parse the arguments mapanalyzer would get to simulate map_pth. If
+    no map is given, also initialize the settings that do not depend on
+    it (only once: plot settings cannot be initialized twice)"""
+    argv = ['mapanalyzer', '--mode', 'sim-plot']
+    if cache_pth is not None:
+        argv += ['-ca', cache_pth]
+    if metrics is not None:
+        argv += ['-mc', metrics]
+    if map_pth is not None:
+        argv += ['--', map_pth]
+    args,_ = mapanalyzer_args(argv)
+    if map_pth is None:
+        st.set_mode(args)
+        st.Plot.from_args(args)
+        st.Sampling.from_args(args)
+    return args
+
+def init_settings(map_pth, cache_pth, metrics):
+    """initialize the settings as mapanalyzer would do to simulate map_pth"""
+    args = mapanalyzer_settings(cache_pth, metrics, map_pth)
+    st.Metrics.from_args(args)
+    st.Cache.from_file(args.cachefile)
+    st.Map.set_path_prefix(args.input_files)
+    st.Map.from_file(map_pth)
+    return
+
+def bench_map(map_pth, cache_pth, metrics, plots, jobs=1, check=False):
+    """run all the stages on a map file. Return the seconds spent in each
+    one, and the stats of the module methods. If jobs > 1, also simulate it
+    in that many jobs, and if check, with each of the check_variants. Exit
+    if any metric differs"""
+    init_settings(map_pth, cache_pth, metrics)
+    stages = {}
+
+    t0 = perf_counter()
+    for _ in MapDataReader(map_pth):
+        pass
+    stages['read'] = perf_counter() - t0
+
+    module_mngr = Modules.Manager()
+    mod_stats = time_module_methods(module_mngr)
+    cache = CacheHierarchy([module_mngr])
+    t0 = perf_counter()
+    cache.run_simulation(MapDataReader(map_pth), show_progress=False)
+    stages['simulate'] = perf_counter() - t0
+    stages['simulate_self'] = stages['simulate'] - sum(
+        secs for meths in mod_stats.values() for _,secs in meths.values())
+
+    t0 = perf_counter()
+    module_mngr.export_all_pdatas()
+    stages['export_pdata'] = perf_counter() - t0
+
+    if plots:
+        t0 = perf_counter()
+        module_mngr.export_all_plots()
+        stages['plot'] = perf_counter() - t0
+
+    if jobs > 1:
+        jobs_mngr = Modules.Manager()
+        cache = CacheHierarchy([jobs_mngr])
+        t0 = perf_counter()
+        cache.run_set_partitioned(map_pth, jobs, show_progress=False)
+        stages['simulate_jobs'] = perf_counter() - t0
+        codes = differing_metrics(module_mngr, jobs_mngr)
+        if codes:
+            UI.error(f'The metrics {", ".join(codes)} of {map_pth} differ '
+                     f'when simulated in {jobs} jobs.')
+
+    if check:
+        t0 = perf_counter()
+        reference_mngr = simulate_variant(map_pth)
+        stages['simulate_reference'] = perf_counter() - t0
+        for variant,description in check_variants.items():
+            t0 = perf_counter()
+            variant_mngr = simulate_variant(map_pth, variant)
+            if variant_mngr is None:
+                continue
+            stages[f'simulate_{variant}'] = perf_counter() - t0
+            codes = differing_metrics(reference_mngr, variant_mngr)
+            if codes:
+                UI.error(f'The metrics {", ".join(codes)} of {map_pth} '
+                         f'differ when simulated with {description}.')
+
+    modules = {mod: {meth: {'calls': calls, 'seconds': secs}
+                     for meth,(calls,secs) in meths.items()}
+               for mod,meths in mod_stats.items()}
+    return stages, modules
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                             text=True, cwd=os.path.dirname(
+                                 os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() if out.returncode == 0 else None
+
+def command_line_args_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        '-p', '--patterns', metavar='PATTERNS', dest='patterns',
+        type=str, default=','.join(mapgen.patterns),
+        help=('Patterns of the synthetic maps.\n'
+              'Format : <PATTERN>{,<PATTERN>}\n'
+              'Example: sequential,random'))
+    parser.add_argument(
+        '-n', '--elems', metavar='ELEMS', dest='elems',
+        type=str, default='4096',
+        help=('Sizes (number of elements) of the synthetic maps.\n'
+              'Format : <integer>{,<integer>}\n'
+              'Example: 1024,16384'))
+    parser.add_argument(
+        '-t', '--threads', metavar='THREADS', dest='threads',
+        type=int, default=4,
+        help='Number of threads of the multithreaded pattern.')
+    parser.add_argument(
+        '-ca', '--cache', metavar='CACHE', dest='cachefile',
+        type=str, default=None,
+        help='Cache file given to mapanalyzer (default: its defaults).')
+    parser.add_argument(
+        '-mc', '--metrics', metavar='CODES', dest='metrics',
+        type=str, default=None,
+        help='Metrics given to mapanalyzer (default: all).')
+    parser.add_argument(
+        '-r', '--repeat', metavar='REPEAT', dest='repeat',
+        type=int, default=1,
+        help=('Run each map this many times, and report the fastest run of\n'
+              'each stage.'))
+    parser.add_argument(
+        '-P', '--no-plots', dest='plots', action='store_false',
+        help='If set, do not time the plotting stage.')
+    parser.add_argument(
+        '-j', '--jobs', metavar='JOBS', dest='jobs',
+        type=int, default=1,
+        help=('Also simulate each map splitting the sets of the cache among\n'
+              'JOBS jobs, and check that its metrics are the same as in a\n'
+              'single job.'))
+    parser.add_argument(
+        '-C', '--check', dest='check', action='store_true',
+        help=('Also simulate each map with the vectorized direct-mapped\n'
+              'simulation (if the cache is direct-mapped), --collapse-runs,\n'
+              '--parse-jobs, from a gzip-compressed copy and resuming it\n'
+              'after an interruption, and check that its metrics are the\n'
+              'same as simulating it access by access.'))
+    parser.add_argument(
+        '-w', '--workdir', metavar='DIR', dest='workdir',
+        type=str, default=None,
+        help='Directory for maps and outputs (default: a temporary one).')
+    parser.add_argument(
+        '-o', '--output', metavar='REPORT', dest='output',
+        type=str, default='bench_report.json',
+        help='Path of the JSON report.')
+    return parser.parse_args()
+
+def main():
+    args = command_line_args_parser()
+    patterns = [p.strip() for p in args.patterns.split(',')]
+    for pattern in patterns:
+        if pattern not in mapgen.patterns:
+            UI.error(f'Unknown pattern "{pattern}".')
+    try:
+        sizes = [int(n) for n in args.elems.split(',')]
+    except ValueError:
+        UI.error(f'Invalid sizes "{args.elems}".')
+    if args.repeat < 1:
+        UI.error('The number of repetitions must be at least 1.')
+    if args.jobs < 1:
+        UI.error('The number of jobs must be at least 1.')
+    cache_pth = None
+    if args.cachefile is not None:
+        cache_pth = os.path.abspath(args.cachefile)
+    report_pth = os.path.abspath(args.output)
+
+    tmp_dir = None
+    if args.workdir is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix='mapanalyzer-bench-')
+        workdir = tmp_dir.name
+    else:
+        workdir = os.path.abspath(args.workdir)
+        os.makedirs(workdir, exist_ok=True)
+
+    mapanalyzer_settings(cache_pth, args.metrics)
+    runs = []
+    cwd = os.getcwd()
+    for pattern in patterns:
+        for elems in sizes:
+            name = f'{pattern}-{elems}'
+            run_dir = os.path.join(workdir, name)
+            os.makedirs(run_dir, exist_ok=True)
+            map_pth = os.path.join(run_dir, f'{name}.map')
+            t0 = perf_counter()
+            events = mapgen.generate(map_pth, pattern, elems,
+                                     threads=args.threads)
+            gen_secs = perf_counter() - t0
+
+            UI.indent_in(title=f'BENCHMARK {name} ({events} events)')
+            os.chdir(run_dir)
+            best_stages, best_modules = None, None
+            for _ in range(args.repeat):
+                stages,modules = bench_map(map_pth, cache_pth, args.metrics,
+                                           args.plots, args.jobs, args.check)
+                if best_stages is None or \
+                   stages['simulate'] < best_stages['simulate']:
+                    best_modules = modules
+                best_stages = stages if best_stages is None else \
+                    {k: min(v, best_stages[k]) for k,v in stages.items()}
+            os.chdir(cwd)
+            UI.columns((list(best_stages.keys()),
+                        [f'{s:.4f} s' for s in best_stages.values()]),
+                       sep=' : ')
+            UI.indent_out()
+
+            runs.append({
+                'pattern': pattern,
+                'elems': elems,
+                'threads': args.threads if pattern == 'multithreaded' else 1,
+                'events': events,
+                'time_size': st.Map.time_size,
+                'generate_seconds': gen_secs,
+                'stages': best_stages,
+                'events_per_second': events / best_stages['simulate'],
+                'modules': best_modules,
+            })
+
+    report = {
+        'version': report_version,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'jobs': args.jobs,
+        'check': args.check,
+        'cache': st.Cache.to_dict(),
+        'metrics': sorted(st.Metrics.enabled),
+        'runs': runs,
+    }
+    with open(report_pth, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    UI.info(f'Report written to {report_pth}', pre='', out='out')
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+"""Synthetic MAP file generator.
+
+Produces MAP files (the format written by maptracer) with typical memory
+access patterns, so that mapanalyzer can be exercised and benchmarked
+without Pin. All patterns work on a single memory block of ELEMS elements of
+ELEM_SIZE bytes each:
+
+  sequential     : read (and write back) every element in order.
+  strided        : visit the elements column by column, STRIDE elements apart.
+  random         : read or write uniformly random elements.
+  transpose      : in-place transposition of a square matrix (of about ELEMS
+                   elements): swap a[i][j] and a[j][i].
+  multithreaded  : THREADS threads sweep their own chunks of the block at the
+                   same time.
+"""
+import argparse, math, random, sys
+
+patterns = ['sequential', 'strided', 'random', 'transpose', 'multithreaded']
+
+def sequential(elems, **_):
+    """yield (thread, event, element) tuples, one per time step"""
+    for i in range(elems):
+        yield [(0, 'R', i)]
+        yield [(0, 'W', i)]
+    return
+
+def strided(elems, stride, **_):
+    for col in range(stride):
+        for i in range(col, elems, stride):
+            yield [(0, 'R', i)]
+    return
+
+def random_access(elems, rng, **_):
+    for _ in range(elems):
+        yield [(0, rng.choice('RW'), rng.randrange(elems))]
+    return
+
+def transpose(elems, **_):
+    side = max(math.isqrt(elems), 1)
+    for i in range(side):
+        for j in range(i+1, side):
+            yield [(0, 'R', i*side+j)]
+            yield [(0, 'R', j*side+i)]
+            yield [(0, 'W', i*side+j)]
+            yield [(0, 'W', j*side+i)]
+    return
+
+def multithreaded(elems, threads, **_):
+    chunk = -(-elems // threads)
+    for i in range(chunk):
+        # all threads access their i-th element at the same time
+        batch = []
+        for thr in range(threads):
+            if thr*chunk + i < elems:
+                batch.append((thr, 'R', thr*chunk + i))
+        yield batch
+    return
+
+generators = {
+    'sequential'    : sequential,
+    'strided'       : strided,
+    'random'        : random_access,
+    'transpose'     : transpose,
+    'multithreaded' : multithreaded,
+}
+
+def generate(path, pattern, elems, elem_size=4, stride=16, threads=4,
+             seed=0, start_addr=0x7F0000001000):
+    """write a MAP file with the given pattern. Return the number of
+    events written."""
+    if pattern not in generators:
+        raise ValueError(f'unknown pattern "{pattern}"')
+    if elems < 1 or elem_size < 1 or stride < 1 or threads < 1:
+        raise ValueError('elems, elem_size, stride and threads must be '
+                         'positive')
+    rng = random.Random(seed)
+    lines = []
+    time = -1
+    thread_count = threads if pattern == 'multithreaded' else 1
+    for time,batch in enumerate(generators[pattern](
+            elems=elems, stride=stride, threads=threads, rng=rng)):
+        for thr,event,elem in batch:
+            lines.append(f'{time},{thr},{event},{elem_size},'
+                         f'{elem*elem_size}\n')
+
+    mem_size = elems * elem_size
+    with open(path, 'w') as map_file:
+        map_file.write(
+            '# METADATA\n'
+            f'start-addr   : 0x{start_addr:X}\n'
+            f'end-addr     : 0x{start_addr+mem_size-1:X}\n'
+            f'block-size   : {mem_size}\n'
+            'owner-thread : 0\n'
+            'slice-size   : 1\n'
+            f'thread-count : {thread_count}\n'
+            f'event-count  : {len(lines)}\n'
+            f'max-time     : {time}\n'
+            '# DATA\n'
+            'time,thread,event,size,offset\n')
+        map_file.writelines(lines)
+    return len(lines)
+
+def command_line_args_parser(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        '-p', '--pattern', metavar='PATTERN', dest='pattern',
+        choices=patterns, default='sequential',
+        help=('Memory access pattern.\n'
+              f'Format: {" | ".join(patterns)}'))
+    parser.add_argument(
+        '-n', '--elems', metavar='ELEMS', dest='elems',
+        type=int, default=1024,
+        help='Number of elements in the memory block.')
+    parser.add_argument(
+        '-e', '--elem-size', metavar='ELEM_SIZE', dest='elem_size',
+        type=int, default=4,
+        help='Size of each element, in bytes.')
+    parser.add_argument(
+        '-s', '--stride', metavar='STRIDE', dest='stride',
+        type=int, default=16,
+        help='Distance, in elements, between strided accesses.')
+    parser.add_argument(
+        '-t', '--threads', metavar='THREADS', dest='threads',
+        type=int, default=4,
+        help='Number of threads of the multithreaded pattern.')
+    parser.add_argument(
+        '-r', '--seed', metavar='SEED', dest='seed',
+        type=int, default=0,
+        help='Seed of the random pattern.')
+    parser.add_argument(
+        'output', metavar='OUTPUT',
+        help='Path of the MAP file to write.')
+    return parser.parse_args(argv)
+
+def main():
+    args = command_line_args_parser()
+    try:
+        count = generate(args.output, args.pattern, args.elems,
+                         elem_size=args.elem_size, stride=args.stride,
+                         threads=args.threads, seed=args.seed)
+    except ValueError as e:
+        print(f'ERROR: {e}', file=sys.stderr)
+        exit(1)
+    print(f'{args.output}: {count} events ({args.pattern})')
+    return
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,3 @@
 from .manager import Manager
+from .registry import Registry
+from . import base
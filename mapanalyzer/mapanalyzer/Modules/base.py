@@ -244,6 +244,8 @@ class BaseModule:
                 title_string += f': {st.Map.ID}'
             if met_str.subtit:
                 title_string += f' ({met_str.subtit})'
+            if st.Sampling.mode is not None:
+                title_string += ' [sampled]'
 
         mpl_axes.set_title(title_string, fontsize=10,
                            pad=st.Plot.img_title_vpad)
@@ -1,70 +1,99 @@
-import sys
+import multiprocessing, os, sys, tempfile
+import numpy as np
 import matplotlib.pyplot as plt
 
 from ..settings import Settings as st
-from ..util import MetricStrings, PdataFile, PlotFile
+from ..profiler import Profiler
+from ..util import MetricStrings, OutputWriter, PdataFile, PlotFile
 from ..ui import UI
 
-from .module_mapplotter import Map
-from .module_locality import Locality
-from .module_missratio import MissRatio
-from .module_memaccess import MemAccess
-from .module_usage import CacheUsage
-from .module_aliasing import Aliasing
-from .module_roundtrip import EvictionRoundtrip
+from .registry import Registry
 
 
 class Manager:
-    # list of available classes
-    available_module_classes = [
-        Map,
-        Locality,
-        MissRatio,
-        MemAccess,
-        CacheUsage,
-        Aliasing,
-        EvictionRoundtrip
-    ]
+    # built-in modules are attributes of the manager (map, locality, ...).
+    # Only the modules of the enabled and bg metrics are imported and
+    # created: the rest are None, and the cache does not probe them.
+    module_names = Registry.builtin_names
+
+    # the bg plot is the same under every fg plot of a run: it is rendered
+    # once (per figure size) and its pixels are pasted under each fg plot.
+    # Vector formats keep drawing it, so that it is not rasterized.
+    vector_formats = ('pdf', 'svg', 'svgz', 'eps', 'ps', 'pgf')
+    # the object holding the bg data of the run, and its rendered plots
+    # {(bg code, figsize, dpi) -> RGBA pixels}. Holding the object prevents
+    # its id from being reused by the data of another run.
+    bg_source = None
+    bg_rasters = {}
+    # with --pipeline, the function that exports one metric in the forked
+    # workers of __export_metrics()
+    exporter = None
 
     def __init__(self):
-        # List of available modules
-        self.map = Map()
-        self.locality = Locality()
-        self.missratio = MissRatio()
-        self.memaccess = MemAccess()
-        self.usage = CacheUsage()
-        self.aliasing = Aliasing()
-        self.roundtrip = EvictionRoundtrip()
-
-        self.available_module_instances = [
-            self.map,
-            self.locality,
-            self.missratio,
-            self.memaccess,
-            self.usage,
-            self.aliasing,
-            self.roundtrip
-        ]
+        computed = set(st.Metrics.enabled)
+        if st.Metrics.bg is not None:
+            computed.add(st.Metrics.bg)
+
+        for name in self.module_names:
+            setattr(self, name, None)
+        # modules of other packages
+        self.extensions = []
+        # bg data imported from a pdata (plot mode)
+        self.imported_bg = None
+
+        self.available_module_instances = []
+        for entry in Registry.entries_for(computed):
+            module = entry.load()()
+            if entry.name is not None:
+                setattr(self, entry.name, module)
+            else:
+                self.extensions.append(module)
+            self.available_module_instances.append(module)
+        if len(self.available_module_instances) == 0:
+            UI.error('None of the requested metrics '
+                     f'({", ".join(sorted(computed))}) is supported by a '
+                     'module.')
+
+        # modules committed as usual by commit_counts()
+        self.uncounted_modules = [
+            mod for mod in self.available_module_instances
+            if mod is not self.missratio and mod is not self.memaccess]
+
+        # modules probed with every access
+        self.access_observers = [self.map] if self.map is not None else []
+        self.access_observers += self.extensions
 
         # inform st.Metrics about the available modules
         st.Metrics.set_available(self.available_module_instances)
         return
 
+    def probed_names(self):
+        """names of the probes that reach some module: the built-in modules
+        present, and 'access' if some module observes every access"""
+        names = [n for n in self.module_names if getattr(self, n) is not None]
+        if self.access_observers:
+            names.append('access')
+        return names
+
+    @classmethod
+    def module_classes(cls, codes):
+        """classes of the modules of the given metric codes"""
+        return Registry.classes_for(codes)
+
     def describe(self):
         enabled_list = ['ENABLED']
         metrics_list = ['METRIC']
         modules_list = ['MODULE']
-        #descrip_list = ['DESCRIPTION']
-        for metric_code,module in st.Metrics.available.items():
-            if metric_code in st.Metrics.enabled or \
-               metric_code == st.Metrics.bg:
-                enabled_list.append('[X]')
-            else:
-                enabled_list.append('[ ]')
-            metrics_list.append(metric_code)
-            modules_list.append(module.__class__.__name__)
-            #descrip_list.append(module.supported_metrics[metric_code].about)
-        table = (enabled_list, metrics_list, modules_list) #, descrip_list)
+        for entry in Registry.entries():
+            for metric_code in entry.codes:
+                if metric_code in st.Metrics.enabled or \
+                   metric_code == st.Metrics.bg:
+                    enabled_list.append('[X]')
+                else:
+                    enabled_list.append('[ ]')
+                metrics_list.append(metric_code)
+                modules_list.append(entry.class_name)
+        table = (enabled_list, metrics_list, modules_list)
         UI.columns(table, sep='   ', header=True)
         return
 
@@ -73,13 +102,26 @@ class Manager:
             mod.commit(time)
         return
 
+    def commit_counts(self, time, events, reads, writes):
+        """commit a time step whose hits, misses and main memory accesses
+        were counted by the caller instead of probed (see the lean kernels
+        of Cache). events are the (thread, hit_miss) of its lines, in order,
+        and reads and writes its main memory accesses."""
+        if self.missratio is not None:
+            self.missratio.commit_events(time, events)
+        if self.memaccess is not None:
+            self.memaccess.commit_counts(time, reads, writes)
+        for mod in self.uncounted_modules:
+            mod.commit(time)
+        return
+
     def finalize(self):
         for mod in self.available_module_instances:
             mod.finalize()
         return
 
     def __export_single_pdata(self, metric_code, meta_data, cache_data,
-                              map_data, bg_data):
+                              map_data, bg_ref):
         # find module of this metric and obtain data
         if metric_code not in st.Metrics.available:
             UI.error(
@@ -93,9 +135,9 @@ class Manager:
         fg_data = module.export_data(metric_code)
 
         # prevent from saving the same data in fg and bg
-        maybe_bg_data = bg_data
+        maybe_bg_ref = bg_ref
         if st.Metrics.bg == metric_code:
-            maybe_bg_data = None
+            maybe_bg_ref = None
 
         # construct ready-to-save dictionary
         pdata = {
@@ -103,7 +145,7 @@ class Manager:
             'cache'  : cache_data,
             'map'    : map_data,
             'metrics': {
-                'bg' : maybe_bg_data,
+                'bg' : maybe_bg_ref,
                 'fg' : fg_data
             }
         }
@@ -111,6 +153,10 @@ class Manager:
         return
 
     def export_all_pdatas(self):
+        # other managers may have registered their modules since this one
+        # was created (e.g., one manager per cache level)
+        st.Metrics.set_available(self.available_module_instances)
+
         # obtain common elements
         meta_data = st.to_dict()
         cache_data = st.Cache.to_dict()
@@ -128,14 +174,65 @@ class Manager:
                     __name__
                 UI.warning(f'{bg_class_name}.{BG_to_dict}() not implemented.'
                            ' No background data will be saved.')
-        bg_data = None
+        # the bg data is stored once and referenced by the pdatas: in the
+        # pdata of the bg metric if enabled, otherwise in a sidecar file.
+        bg_ref = None
         if BG_to_dict is not None:
-            bg_data = BG_to_dict()
+            if st.Metrics.bg in st.Metrics.enabled:
+                bg_ref = PdataFile.bg_reference(
+                    st.Metrics.bg, PdataFile.filename(st.Metrics.bg))
+            else:
+                bg_ref = PdataFile.save_bg(meta_data, BG_to_dict())
 
         # for each enabled metric, save its pdata
-        for metric_code in st.Metrics.enabled:
-            self.__export_single_pdata(metric_code, meta_data, cache_data,
-                                       map_data, bg_data)
+        self.__export_metrics(
+            lambda metric_code: self.__export_single_pdata(
+                metric_code, meta_data, cache_data, map_data, bg_ref))
+        return
+
+    @staticmethod
+    def __export_jobs():
+        """number of workers exporting the enabled metrics (1: exported
+        here). The workers of --jobs and batch mode cannot fork their own,
+        and the profiler only measures the calls made in this process."""
+        if not st.pipeline or Profiler.enabled() or \
+           multiprocessing.current_process().daemon:
+            return 1
+        return max(1, min(len(st.Metrics.enabled), st.jobs))
+
+    def __export_metrics(self, export):
+        """call export(metric_code) for each enabled metric. The metrics are
+        independent, so with --pipeline they are exported by a pool of
+        --jobs forked workers, which inherit the modules and their data
+        (nothing is pickled). The output of each worker is shown in the
+        order of the metrics, as if they were exported here."""
+        metric_codes = list(st.Metrics.enabled)
+        num_jobs = self.__export_jobs()
+        if num_jobs < 2:
+            for metric_code in metric_codes:
+                export(metric_code)
+            return
+        # the workers would inherit the locks of the writer thread in
+        # whatever state they are: write the pending files, and start the
+        # thread again afterwards.
+        writing = OutputWriter.running()
+        OutputWriter.finish()
+        Manager.exporter = export
+        sys.stdout.flush()
+        try:
+            with multiprocessing.get_context('fork').Pool(
+                    num_jobs, initializer=export_worker_init) as pool:
+                for output,exit_code in pool.imap(export_worker,
+                                                  metric_codes):
+                    sys.stdout.buffer.write(output)
+                    sys.stdout.flush()
+                    # the worker has shown the error
+                    if exit_code is not None:
+                        sys.exit(exit_code)
+        finally:
+            Manager.exporter = None
+            if writing:
+                OutputWriter.start()
         return
 
     def __export_single_plot(self, metric_code):
@@ -176,7 +273,10 @@ class Manager:
                 figsize=figsize)
             fg_axes = fig.add_axes(bg_axes.get_position())
             # draw background plot
-            BG_to_plot(bg_axes, bg_mode=True)
+            if st.Plot.format in self.vector_formats:
+                BG_to_plot(bg_axes, bg_mode=True)
+            else:
+                self.__paste_bg_plot(bg_axes, BG_to_plot, figsize)
         else:
             fig,fg_axes = plt.subplots(
                 facecolor='white',
@@ -188,10 +288,78 @@ class Manager:
         PlotFile.save(fig, metric_code)
         return
 
+    def __render_bg_plot(self, BG_to_plot, figsize):
+        """draw the bg plot alone, at the resolution of the final plots, and
+        return the pixels inside its axes"""
+        fig,bg_axes = plt.subplots(facecolor='white', figsize=figsize,
+                                   dpi=st.Plot.dpi)
+        BG_to_plot(bg_axes, bg_mode=True)
+        # the frame is drawn by the axes it is pasted into
+        for spine in bg_axes.spines.values():
+            spine.set_visible(False)
+        fig.canvas.draw()
+        pixels = np.asarray(fig.canvas.buffer_rgba())
+        box = bg_axes.get_window_extent()
+        height = pixels.shape[0]
+        raster = pixels[height-round(box.y1):height-round(box.y0),
+                        round(box.x0):round(box.x1)].copy()
+        plt.close(fig)
+        return raster
+
+    def __bg_raster(self, BG_to_plot, figsize):
+        """the rendered bg plot of the run for figsize (see
+        __render_bg_plot()), rendering it the first time"""
+        # in plot mode the modules are new for each pdata, but the bg data
+        # of the pdatas of a run is the same object.
+        source = self.imported_bg
+        if source is None:
+            source = st.Metrics.available[st.Metrics.bg]
+        if Manager.bg_source is not source:
+            Manager.bg_source = source
+            Manager.bg_rasters = {}
+        key = (st.Metrics.bg, tuple(figsize), st.Plot.dpi)
+        if key not in Manager.bg_rasters:
+            Manager.bg_rasters[key] = self.__render_bg_plot(BG_to_plot,
+                                                            figsize)
+        return Manager.bg_rasters[key]
+
+    def __render_bg_rasters(self):
+        """render the bg plot for the figure sizes of the enabled metrics,
+        so that the export workers inherit it instead of rendering it each"""
+        if st.Metrics.bg is None or st.Plot.format in self.vector_formats:
+            return
+        BG_to_plot = getattr(st.Metrics.available[st.Metrics.bg],
+                             f'{st.Metrics.bg}_to_plot', None)
+        if BG_to_plot is None:
+            return
+        for metric_code in st.Metrics.enabled:
+            if metric_code == st.Metrics.bg:
+                continue
+            figsize = st.Plot.plots_sizes.get(
+                metric_code, (st.Plot.width, st.Plot.height))
+            self.__bg_raster(BG_to_plot, figsize)
+        return
+
+    def __paste_bg_plot(self, bg_axes, BG_to_plot, figsize):
+        raster = self.__bg_raster(BG_to_plot, figsize)
+        bg_axes.imshow(raster, extent=(0, 1, 0, 1),
+                       transform=bg_axes.transAxes, aspect='auto',
+                       interpolation='none', zorder=0)
+        bg_axes.set_xticks([])
+        bg_axes.set_yticks([])
+        for spine in bg_axes.spines.values():
+            spine.set_zorder(500)
+        return
+
     def export_all_plots(self):
+        # other managers may have registered their modules since this one
+        # was created (e.g., one manager per cache level)
+        st.Metrics.set_available(self.available_module_instances)
+
         # for each enabled metric, save its plot
-        for metric_code in st.Metrics.enabled:
-            self.__export_single_plot(metric_code)
+        if self.__export_jobs() > 1:
+            self.__render_bg_rasters()
+        self.__export_metrics(self.__export_single_plot)
         return
 
     def __import_single_pdata(self, pdata_dict):
@@ -214,6 +382,8 @@ class Manager:
                          f'.metrics.{k}.code = {metric_code}.\n')
             st.Metrics.available[metric_code].import_data(
                 metric_code, metric_data)
+            if k == 'bg':
+                self.imported_bg = metric_data
 
         return
 
@@ -240,8 +410,8 @@ class Manager:
                 'aggregation on that code.\n'
                 'If you think the metric code is correct, please make '
                 'sure the module to which it belongs is registered in\n'
-                'Modules.available_module_classes, and that the module '
-                'itself registers the metric in its '
+                'Modules.Registry (or through an entry point), and that the '
+                'module itself registers the metric in its '
                 '"supported_aggr_metrics" dictionary.\n'
                 f'Ignoring {len(pdata_dicts)} input files with foreground '
                 f'code "{metric_code}".')
@@ -251,3 +421,27 @@ class Manager:
         AggrModuleClass = st.Metrics.available[metric_code]
         AggrModuleClass.export_aggregated_plot(pdata_dicts)
         return
+
+
+def export_worker_init():
+    """the stdout of export workers is kept in a temporary file, to be
+    shown by the parent"""
+    export_worker.stdout = tempfile.TemporaryFile(buffering=0)
+    os.dup2(export_worker.stdout.fileno(), sys.stdout.fileno())
+    return
+
+def export_worker(metric_code):
+    """export one metric with Manager.exporter. Return the output shown
+    meanwhile, and the exit code if UI.error() exited"""
+    exit_code = None
+    try:
+        Manager.exporter(metric_code)
+    except SystemExit as e:
+        exit_code = e.code
+    sys.stdout.flush()
+    out = export_worker.stdout
+    out.seek(0)
+    output = out.read()
+    out.seek(0)
+    out.truncate()
+    return output, exit_code
@@ -79,7 +79,7 @@ class Aliasing(BaseModule):
         # time component of the most recent element of the window
         curr_time = self.time_window[-1][1]
         tot_fetch = sum(self.fetch_count_per_set)
-        for s in range(st.Cache.num_sets):
+        for s in range(len(self.sets_aliasing)):
             self.sets_aliasing[s][curr_time] = self.fetch_count_per_set[s] \
                 / tot_fetch
         return
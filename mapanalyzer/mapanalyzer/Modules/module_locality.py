@@ -1,5 +1,7 @@
 from collections import deque
+from array import array
 import matplotlib.pyplot as plt
+import numpy as np
 from itertools import zip_longest
 
 from ..settings import Settings as st
@@ -69,6 +71,10 @@ class Locality(BaseModule):
         # the rear-popped element from tw_chro_acc.
         self.tw_byte_count = {}
         self.tw_byte_count_max = st.Cache.cache_size
+        # values of the cache level and the map used while probing
+        self.start_addr = st.Map.start_addr
+        self.line_size = st.Cache.line_size
+        self.bits_off = st.Cache.bits_off
         # Spatial Locality vector: Contains the final SLD metric.
         self.Ls = [0] * st.Map.time_size
         # the time at which the first (full) time window is completed. That is,
@@ -78,15 +84,31 @@ class Locality(BaseModule):
 
         #####################################
         ## TEMPORAL LOCALITY ACROSS SPACE
-        self.space_by_blocks = {} #block->list of block access times
+        # all block accesses, as a flat typed array of (block, time) pairs:
+        # [blk0, t0, blk1, t1, ...] (16 bytes per access).
+        self.block_accesses = array('q')
         self.Lt = [0] * st.Map.num_blocks
+
+        # In streaming mode, the space windows are not kept. Instead, each
+        # block accumulates its (integer) distances as it is accessed:
+        # its last access time, the sum of distances, and their count.
+        self.tld_streaming = 'TLD' in st.Metrics.streaming
+        if self.tld_streaming:
+            self.block_accesses = None
+            num_blocks = st.Map.num_blocks
+            self.last_access = array('q', [-1]) * num_blocks
+            self.dist_sum = array('q', [0]) * num_blocks
+            self.dist_count = array('q', [0]) * num_blocks
+            self.C = st.Cache.cache_size
+            self.B = st.Cache.line_size
+            self.max_gap = self.C // self.B
         return
 
     def probe(self, time, thread, event, size, addr):
         if not self.enabled:
             return
         ## SPACIAL LOCALITY ACROSS TIME
-        off = addr - st.Map.start_addr
+        off = addr - self.start_addr
 
         # Add access to:
         # - the chronological queue
@@ -113,19 +135,34 @@ class Locality(BaseModule):
 
         ## TEMPORAL LOCALITY ACROSS SPACE
         # get the block to which the address belongs
-        blkid_start = addr >> st.Cache.bits_off
-        if blkid_start not in self.space_by_blocks:
-            self.space_by_blocks[blkid_start] = []
-        self.space_by_blocks[blkid_start].append(time)
+        blkid_start = addr >> self.bits_off
+        if self.tld_streaming:
+            self.__accumulate_block_dist(blkid_start, time)
+        else:
+            self.block_accesses.append(blkid_start)
+            self.block_accesses.append(time)
 
         # in case the reading fell between blocks, the last bytes will be
         # in the next block.
-        blkid_end = (addr + size -1) >> st.Cache.bits_off
+        blkid_end = (addr + size -1) >> self.bits_off
         if blkid_end == blkid_start:
             return
-        if blkid_end not in self.space_by_blocks:
-            self.space_by_blocks[blkid_end] = []
-        self.space_by_blocks[blkid_end].append(time)
+        if self.tld_streaming:
+            self.__accumulate_block_dist(blkid_end, time)
+        else:
+            self.block_accesses.append(blkid_end)
+            self.block_accesses.append(time)
+        return
+
+    def __accumulate_block_dist(self, blkid, time):
+        """add the distance to the previous access of this block to the
+        block's accumulators"""
+        last_time = self.last_access[blkid]
+        if last_time >= 0:
+            gap = time - last_time
+            self.dist_sum[blkid] += self.C - self.B*min(gap, self.max_gap)
+            self.dist_count[blkid] += 1
+        self.last_access[blkid] = time
         return
 
     def commit(self, time):
@@ -144,7 +181,7 @@ class Locality(BaseModule):
 
         # compute differences among neighbors and store them into dist.
         dist = neig # just to reuse memory
-        b = st.Cache.line_size
+        b = self.line_size
         for j,ni,nj in zip(range(len(dist)-1), neig[:-1], neig[1:]):
             dist[j] = (b - min(b, nj-ni)) / (b - 1)
         del dist[-1]
@@ -158,36 +195,55 @@ class Locality(BaseModule):
         if not self.enabled:
             return
 
-        self.__all_space_windows_to_lt()
+        if self.tld_streaming:
+            self.__accumulators_to_lt()
+        else:
+            self.__all_space_windows_to_lt()
+        return
+
+    def __accumulators_to_lt(self):
+        """compose Lt from the per-block accumulated distances"""
+        C,B = self.C,self.B
+        # if there is only one access, there is no locality to compute.
+        self.Lt = [dist_sum / (C-B) / count if count > 0 else 0.0
+                   for dist_sum,count in zip(self.dist_sum, self.dist_count)]
         return
 
     def __all_space_windows_to_lt(self):
         """for all space windows, compute differences and compose the
         entirety of Lt"""
-        # obtain the list of all ACTUALLY used blocks
-        used_blocks = list(self.space_by_blocks.keys())
-        used_blocks.sort()
+        if len(self.block_accesses) == 0:
+            return
 
-        # for each window, get its neighborhood, compute distances and store
-        # the average distance in Lt.
+        # sort accesses by block. The sort is stable and the accesses were
+        # registered in chronological order, so each block's times (its
+        # space window) remain sorted.
+        pairs = np.frombuffer(self.block_accesses, dtype=np.int64)
+        pairs = pairs.reshape(-1, 2)
+        order = np.argsort(pairs[:,0], kind='stable')
+        blocks = pairs[order,0]
+        times = pairs[order,1]
+
+        # distances between consecutive accesses to the same block
+        same_block = blocks[1:] == blocks[:-1]
+        gap_blocks = blocks[1:][same_block]
+        gaps = np.diff(times)[same_block]
+
+        # for each window, compute distances and store the average distance
+        # in Lt. Distances are added as integers (exact) and scaled at the end:
+        # dist = (C - B*min(gap,C//B)) / (C-B)
         C = st.Cache.cache_size
         B = st.Cache.line_size
-        for ubi in used_blocks: #ubi: used-block ID
-            neig = self.space_by_blocks[ubi]
-            dist = neig # just to reuse memory
-            # if there is only one access, there is no locality to compute.
-            if len(neig) < 2:
-                self.Lt[ubi] = 0
-                continue
-
-            for j,ni,nj in zip(range(len(dist)-1), neig[:-1], neig[1:]):
-                #dist[j] = (C - min(C, nj-ni)) / (C-1)
-                dist[j] = (C - B*min(nj-ni,C//B)) / (C-B)
-            del dist[-1]
-
-            # get average difference in the neighborhood, and write it in Lt.
-            avg_dist = sum(dist) / len(dist)
-            self.Lt[ubi] = avg_dist
+        dist = C - B*np.minimum(gaps, C//B)
+        num_blocks = st.Map.num_blocks
+        dist_sum = np.bincount(gap_blocks, weights=dist, minlength=num_blocks)
+        dist_count = np.bincount(gap_blocks, minlength=num_blocks)
+
+        # if there is only one access, there is no locality to compute.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg_dist = dist_sum / (C-B) / dist_count
+        self.Lt = np.where(dist_count > 0, avg_dist, 0).tolist()
+        self.block_accesses = None
         return
 
     def SLD_to_dict(self):
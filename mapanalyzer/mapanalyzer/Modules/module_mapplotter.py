@@ -37,6 +37,13 @@ class Map(BaseModule):
         # rows: byte (space) state across all instructions
         self.space_time = [[0] * map_mat_cols for _ in range(map_mat_rows)]
 
+        # bounds of the map (aligned to the lines of this cache level)
+        self.aligned_start_addr = st.Map.aligned_start_addr
+        self.first_addr = st.Map.left_pad
+        self.last_addr = st.Map.aligned_end_addr - st.Map.right_pad
+        self.max_real_addr = max(1, st.Map.num_padded_bytes - 1)
+        self.max_real_time = max(1, st.Map.time_size - 1)
+
         # set of threads found
         self.threads = set()
         return
@@ -56,21 +63,18 @@ class Map(BaseModule):
         # register accesses of size more than 1 byte
         for offset in range(access.size):
             # obtain the original coordinates
-            addr = access.addr - st.Map.aligned_start_addr + offset
+            addr = access.addr - self.aligned_start_addr + offset
             time = access.time
 
             # out of boundary access attempt
-            if addr < st.Map.left_pad or \
-               st.Map.aligned_end_addr-st.Map.right_pad < addr:
+            if addr < self.first_addr or self.last_addr < addr:
                 UI.error(f'The map file has an access out of boundaries '
                          f'at (time,thread,event,size,offset):\n'
                          f'{access.time},{access.thread},{access.event},'
-                         f'{access.size},{addr-st.Map.left_pad}')
+                         f'{access.size},{addr-self.first_addr}')
             # get percentage (from first to last possible address or time)
-            max_real_addr = max(1, st.Map.num_padded_bytes - 1)
-            max_real_time = max(1, st.Map.time_size - 1)
-            propor_addr = addr / max_real_addr
-            propor_time = time / max_real_time
+            propor_addr = addr / self.max_real_addr
+            propor_time = time / self.max_real_time
 
             # get maximum value for the mapped address and time
             max_mapped_addr = len(self.space_time) - 1
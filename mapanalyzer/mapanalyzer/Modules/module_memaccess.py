@@ -56,6 +56,21 @@ class MemAccess(BaseModule):
             self.write += 1
         return
 
+    def commit_counts(self, time, reads, writes):
+        """add the reads and writes of a time step, and commit it"""
+        if not self.enabled:
+            return
+        self.read += reads
+        self.write += writes
+        if time > self.last_time + 1:
+            # there are empty times to fill
+            self.commit(time)
+            return
+        self.read_dist[time] = self.read
+        self.write_dist[time] = self.write
+        self.last_time = time
+        return
+
     def commit(self, time):
         if not self.enabled:
             return
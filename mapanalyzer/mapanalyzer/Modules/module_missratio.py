@@ -92,18 +92,45 @@ class MissRatio(BaseModule):
             return
 
         # queue event to time_window, and increment the thread's counters
-        self.time_window.append((access,hit_miss))
+        self.time_window.append((access.thread,hit_miss))
         if access.thread not in self.thread_miss_ratio:
             self.thread_miss_ratio[access.thread] = ThreadMissRatio()
         self.thread_miss_ratio[access.thread].update_counters(hit_miss)
 
         # dequeue event from time_window, and decrement the thread's counters
         while len(self.time_window) > self.time_window_size:
-            old_acc,(old_h,old_m) = self.time_window.popleft()
-            self.thread_miss_ratio[old_acc.thread].update_counters(
+            old_thread,(old_h,old_m) = self.time_window.popleft()
+            self.thread_miss_ratio[old_thread].update_counters(
                 (-old_h,-old_m))
         return
 
+    def commit_events(self, time, events):
+        """probe all the (thread, hit_miss) events of a time step, in order,
+        and commit it. Same as a probe per event and a commit, but the
+        window is trimmed once."""
+        if not self.enabled:
+            return
+        window = self.time_window
+        window.extend(events)
+        thread_miss_ratio = self.thread_miss_ratio
+        for thread,(hit,miss) in events:
+            thr_mr = thread_miss_ratio.get(thread)
+            if thr_mr is None:
+                thr_mr = thread_miss_ratio[thread] = ThreadMissRatio()
+            thr_mr.hit_count += hit
+            thr_mr.miss_count += miss
+        for _ in range(len(window) - self.time_window_size):
+            old_thread,(old_h,old_m) = window.popleft()
+            thr_mr = thread_miss_ratio[old_thread]
+            thr_mr.hit_count -= old_h
+            thr_mr.miss_count -= old_m
+        # same as commit(), without a call per thread
+        for thr_mr in thread_miss_ratio.values():
+            total = thr_mr.hit_count + thr_mr.miss_count
+            thr_mr.miss_ratio[time] = \
+                100*thr_mr.miss_count / total if total else 0
+        return
+
     def commit(self, time):
         if not self.enabled:
             return
@@ -1,10 +1,11 @@
 import matplotlib.pyplot as plt
 from itertools import zip_longest
 import math
+from bisect import bisect_right
 
 from ..settings import Settings as st
 from ..util import MetricStrings, Palette, PlotFile, sample_list, \
-    median
+    median, StreamingQuantile
 from ..ui import UI
 from .base import BaseModule
 
@@ -58,8 +59,9 @@ class EvictionRoundtrip(BaseModule):
             return
 
         # METRIC INTERNAL VARIABLES
-        # number of sets in the cache.
+        # number of sets in the cache, and bits of the set index.
         self.num_sets = st.Cache.num_sets
+        self.bits_set = st.Cache.bits_set
 
         # This table-of-dicts stores the in-cache time duration of each block.
         # The block_id is the concatenation of the block-tag and the set-id.
@@ -76,12 +78,51 @@ class EvictionRoundtrip(BaseModule):
         # change is a tuple set_idx -> [(time, old_block, new_block), ...]
         self.personalities = [[] for _ in range(self.num_sets)]
 
+        # In streaming mode, MRID does not need the alive intervals. Each
+        # roundtrip duration is binned as soon as the block is fetched back,
+        # so only BPA and SMRI (if enabled) keep the whole history.
+        self.mrid_streaming = ('MRID' in st.Metrics.streaming and
+                               self.__is_active('MRID'))
+        self.track_alive = (self.__is_active('BPA') or
+                            self.__is_active('SMRI') or
+                            (self.__is_active('MRID') and
+                             not self.mrid_streaming))
+        self.track_personalities = self.__is_active('BPA')
+
+        # STREAMING MRID
+        # time at which each block out of the cache was evicted:
+        # last_evict[set][tag] -> time
+        self.last_evict = [{} for _ in range(self.num_sets)]
+        # edges of the (log) bins and per-set histograms. The last counter of
+        # each histogram is for durations beyond the last edge.
+        self.mrid_bin_edges = self.__create_bins()
+        self.mrid_hists = None
+        self.mrid_medians = None
+        self.mrid_max = None
+        if self.mrid_streaming:
+            self.mrid_hists = [[0] * len(self.mrid_bin_edges)
+                               for _ in range(self.num_sets)]
+            self.mrid_quantiles = [StreamingQuantile(0.5)
+                                   for _ in range(self.num_sets)]
+            self.mrid_max = [None] * self.num_sets
         return
 
+    @classmethod
+    def __is_active(cls, metric_code):
+        """whether a metric of this module is enabled or used as background"""
+        return (metric_code in st.Metrics.enabled or
+                metric_code == st.Metrics.bg)
+
     def probe(self, time, set_idx, tag_in, tag_out):
         if not self.enabled:
             return
 
+        if self.mrid_streaming:
+            self.__stream_roundtrip(time, set_idx, tag_in, tag_out)
+
+        if not self.track_alive:
+            return
+
         # if a block is being fetched...
         if tag_in is not None:
             # Begin registration of in-Cache interval
@@ -100,14 +141,33 @@ class EvictionRoundtrip(BaseModule):
 
 
         # if one block is evicted and the other fetched...
-        if tag_in is not None and tag_out is not None:
+        if (tag_in is not None and tag_out is not None and
+            self.track_personalities):
             # the set is changing personality
-            block_in_id = (tag_in  << st.Cache.bits_set) | set_idx
-            block_out_id = (tag_out  << st.Cache.bits_set) | set_idx
+            block_in_id = (tag_in  << self.bits_set) | set_idx
+            block_out_id = (tag_out  << self.bits_set) | set_idx
             self.personalities[set_idx].append(
                 (time,block_out_id,block_in_id))
         return
 
+    def __stream_roundtrip(self, time, set_idx, tag_in, tag_out):
+        """Bin the roundtrip duration of a block being fetched back, and
+        remember the eviction time of a block being evicted"""
+        # a block that was evicted before is being fetched back
+        if tag_in is not None and tag_in in self.last_evict[set_idx]:
+            interv = time - self.last_evict[set_idx].pop(tag_in)
+            bin_idx = bisect_right(self.mrid_bin_edges, interv) - 1
+            self.mrid_hists[set_idx][bin_idx] += 1
+            self.mrid_quantiles[set_idx].add(interv)
+            set_max = self.mrid_max[set_idx]
+            if set_max is None or interv > set_max:
+                self.mrid_max[set_idx] = interv
+
+        # a block leaves the cache
+        if tag_out is not None:
+            self.last_evict[set_idx][tag_out] = time
+        return
+
     def commit(self, time):
         if not self.enabled:
             return
@@ -124,6 +184,12 @@ class EvictionRoundtrip(BaseModule):
         if not self.enabled:
             return
 
+        # (0) In streaming mode, the MRID histograms are already complete. Just
+        # read the medians from the quantile sketches.
+        if self.mrid_streaming:
+            self.mrid_medians = [q.value() for q in self.mrid_quantiles]
+            self.last_evict = None
+
 
         # (1) Derive self.dead_intervals from self.alive_intervals.
         # dead_intervals is the time in between alive_intervals.
@@ -517,6 +583,16 @@ class EvictionRoundtrip(BaseModule):
 
 
     def MRID_to_dict(self):
+        if self.mrid_streaming:
+            return {
+                'code' : 'MRID',
+                'streaming' : True,
+                'bin_edges' : self.mrid_bin_edges,
+                'histograms' : self.mrid_hists,
+                'medians' : self.mrid_medians,
+                'max_intervals' : self.mrid_max,
+                'num_sets' : self.num_sets
+            }
         return {
             'code' : 'MRID',
             'dead_intervals' : self.dead_intervals,
@@ -525,8 +601,15 @@ class EvictionRoundtrip(BaseModule):
 
     def dict_to_MRID(self, data):
         try:
-            self.dead_intervals = data['dead_intervals']
             self.num_sets = int(data['num_sets'])
+            if data.get('streaming', False):
+                self.mrid_bin_edges = data['bin_edges']
+                self.mrid_hists = data['histograms']
+                self.mrid_medians = data['medians']
+                self.mrid_max = data['max_intervals']
+            else:
+                self.dead_intervals = data['dead_intervals']
+                self.mrid_hists = None
         except:
             class_name = self.__class__.__name__
             UI.error(f'{class_name}.dict_to_MRID(): Malformed data.')
@@ -556,9 +639,16 @@ class EvictionRoundtrip(BaseModule):
         #####################################
         ## CREATE DATA SERIES
         # obtain dead intervals and medians (per set) and max dead interval
-        # (across all sets)
-        intervs, medians, range_intervs = \
-            self.__obtain_intervals(interv_marks=self.dead_intervals)
+        # (across all sets). If the data was streamed, the histograms are
+        # already binned.
+        streamed = self.mrid_hists is not None
+        if streamed:
+            medians = self.mrid_medians
+            range_intervs = [None if m is None else (0,m)
+                             for m in self.mrid_max]
+        else:
+            intervs, medians, range_intervs = \
+                self.__obtain_intervals(interv_marks=self.dead_intervals)
 
         if all(m is None for m in medians):
             self.draw_textbox(mpl_axes, f'{metric_code}: NO DATA', metric_code,
@@ -571,17 +661,27 @@ class EvictionRoundtrip(BaseModule):
         lin_bin_edges = [i for i in range(len(bin_edges))]
 
         # map dead intervals and bin edges to a linear scale so the histogram
-        # has even columns width
-        lin_intervs, lin_medians = self.__linearize_data(intervs, medians,
-                                                         bin_edges)
+        # has even columns width. Streamed histograms are given as one
+        # data-point per bin, weighted by the bin count.
+        if streamed:
+            num_bins = len(bin_edges) - 1
+            lin_intervs = [list(range(num_bins)) for _ in self.mrid_hists]
+            weights = [hist[:num_bins] for hist in self.mrid_hists]
+            _, lin_medians = self.__linearize_data(
+                [None]*self.num_sets, medians, bin_edges)
+        else:
+            weights = None
+            lin_intervs, lin_medians = self.__linearize_data(intervs, medians,
+                                                             bin_edges)
 
 
         #####################################
         ## PLOT HISTOGRAM
         hist_labels = [f's{s}' for s in range(self.num_sets)]
         counts,_,_ = mpl_axes.hist(lin_intervs, bins=lin_bin_edges,
-                                   label=hist_labels, color=hset_to_color,
-                                   stacked=True, zorder=3, width=0.95)
+                                   weights=weights, label=hist_labels,
+                                   color=hset_to_color, stacked=True, zorder=3,
+                                   width=0.95)
 
 
         #####################################
@@ -610,9 +710,10 @@ class EvictionRoundtrip(BaseModule):
         else:
             # compose the text to display in the textbox. One line per set
             text_lines = []
+            approx = '~' if streamed else ''
             for s,s_med in enumerate(medians):
                 if s_med is not None:
-                    text_lines.append(f's{s} median MRI: {s_med:.1f}')
+                    text_lines.append(f's{s} median MRI: {approx}{s_med:.1f}')
 
             # if too many lines, trim the list
             max_sets = 16
@@ -816,8 +917,9 @@ class EvictionRoundtrip(BaseModule):
         metric_code = all_pdata_dicts[0]['fg']['code']
         met_str = cls.supported_aggr_metrics[metric_code]
 
-        # extract data from dictionaries
-        all_interv_marks = [pd['fg']['dead_intervals']
+        # extract data from dictionaries. Pdatas simulated in streaming mode
+        # have no intervals, but histograms already binned.
+        all_interv_marks = [pd['fg'].get('dead_intervals')
                             for pd in all_pdata_dicts]
         num_pdatas = len(all_interv_marks)
 
@@ -832,8 +934,22 @@ class EvictionRoundtrip(BaseModule):
         pdatas_intervs = []
         pdatas_medians = []
         pdatas_ranges = []
+        pdatas_hists = []
         global_max_interv = 0
-        for pdata_marks in all_interv_marks:
+        for pdata_dict,pdata_marks in zip(all_pdata_dicts, all_interv_marks):
+            # streamed pdata: merge the histograms of all the sets into one
+            if pdata_marks is None:
+                fg = pdata_dict['fg']
+                pdatas_hists.append([sum(c) for c in zip(*fg['histograms'])])
+                pdatas_intervs.append([None])
+                pdatas_medians.append([None])
+                pdatas_ranges.append([None])
+                sets_max = [m for m in fg['max_intervals'] if m is not None]
+                if len(sets_max) > 0:
+                    global_max_interv = max(global_max_interv, max(sets_max))
+                continue
+            pdatas_hists.append(None)
+
             # flatten marks so that there is only one "dummy" set that merges
             # all the actual sets in this pdata_marks
             merged_t0 = []
@@ -877,6 +993,9 @@ class EvictionRoundtrip(BaseModule):
                                           pdatas_lin_medians)):
             for l_idx in intv[0]:
                 bin_count_distr[i][l_idx] += 1
+        for i,hist in enumerate(pdatas_hists):
+            if hist is not None:
+                bin_count_distr[i] = hist[:len(bin_edges)-1]
 
         # Find the median of each bin
         bin_medians = [0] * (len(bin_edges)-1)
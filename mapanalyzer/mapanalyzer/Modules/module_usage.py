@@ -56,6 +56,10 @@ class CacheUsage(BaseModule):
     def commit(self, time):
         if not self.enabled:
             return
+        # without write-allocate, writes may not bring any block to cache
+        if self.valid_bytes == 0:
+            self.usage_ratio[time] = 0
+            return
         self.usage_ratio[time] = 100 * self.accessed_bytes / self.valid_bytes
 
     def finalize(self):
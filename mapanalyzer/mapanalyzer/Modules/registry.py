@@ -0,0 +1,103 @@
+import importlib
+from importlib import metadata
+
+from ..ui import UI
+
+class ModuleEntry:
+    """A module that can compute some metrics, imported only when asked for
+    its class. Built-in modules are attributes of the modules manager (and
+    are probed at specific points of the simulation). Modules installed by
+    other packages are extensions: they are probed with every access, as
+    the MAP module is."""
+    def __init__(self, path, class_name, codes, name=None, entry_point=None):
+        self.path = path
+        self.class_name = class_name
+        self.codes = codes
+        # attribute name in the manager. None for extensions
+        self.name = name
+        self.entry_point = entry_point
+        self.module_class = None
+        return
+
+    def load(self):
+        if self.module_class is None:
+            try:
+                if self.entry_point is not None:
+                    self.module_class = self.entry_point.load()
+                else:
+                    py_module = importlib.import_module(self.path, __package__)
+                    self.module_class = getattr(py_module, self.class_name)
+            except Exception as e:
+                UI.error(f'While loading the module {self.path}:'
+                         f'{self.class_name} of the metrics '
+                         f'{", ".join(self.codes)}:\n{e}')
+        return self.module_class
+
+
+class Registry:
+    """Modules by the metric codes they compute. Built-in modules are listed
+    here; other packages add theirs through entry points of the group
+    "mapanalyzer.modules", named after the metric codes they compute:
+
+        [project.entry-points."mapanalyzer.modules"]
+        XYZ = "mypackage.mymodule:MyModule"
+
+    A module class computing several metrics has one entry point per code.
+    Its class must inherit from BaseModule, and define supported_metrics
+    with the same codes."""
+    entry_point_group = 'mapanalyzer.modules'
+    # built-in modules, in the order of their metrics
+    builtin = [
+        ModuleEntry('.module_mapplotter', 'Map', ('MAP',), 'map'),
+        ModuleEntry('.module_locality', 'Locality', ('SLD', 'TLD'),
+                    'locality'),
+        ModuleEntry('.module_missratio', 'MissRatio', ('CMR',), 'missratio'),
+        ModuleEntry('.module_memaccess', 'MemAccess', ('CMMA',), 'memaccess'),
+        ModuleEntry('.module_usage', 'CacheUsage', ('CUR',), 'usage'),
+        ModuleEntry('.module_aliasing', 'Aliasing', ('AD',), 'aliasing'),
+        ModuleEntry('.module_roundtrip', 'EvictionRoundtrip',
+                    ('BPA', 'SMRI', 'MRID'), 'roundtrip'),
+    ]
+    builtin_names = [e.name for e in builtin]
+    # extensions, discovered on first use
+    extensions = None
+
+    @classmethod
+    def __discover(cls):
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, 'select'):
+            entry_points = entry_points.select(group=cls.entry_point_group)
+        else:
+            entry_points = entry_points.get(cls.entry_point_group, [])
+        builtin_codes = {c for e in cls.builtin for c in e.codes}
+        # {'package.module:Class' -> ModuleEntry}
+        by_value = {}
+        for ep in entry_points:
+            code = ep.name.upper()
+            if code in builtin_codes:
+                UI.warning(f'Ignoring the module {ep.value} registered for '
+                           f'the built-in metric "{code}".')
+                continue
+            if ep.value not in by_value:
+                path,_,class_name = ep.value.partition(':')
+                by_value[ep.value] = ModuleEntry(path, class_name, (),
+                                                 entry_point=ep)
+            by_value[ep.value].codes += (code,)
+        cls.extensions = list(by_value.values())
+        return
+
+    @classmethod
+    def entries(cls):
+        if cls.extensions is None:
+            cls.__discover()
+        return cls.builtin + cls.extensions
+
+    @classmethod
+    def entries_for(cls, codes):
+        """the modules that compute any of the given metric codes"""
+        codes = {c.upper() for c in codes}
+        return [e for e in cls.entries() if codes.intersection(e.codes)]
+
+    @classmethod
+    def classes_for(cls, codes):
+        return [e.load() for e in cls.entries_for(codes)]
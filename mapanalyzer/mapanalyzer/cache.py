@@ -1,12 +1,166 @@
-from collections import deque
+import math, multiprocessing, os, pickle, queue, random, threading
+import numpy as np
 
 from .settings import Settings as st
 from .ui import UI
+from .util import MapDataReader
+from .directmapped import DirectMappedSimulation
+
+class Request:
+    """A memory access issued by a cache level to the next one. It has the
+    same members as the records read from the map file."""
+    # cache line fragments, if already computed (see split_lines())
+    lines = None
+
+    def __init__(self, time, thread, event, size, addr):
+        self.time = time
+        self.thread = thread
+        self.event = event
+        self.size = size
+        self.addr = addr
+
+    def __str__(self):
+        return (f'tim:{self.time}, thr:{self.thread}, '
+                f'eve:{self.event}, addr:{self.addr}, '
+                f'siz:{self.size}')
+
+
+class Run(Request):
+    """An access followed by accesses of the same thread to the same cache
+    line, with no other access in between (see collapse_runs()). The
+    repeats are the records of the following accesses."""
+    def __init__(self, access, repeats):
+        super().__init__(access.time, access.thread, access.event,
+                         access.size, access.addr)
+        self.repeats = repeats
+
+
+class ProbeSink:
+    """Stand-in for a modules manager that discards the probes sent by a
+    cache. Some modules can be set as its attributes to keep probing them
+    (e.g., the modules tracking the contents of a cache being warmed up)."""
+    module_names = ['map', 'locality', 'missratio', 'memaccess', 'usage',
+                    'aliasing', 'roundtrip']
+
+    def __init__(self):
+        for name in self.module_names:
+            setattr(self, name, None)
+        self.access_observers = []
+        return
+
+    def commit(self, time):
+        return
+
+    def commit_counts(self, time, events, reads, writes):
+        return
+
+    def finalize(self):
+        return
+
+
+class ShardProbes(ProbeSink):
+    """Stand-in for a modules manager in a job that simulates some of the
+    sets of a cache (see simulate_set_shard()). Instead of computing the
+    metrics, it collects what the modules of the parent need from the job:
+    - per commit, the main memory reads and writes and the usage deltas,
+      which are just added up across jobs.
+    - the hits, misses and fetches, keyed by commit (step) and by the
+      position that the cache gives to their line in the sequential order.
+      Their order matters, as the modules keep windows of the last ones.
+    - the fills and evictions, whose order only matters within a set.
+    - if the map or locality modules are probed (they see every access, so
+      the parent probes them), the rank of the accesses of the steps of
+      several accesses whose first line is in the owned sets.
+    The collections of several jobs are merged with merge()."""
+    class __Probe:
+        def __init__(self, probe):
+            self.probe = probe
+
+    def __init__(self, probed_names):
+        super().__init__()
+        self.position = None
+        self.step = 0
+        self.reads = 0
+        self.writes = 0
+        self.accessed = 0
+        self.valid = 0
+        self.collected = {'times': [], 'reads': [], 'writes': [],
+                          'accessed': [], 'valid': [], 'hits_misses': [],
+                          'fetches': [], 'fills_evictions': [], 'ranks': {}}
+        probes = {'missratio': self.__hit_miss, 'memaccess': self.__memory,
+                  'usage': self.__usage, 'aliasing': self.__fetch,
+                  'roundtrip': self.__fill_evict}
+        for name,probe in probes.items():
+            if name in probed_names:
+                setattr(self, name, self.__Probe(probe))
+        self.track_ranks = 'access' in probed_names or \
+            'locality' in probed_names
+        return
+
+    def __hit_miss(self, access, hit_miss):
+        self.collected['hits_misses'].append(
+            (self.step, self.position, access.thread, hit_miss))
+
+    def __memory(self, rw):
+        if rw == 'r':
+            self.reads += 1
+        else:
+            self.writes += 1
+
+    def __usage(self, delta_access=0, delta_valid=0):
+        self.accessed += delta_access
+        self.valid += delta_valid
+
+    def __fetch(self, set_index, access_time):
+        self.collected['fetches'].append((self.step, self.position,
+                                          set_index))
+
+    def __fill_evict(self, time, set_idx, tag_in, tag_out):
+        self.collected['fills_evictions'].append((time, set_idx, tag_in,
+                                                  tag_out))
+
+    def rank(self, i, rank):
+        """the rank of the i-th access of the current step"""
+        if self.track_ranks:
+            self.collected['ranks'][(self.step, i)] = rank
+        return
+
+    def commit(self, time):
+        collected = self.collected
+        collected['times'].append(time)
+        collected['reads'].append(self.reads)
+        collected['writes'].append(self.writes)
+        collected['accessed'].append(self.accessed)
+        collected['valid'].append(self.valid)
+        self.reads = self.writes = self.accessed = self.valid = 0
+        self.step += 1
+        return
+
+    def finalize(self):
+        # counters are sent as arrays, to be added up
+        for name in ('reads', 'writes', 'accessed', 'valid'):
+            self.collected[name] = np.array(self.collected[name],
+                                            dtype=np.int64)
+        return
+
+    @staticmethod
+    def merge(collected, other):
+        """add the collection of a job to the one of another job (of the
+        same map). Events are only appended: sort them before use."""
+        for name in ('reads', 'writes', 'accessed', 'valid'):
+            collected[name] += other[name]
+        for name in ('hits_misses', 'fetches', 'fills_evictions'):
+            collected[name].extend(other[name])
+        collected['ranks'].update(other['ranks'])
+        return
+
 
 class Block:
-    def __init__(self, block_size, tag=None, dirty=False):
+    def __init__(self, block_size, tag=None, dirty=False, thread=None):
         self.tag = tag
         self.dirty = dirty
+        self.thread = thread # thread that fetched the block
+        self.way = None # way of the set in which the block is stored
         self.bytes = [False] * block_size # accessed bytes
         
     def access(self, offset, n_bytes, write=False):
@@ -34,44 +188,383 @@ class Block:
         return f'{by}|{d}'
 
 
+class TagBlock:
+    """Block that does not track its accessed bytes, used when no module
+    counts them"""
+    __slots__ = ('tag', 'dirty', 'thread', 'way')
+    def __init__(self, tag, dirty=False, thread=None):
+        self.tag = tag
+        self.dirty = dirty
+        self.thread = thread
+        self.way = None
+
+    def __repr__(self):
+        d = "x" if self.dirty else "_"
+        return f'{self.tag}|{d}'
+
+
+class LineEvents(dict):
+    """{thread -> its (thread, hit_miss) events of a hit and of a miss}. The
+    lean kernels of Cache give the same objects for all the lines of a
+    thread, instead of building them for each line."""
+    def __missing__(self, thread):
+        events = self[thread] = ((thread, (1,0)), (thread, (0,1)))
+        return events
+
+
 class Set:
-    def __init__(self, associativity):
+    """Array-backed cache set: blocks live in self.ways, and each block
+    knows its way. The replacement policy is implemented by subclasses
+    through the hooks _on_fill(way), _on_hit(way), _on_remove(way) and
+    _victim(), which only see way indices."""
+    def __init__(self, associativity, set_index=0):
         self.associativity = int(associativity)
-        self.lines = deque()
+        self.ways = [None] * self.associativity
+        # free ways, filled from way 0 upwards
+        self.free = list(range(self.associativity-1, -1, -1))
 
     def push_block(self, block) -> Block:
         """push a block to this set. If the set is full, return the evicting
         block, otherwise return None"""
-        self.lines.appendleft(block)
-        if len(self.lines) <= self.associativity:
-            return None
-        return self.lines.pop()
+        if self.free:
+            way = self.free.pop()
+            evicted_block = None
+        else:
+            way = self._victim()
+            evicted_block = self.ways[way]
+            self._on_remove(way)
+        self.ways[way] = block
+        block.way = way
+        self._on_fill(way)
+        return evicted_block
 
     def touch_block(self, block):
-        """bring some block in the set to the beginning of the queue,
-        making it the "most recently used" one."""
-        self.lines.remove(block)
-        self.lines.appendleft(block)
+        """register a hit on some block in the set"""
+        self._on_hit(block.way)
         return
 
-    def pop_lru_block(self):
-        """remove the least recently used block, or None if set is empty"""
-        if len(self.lines) == 0:
+    def pop_block(self):
+        """remove the block that would be evicted next, or None if the set is
+        empty"""
+        if len(self.free) == self.associativity:
             return None
-        return self.lines.pop()
+        way = self._flush_victim()
+        block = self.ways[way]
+        self.ways[way] = None
+        self.free.append(way)
+        self._on_remove(way)
+        return block
+
+    def _on_fill(self, way):
+        return
+
+    def _on_hit(self, way):
+        return
+
+    def _on_remove(self, way):
+        return
+
+    def _victim(self):
+        raise NotImplementedError
+
+    def _flush_victim(self):
+        """way to empty next when flushing. By default, the next victim"""
+        return self._victim()
+
+    def _first_used_way(self):
+        for way,block in enumerate(self.ways):
+            if block is not None:
+                return way
+        return None
+
+
+class LRUSet(Set):
+    """Least Recently Used. Ways are kept in a doubly linked list (arrays of
+    previous/next way) from the most to the least recently used."""
+    def __init__(self, associativity, set_index=0):
+        super().__init__(associativity, set_index)
+        self.prev = [-1] * self.associativity
+        self.next = [-1] * self.associativity
+        self.head = -1 # most recently used
+        self.tail = -1 # least recently used
+
+    def _on_fill(self, way):
+        # push way to the front of the list
+        self.prev[way] = -1
+        self.next[way] = self.head
+        if self.head != -1:
+            self.prev[self.head] = way
+        else:
+            self.tail = way
+        self.head = way
+        return
+
+    def _on_hit(self, way):
+        if way != self.head:
+            self._on_remove(way)
+            self._on_fill(way)
+        return
+
+    def _on_remove(self, way):
+        # unlink way from the list
+        prv,nxt = self.prev[way],self.next[way]
+        if prv != -1:
+            self.next[prv] = nxt
+        else:
+            self.head = nxt
+        if nxt != -1:
+            self.prev[nxt] = prv
+        else:
+            self.tail = prv
+        return
+
+    def _victim(self):
+        return self.tail
+
+
+class FIFOSet(Set):
+    """First In First Out. Ways are filled in order, so the oldest block is
+    always the one after the last evicted."""
+    def __init__(self, associativity, set_index=0):
+        super().__init__(associativity, set_index)
+        self.next_victim = 0
+
+    def _victim(self):
+        way = self.next_victim
+        self.next_victim = (way + 1) % self.associativity
+        return way
+
+
+class PLRUSet(Set):
+    """Tree Pseudo-LRU. A binary tree of associativity-1 bits, each pointing
+    to the half with the next victim. Accessing a way flips the bits in its
+    path to point away from it."""
+    # {associativity -> [[(node, bit), ...] for each way]}
+    paths = {}
+
+    def __init__(self, associativity, set_index=0):
+        super().__init__(associativity, set_index)
+        self.bits = [0] * max(self.associativity-1, 0)
+        if self.associativity not in self.paths:
+            self.paths[self.associativity] = \
+                [self.__path(w) for w in range(self.associativity)]
+        self.way_paths = self.paths[self.associativity]
+
+    def __path(self, way):
+        """nodes from the root to the way, and the value that makes each
+        node point away from it"""
+        path = []
+        node,lo,hi = 0,0,self.associativity
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if way < mid:
+                path.append((node, 1))
+                node,hi = 2*node+1,mid
+            else:
+                path.append((node, 0))
+                node,lo = 2*node+2,mid
+        return path
+
+    def _on_fill(self, way):
+        bits = self.bits
+        for node,bit in self.way_paths[way]:
+            bits[node] = bit
+        return
+
+    _on_hit = _on_fill
+
+    def _victim(self):
+        node,lo,hi = 0,0,self.associativity
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.bits[node] == 0:
+                node,hi = 2*node+1,mid
+            else:
+                node,lo = 2*node+2,mid
+        return lo
+
+    def _flush_victim(self):
+        # the tree is not updated when blocks are removed, so it may point
+        # to an empty way.
+        return self._first_used_way()
+
+
+class RandomSet(Set):
+    """Random replacement, with a generator per set seeded from the
+    replacement_seed and the set index (so results do not depend on the
+    order in which sets are simulated)."""
+    def __init__(self, associativity, set_index=0):
+        super().__init__(associativity, set_index)
+        self.rng = random.Random(st.Cache.policy_seed * 1000003 + set_index)
+
+    def _victim(self):
+        return self.rng.randrange(self.associativity)
+
+    def _flush_victim(self):
+        # no need to draw random numbers to empty the set
+        return self._first_used_way()
+
+
+class SRRIPSet(Set):
+    """Static Re-Reference Interval Prediction (2-bit RRPV). Blocks are
+    inserted with a long re-reference prediction, and promoted to near
+    on hits. The victim is the first way with a distant prediction, aging
+    all ways if there is none.
+
+    The used ways are kept in buckets (bitmasks of ways) by RRPV, and the
+    buckets in a ring rotated by the aging offset: aging all ways moves
+    the offset rather than the ways, so finding a victim and aging take
+    constant time."""
+    max_rrpv = 3
+    num_buckets = max_rrpv + 1
+
+    def __init__(self, associativity, set_index=0):
+        super().__init__(associativity, set_index)
+        # the bucket of RRPV r is buckets[(r - age) % num_buckets]
+        self.buckets = [0] * self.num_buckets
+        self.age = 0
+        # bucket of each used way (None if free)
+        self.way_bucket = [None] * self.associativity
+
+    def _on_fill(self, way):
+        bucket = (self.max_rrpv - 1 - self.age) % self.num_buckets
+        self.buckets[bucket] |= 1 << way
+        self.way_bucket[way] = bucket
+        return
+
+    def _on_hit(self, way):
+        bucket = -self.age % self.num_buckets
+        old = self.way_bucket[way]
+        if old != bucket:
+            buckets = self.buckets
+            buckets[old] &= ~(1 << way)
+            buckets[bucket] |= 1 << way
+            self.way_bucket[way] = bucket
+        return
+
+    def _on_remove(self, way):
+        self.buckets[self.way_bucket[way]] &= ~(1 << way)
+        self.way_bucket[way] = None
+        return
+
+    def _victim(self):
+        # oldest prediction among the used ways
+        buckets = self.buckets
+        rrpv = self.max_rrpv
+        ways = buckets[(rrpv - self.age) % self.num_buckets]
+        while not ways:
+            rrpv -= 1
+            ways = buckets[(rrpv - self.age) % self.num_buckets]
+        # age all ways at once, as many times as needed
+        self.age = (self.age + self.max_rrpv - rrpv) % self.num_buckets
+        # lowest way in the bucket
+        return (ways & -ways).bit_length() - 1
+
+
+# {replacement policy name -> set class}
+replacement_policies = {
+    'lru'   : LRUSet,
+    'fifo'  : FIFOSet,
+    'plru'  : PLRUSet,
+    'random': RandomSet,
+    'srrip' : SRRIPSet,
+}
 
 
 class Cache:
-    def __init__(self, modules=None):
+    # the (thread, hit_miss) events of the lean kernels, shared by all caches
+    line_events = LineEvents()
+
+    def __init__(self, modules=None, forward=False, owned_sets=None):
         if modules is None:
             raise ValueError('modules object cannot be None')
         self.modules = modules
         self.blocks_in_cache = {}
-        self.sets = [Set(st.Cache.asso) for _ in range(st.Cache.num_sets)]
+        set_class = replacement_policies[st.Cache.policy]
+        self.sets = [set_class(st.Cache.asso, set_index=i)
+                     for i in range(st.Cache.num_sets)]
+
+        # geometry of this level, and the constants that split its addresses
+        # (relative to the map start, aligned to its lines). They are taken
+        # from the selected level once, so that the levels of a hierarchy can
+        # be simulated without selecting them again.
+        self.line_size = st.Cache.line_size
+        self.num_sets = st.Cache.num_sets
+        self.bits_set = st.Cache.bits_set
+        self.bits_off = st.Cache.bits_off
+        self.tag_shift = st.Cache.bits_set + st.Cache.bits_off
+        self.max_index = st.Cache.num_sets - 1
+        self.max_offset = st.Cache.line_size - 1
+        self.base_addr = st.Map.aligned_start_addr
+        self.fmt = (st.Cache.bits_off, st.Cache.bits_set,
+                    st.Map.aligned_start_addr, st.Cache.arch)
+
+        # if given (one boolean per set), only the lines mapped to the owned
+        # sets are simulated and reported. Accesses are reported to the
+        # 'map' module by the owner of their first line.
+        self.owned_sets = owned_sets
+        # the probes of a job are told the position of each line in the
+        # sequential order, so that the probes of several jobs can be merged.
+        self.tag_positions = isinstance(modules, ShardProbes)
+
+        # if given, hits, misses and main memory accesses are also counted
+        # per sampling unit (see SampleStats)
+        self.sample_stats = None
+
+        # write policies. With write-through, blocks are never dirty.
+        self.write_back = st.Cache.write_policy == 'write-back'
+        self.write_allocate = st.Cache.write_allocate != 0
+
+        # if forwarding, block fetches and dirty write-backs are collected as
+        # requests to the next cache level.
+        self.forward = forward
+        self.requests = []
+
+        # if the modules only count hits, misses and main memory accesses
+        # (e.g., only CMR and CMMA are enabled), the lean access kernel
+        # skips the bookkeeping that no module would see.
+        self.lean = self.__lean_modules(modules)
         return
 
-    def __accesses(self, concurrent_access):
-        common_time = concurrent_access[0].time
+    @staticmethod
+    def __lean_modules(modules):
+        # profiling measures the probes and commits of the modules
+        if modules.access_observers or st.profile is not None:
+            return False
+        return all(getattr(modules, name) is None
+                   for name in ('locality', 'usage', 'aliasing', 'roundtrip'))
+
+    def pop_requests(self):
+        """return the requests to the next level collected so far"""
+        requests = self.requests
+        self.requests = []
+        return requests
+
+    def __request_block(self, time, thread, event, tag, set_index):
+        """issue a request to the next level for the (non-padding) bytes of
+        the given block"""
+        block_addr = self.base_addr + \
+            (((tag << self.bits_set) | set_index) << self.bits_off)
+        first = max(block_addr, st.Map.start_addr)
+        last = min(block_addr + self.line_size - 1, st.Map.end_addr)
+        self.requests.append(Request(time, thread, event, last-first+1, first))
+        return
+
+    def __request_bytes(self, time, thread, event, addr, n_bytes):
+        """issue a request to the next level for some bytes of a block"""
+        self.requests.append(Request(time, thread, event, n_bytes,
+                                     self.base_addr + addr))
+        return
+
+    def split(self, addr):
+        """(tag, set index, offset) of an address relative to the aligned
+        start of the map"""
+        return (addr >> self.tag_shift, (addr >> self.bits_off) &
+                self.max_index, addr & self.max_offset)
+
+    def accesses(self, concurrent_access, common_time):
+        """effect a batch of accesses that happen at the same time, and
+        commit that time"""
 
         # sort concurrent accesses so requests to blocks in cache
         # have priority (to avoid potential evict&fetch the same block
@@ -80,22 +573,66 @@ class Cache:
             priority = []
             rest = []
             for a in concurrent_access:
-                addr = a.addr - st.Map.aligned_start_addr
-                tag, idx, _ = st.AddrFmt.split(addr)
+                fragments = line_fragments(a, self.fmt)
+                if fragments:
+                    tag, idx = fragments[0][:2]
+                else:
+                    tag, idx, _ = self.split(a.addr - self.base_addr)
                 if (tag,idx) in self.blocks_in_cache:
                     priority.append(a)
                 else:
                     rest.append(a)
             concurrent_access = priority+rest
 
-        # effect all concurrent accesses
+        # effect all concurrent accesses. Sampled caches always take the
+        # general kernel.
+        if self.lean and self.owned_sets is None and \
+           self.sample_stats is None:
+            if self.modules.memaccess is None and not self.forward:
+                self.__hit_miss_accesses(concurrent_access, common_time)
+            else:
+                self.__memory_accesses(concurrent_access, common_time)
+            return
         for a in concurrent_access:
             self.__single_access(a)
         self.modules.commit(common_time)
 
         return
 
-    def __single_access(self, access):
+    def accesses_in_owned_sets(self, concurrent_access, common_time):
+        """same as accesses(), but only simulating the owned sets, and telling
+        the probes (a ShardProbes) the position that each line has in the
+        sequential order: resident blocks first, then order of arrival, then
+        the lines of each access in order. The residency of blocks in sets
+        owned elsewhere is unknown, so if a concurrent access has lines in
+        owned and not owned sets, its rank among the others cannot be known.
+        Then return False, without effecting the accesses. Otherwise return
+        True."""
+        if len(concurrent_access) == 1:
+            ranked = [((0,0), concurrent_access[0])]
+        else:
+            ranked = []
+            for i,a in enumerate(concurrent_access):
+                fragments = line_fragments(a, self.fmt)
+                if len({self.owned_sets[f[1]] for f in fragments}) > 1:
+                    return False
+                if fragments:
+                    tag, idx = fragments[0][:2]
+                else:
+                    tag, idx, _ = self.split(a.addr - self.base_addr)
+                rank = (0 if (tag,idx) in self.blocks_in_cache else 1, i)
+                if self.owned_sets[idx]:
+                    self.modules.rank(i, rank)
+                ranked.append((rank, a))
+            ranked.sort(key=lambda r: r[0])
+
+        # effect all concurrent accesses
+        for rank,a in ranked:
+            self.__single_access(a, rank)
+        self.modules.commit(common_time)
+        return True
+
+    def __single_access(self, access, rank=None):
         """ Access 'n bytes' starting from address 'addr'. If this requires to
         access multiple cache lines, then generate multiple accesses."""
         # Access object:
@@ -104,93 +641,317 @@ class Cache:
         # - event : read or write event {'R', 'W'}
         # - thread: the thread accessing data
         # - time  : the timestamp of the instruction.
-        addr = access.addr - st.Map.aligned_start_addr
-        n_bytes = access.size
-        self.modules.map.probe(access=access)
+        # modules of disabled metrics are None, and are not probed
+        modules = self.modules
+        if self.owned_sets is None:
+            for observer in modules.access_observers:
+                observer.probe(access=access)
+        else:
+            addr = access.addr - self.base_addr
+            if self.owned_sets[self.split(addr)[1]]:
+                for observer in modules.access_observers:
+                    observer.probe(access=access)
 
-        # check correct bit_length
-        if addr.bit_length() > st.Cache.arch:
-            raise ValueError(f'Error: Access issued to address '
-                             f'larger ({addr.bit_length()} bits) than '
-                             f'the architecture defined for this cache '
-                             f'({st.Cache.arch} bits).')
+        writing = (access.event == 'W')
+        dirtying = writing and self.write_back
+        # Accessed bytes are only tracked for the usage module.
+        track_bytes = modules.usage is not None
 
         # access the potentially many lines
-        while n_bytes > 0:
-            v_tag, set_index, offset = st.AddrFmt.split(addr)
+        for fragment in line_fragments(access, self.fmt):
+            v_tag, set_index, offset, this_block_n_bytes, addr = fragment
             # TODO: implement TLB and physical addresses
             p_tag = v_tag
 
-            # handle multi-line accesses
-            if n_bytes > (st.Cache.line_size - offset):
-                this_block_n_bytes = st.Cache.line_size - offset
-            else:
-                this_block_n_bytes = n_bytes
+            # skip lines of sets simulated elsewhere
+            if self.owned_sets is not None:
+                if not self.owned_sets[set_index]:
+                    continue
+                if self.tag_positions:
+                    modules.position = (rank, addr)
 
-            self.modules.locality.probe(access.time, access.thread,
-                                        access.event, this_block_n_bytes, addr)
+            if modules.locality is not None:
+                modules.locality.probe(access.time, access.thread,
+                                       access.event, this_block_n_bytes, addr)
 
             # access this_block
-            writing = (access.event == 'W')
-            if (p_tag,set_index) not in self.blocks_in_cache:
+            hit, resident_block, evicted_block, mem_writes = \
+                self.__access_line(access, fragment, writing, dirtying,
+                                   track_bytes)
+            if modules.missratio is not None:
+                modules.missratio.probe(access, (1,0) if hit else (0,1))
+            if self.sample_stats is not None:
+                self.sample_stats.access(set_index, miss=not hit)
+                for _ in range(mem_writes + (resident_block is not None and
+                                             not hit)):
+                    self.sample_stats.memory(set_index)
+            if modules.memaccess is not None:
+                if resident_block is not None and not hit:
+                    modules.memaccess.probe('r') # read
+                for _ in range(mem_writes):
+                    modules.memaccess.probe('w') # write
+            if resident_block is None:
+                # written around the cache
+                continue
+
+            if not hit:
+                # FETCH (and maybe EVICTION)
+                if modules.aliasing is not None:
+                    modules.aliasing.probe(set_index, access.time)
+                if modules.usage is not None:
+                    modules.usage.probe(delta_valid=self.line_size)
+                tag_out = None if evicted_block is None else \
+                    evicted_block.tag
+                if modules.roundtrip is not None:
+                    modules.roundtrip.probe(access.time, set_index, p_tag,
+                                            tag_out)
+                if evicted_block is not None and modules.usage is not None:
+                    modules.usage.probe(
+                        delta_access=-evicted_block.count_accessed(),
+                        delta_valid=-self.line_size)
+
+            # mark accessed bytes (only counted for the usage module)
+            if modules.usage is not None:
+                old_ab = resident_block.count_accessed()
+                resident_block.access(offset, this_block_n_bytes,
+                                      write=dirtying)
+                new_ab = resident_block.count_accessed()
+                modules.usage.probe(delta_access=new_ab-old_ab)
+        return
+
+    def __access_line(self, access, fragment, writing, dirtying, track_bytes):
+        """effect the access to one line fragment (see line_fragments()) on
+        the state of the cache, for the general kernel (which probes the
+        modules with the outcome): look the block up; on a miss, fetch it
+        (unless the write goes around the cache), evicting one of its set;
+        update the replacement policy; mark the block dirty if dirtying; and
+        request the main memory accesses to the next level if forwarding. Blocks track their accessed bytes if track_bytes.
+        Return (hit, block, evicted block, number of main memory writes),
+        where block is None if the write went around the cache. On a miss
+        with a block, the block was read from main memory."""
+        p_tag, set_index, _, n_bytes, addr = fragment
+        blocks_in_cache = self.blocks_in_cache
+        block = blocks_in_cache.get((p_tag,set_index))
+        mem_writes = 0
+        if block is not None:
+            # HIT
+            hit = True
+            evicted_block = None
+            self.sets[set_index].touch_block(block)
+            if dirtying:
+                block.dirty = True
+        else:
+            # MISS
+            hit = False
+            if writing and not self.write_allocate:
+                # WRITE AROUND: write to main memory, without fetching
+                if self.forward:
+                    self.__request_bytes(access.time, access.thread, 'W',
+                                         addr, n_bytes)
+                return False, None, None, 1
+
+            # fetch block from main memory
+            if track_bytes:
+                block = Block(self.line_size, tag=p_tag, dirty=dirtying,
+                              thread=access.thread)
+            else:
+                block = TagBlock(p_tag, dirty=dirtying, thread=access.thread)
+            if self.forward:
+                self.__request_block(access.time, access.thread, 'R',
+                                     p_tag, set_index)
+            blocks_in_cache[(p_tag,set_index)] = block
+
+            # handle potentially evicted block
+            evicted_block = self.sets[set_index].push_block(block)
+            if evicted_block is not None:
+                # EVICTION
+                del blocks_in_cache[(evicted_block.tag,set_index)]
+                if evicted_block.dirty:
+                    # WRITE DIRTY BLOCK
+                    mem_writes += 1
+                    if self.forward:
+                        self.__request_block(access.time, access.thread,
+                                             'W', evicted_block.tag,
+                                             set_index)
+
+        if writing and not self.write_back:
+            # WRITE THROUGH
+            mem_writes += 1
+            if self.forward:
+                self.__request_bytes(access.time, access.thread, 'W',
+                                     addr, n_bytes)
+        return hit, block, evicted_block, mem_writes
+
+    def __hit_miss_accesses(self, concurrent_access, common_time):
+        """same as calling __single_access() on each access and committing
+        the time, for modules that only see hits and misses (e.g., only CMR
+        is enabled) of a last level: there are no probes of locality,
+        aliasing or evictions, and neither accessed bytes, dirty blocks nor
+        main memory accesses are kept. So each line costs a tag lookup and a
+        replacement policy update. Hits and misses are given to the modules
+        once for the whole time step."""
+        events = []
+        append = events.append
+        blocks_in_cache = self.blocks_in_cache
+        sets = self.sets
+        write_allocate = self.write_allocate
+        line_events = self.line_events
+        fmt = self.fmt
+
+        for access in concurrent_access:
+            thread = access.thread
+            hit_event,miss_event = line_events[thread]
+            around = not write_allocate and access.event == 'W'
+            # access the potentially many lines
+            for p_tag, set_index, _, _, _ in line_fragments(access, fmt):
+                key = (p_tag,set_index)
+                block = blocks_in_cache.get(key)
+                if block is not None:
+                    # HIT
+                    append(hit_event)
+                    sets[set_index].touch_block(block)
+                    continue
                 # MISS
-                self.modules.missratio.probe(access, (0,1)) # miss++
-
-                # fetch block from main memory
-                fetched_block = Block(st.Cache.line_size, tag=p_tag,
-                                            dirty=writing)
-                self.modules.aliasing.probe(set_index, access.time)
-                self.modules.memaccess.probe('r') # read
-
-                # add fetched block to the cache
-                self.blocks_in_cache[(p_tag,set_index)] = fetched_block
-                self.modules.usage.probe(delta_valid=st.Cache.line_size)
-
-                # handle potentially evicted block
-                evicted_block = self.sets[set_index].push_block(fetched_block)
-                tag_out = None if evicted_block is None else evicted_block.tag
-                self.modules.roundtrip.probe(access.time, set_index, p_tag,
-                                             tag_out)
+                append(miss_event)
+                if around:
+                    # WRITE AROUND
+                    continue
+                block = TagBlock(p_tag, thread=thread)
+                blocks_in_cache[key] = block
+                evicted_block = sets[set_index].push_block(block)
                 if evicted_block is not None:
                     # EVICTION
-                    del self.blocks_in_cache[(evicted_block.tag,set_index)]
-                    self.modules.usage.probe(
-                        delta_access=-evicted_block.count_accessed(),
-                        delta_valid=-st.Cache.line_size)
-                    if evicted_block.dirty:
-                        # WRITE DIRTY BLOCK
-                        self.modules.memaccess.probe('w') # write
-                    else:
-                        # DROP CLEAN BLOCK
-                        pass
-                resident_block = fetched_block
-            else:
-                # HIT
-                resident_block = self.blocks_in_cache[(p_tag,set_index)]
-                self.modules.missratio.probe(access, (1,0)) # hit++
-                self.sets[set_index].touch_block(resident_block)
+                    del blocks_in_cache[(evicted_block.tag,set_index)]
+        self.modules.commit_counts(common_time, events, 0, 0)
+        return
+
+    def __memory_accesses(self, concurrent_access, common_time):
+        """same as __hit_miss_accesses(), but also counting the main memory
+        reads and writes (e.g., CMMA is enabled), and forwarding them to the
+        next level as requests."""
+        events = []
+        append = events.append
+        reads = 0
+        writes = 0
+        forward = self.forward
+        write_back = self.write_back
+        write_allocate = self.write_allocate
+        blocks_in_cache = self.blocks_in_cache
+        sets = self.sets
+        line_events = self.line_events
+        fmt = self.fmt
+
+        for access in concurrent_access:
+            thread = access.thread
+            hit_event,miss_event = line_events[thread]
+            writing = (access.event == 'W')
+            dirtying = writing and write_back
+            # access the potentially many lines
+            for p_tag, set_index, _, n_bytes, addr in \
+                    line_fragments(access, fmt):
+                key = (p_tag,set_index)
+                block = blocks_in_cache.get(key)
+                if block is not None:
+                    # HIT
+                    append(hit_event)
+                    sets[set_index].touch_block(block)
+                    if dirtying:
+                        block.dirty = True
+                else:
+                    # MISS
+                    append(miss_event)
+                    if writing and not write_allocate:
+                        # WRITE AROUND
+                        writes += 1
+                        if forward:
+                            self.__request_bytes(access.time, thread, 'W',
+                                                 addr, n_bytes)
+                        continue
 
-            # mark accessed bytes
-            old_ab = resident_block.count_accessed()
-            resident_block.access(offset, this_block_n_bytes, write=writing)
-            new_ab = resident_block.count_accessed()
-            self.modules.usage.probe(delta_access=new_ab-old_ab)
+                    # fetch block from main memory
+                    block = TagBlock(p_tag, dirty=dirtying, thread=thread)
+                    reads += 1
+                    if forward:
+                        self.__request_block(access.time, thread, 'R',
+                                             p_tag, set_index)
+                    blocks_in_cache[key] = block
+                    evicted_block = sets[set_index].push_block(block)
+                    if evicted_block is not None:
+                        # EVICTION
+                        del blocks_in_cache[(evicted_block.tag,set_index)]
+                        if evicted_block.dirty:
+                            # WRITE DIRTY BLOCK
+                            writes += 1
+                            if forward:
+                                self.__request_block(access.time, thread,
+                                                     'W', evicted_block.tag,
+                                                     set_index)
 
-            # update address and reminding bytes to continue accessing memory
-            addr += this_block_n_bytes
-            n_bytes -= this_block_n_bytes
+                if writing and not write_back:
+                    # WRITE THROUGH
+                    writes += 1
+                    if forward:
+                        self.__request_bytes(access.time, thread, 'W', addr,
+                                             n_bytes)
+        self.modules.commit_counts(common_time, events, reads, writes)
         return
 
-    def __flush(self):
+    def repeated_hits(self, run):
+        """effect the repeats of a run whose first access was just effected,
+        committing the time of each. They hit the block that the first access
+        left as the most recently used one, so only the modules are probed:
+        the replacement policy is updated once (touching a block again right
+        away has no effect in any policy), and the line is never looked up.
+        Return False without effecting anything if the repeats are not plain
+        hits: the block is not in cache (a write without write-allocate), or
+        they write through."""
+        addr = run.addr - self.base_addr
+        p_tag, set_index, _ = self.split(addr)
+        block = self.blocks_in_cache.get((p_tag,set_index))
+        if block is None or self.owned_sets is not None or \
+           self.sample_stats is not None:
+            return False
+        if not self.write_back and any(r.event == 'W' for r in run.repeats):
+            return False
+        self.sets[set_index].touch_block(block)
+
+        modules = self.modules
+        observers = modules.access_observers
+        locality = modules.locality
+        missratio = modules.missratio
+        usage = modules.usage
+        base_addr = self.base_addr
+        offset_mask = self.max_offset
+        for access in run.repeats:
+            for observer in observers:
+                observer.probe(access=access)
+            addr = access.addr - base_addr
+            if locality is not None:
+                locality.probe(access.time, access.thread, access.event,
+                               access.size, addr)
+            if missratio is not None:
+                missratio.probe(access, (1,0)) # hit++
+            dirtying = access.event == 'W' and self.write_back
+            if usage is not None:
+                old_ab = block.count_accessed()
+                block.access(addr & offset_mask, access.size, write=dirtying)
+                usage.probe(delta_access=block.count_accessed()-old_ab)
+            elif dirtying:
+                block.dirty = True
+            modules.commit(access.time)
+        return True
+
+    def flush(self):
         """evict all cache lines"""
-        for set_idx in range(st.Cache.num_sets):
+        for set_idx in range(self.num_sets):
             s = self.sets[set_idx]
-            evicted_block = s.pop_lru_block()
+            evicted_block = s.pop_block()
             tag_out = None if evicted_block is None else evicted_block.tag
             while evicted_block is not None:
                 tag_out = evicted_block.tag
-                self.modules.roundtrip.probe(st.Map.time_size, set_idx, None,
-                                         tag_out)
+                if self.modules.roundtrip is not None:
+                    self.modules.roundtrip.probe(st.Map.time_size, set_idx,
+                                                 None, tag_out)
 
                 # It doesn't make much sense to register usage on flush
                 # self.modules.usage.probe(
@@ -199,9 +960,15 @@ class Cache:
 
 
                 if evicted_block.dirty:
-                    self.modules.memaccess.probe('w')
-                    pass #!
-                evicted_block = s.pop_lru_block() # get next evicted block
+                    if self.modules.memaccess is not None:
+                        self.modules.memaccess.probe('w')
+                    if self.sample_stats is not None:
+                        self.sample_stats.memory(set_idx)
+                    if self.forward:
+                        self.__request_block(st.Map.time_size-1,
+                                             evicted_block.thread, 'W',
+                                             tag_out, set_idx)
+                evicted_block = s.pop_block() # get next evicted block
         return
 
     def __repr__(self):
@@ -215,39 +982,721 @@ class Cache:
         ret += '+---------------------'
         return ret
 
-    def run_simulation(self, map_data_reader):
+    def finish(self):
+        """send a last commit to the modules and signal them that the
+        simulation has finished"""
+        self.modules.commit(st.Map.time_size-1)
+        self.modules.finalize()
+        return
+
+
+class SampleStats:
+    """Counters of accesses, misses and main memory accesses per sampling
+    unit: either a cache set (by_set) or the time window being measured
+    (self.unit). Used to extrapolate CMR and CMMA with confidence bounds."""
+    # z value of the confidence intervals
+    z = 1.96
+    confidence = 0.95
+
+    def __init__(self, by_set=False):
+        self.by_set = by_set
+        self.unit = None
+        # {unit -> [accesses, misses, main_memory_accesses]}
+        self.units = {}
+
+    def add_unit(self, unit):
+        if unit not in self.units:
+            self.units[unit] = [0, 0, 0]
+        return
+
+    def access(self, set_index, miss):
+        counters = self.units[set_index if self.by_set else self.unit]
+        counters[0] += 1
+        if miss:
+            counters[1] += 1
+        return
+
+    def memory(self, set_index):
+        self.units[set_index if self.by_set else self.unit][2] += 1
+        return
+
+    def __bounds(self, estimate, variance):
+        if variance is None:
+            return {'estimate': estimate, 'low': None, 'high': None}
+        margin = self.z * math.sqrt(max(variance, 0))
+        return {'estimate': estimate, 'low': estimate - margin,
+                'high': estimate + margin}
+
+    def estimates(self, population):
+        """Extrapolate the sampled units to a population of units. CMR is a
+        ratio estimator (misses/accesses over units) and CMMA the total
+        number of main memory accesses. Bounds use the normal approximation
+        with finite population correction, and need at least two units."""
+        n = len(self.units)
+        counters = list(self.units.values())
+        accesses = [c[0] for c in counters]
+        misses = [c[1] for c in counters]
+        mem_acc = [c[2] for c in counters]
+        fpc = max(0, 1 - n/population) if population > 0 else 0
+
+        # cache miss rate (percentage)
+        cmr = 100 * sum(misses) / sum(accesses) if sum(accesses) > 0 else 0
+        cmr_var = None
+        if n > 1 and sum(accesses) > 0:
+            mean_acc = sum(accesses) / n
+            residuals = [m - cmr/100*a for m,a in zip(misses, accesses)]
+            s2 = sum(r*r for r in residuals) / (n-1)
+            cmr_var = 100**2 * fpc * s2 / (n * mean_acc**2)
+
+        # cumulative main memory accesses (total)
+        cmma = population * sum(mem_acc) / n if n > 0 else 0
+        cmma_var = None
+        if n > 1:
+            mean_mem = sum(mem_acc) / n
+            s2 = sum((c-mean_mem)**2 for c in mem_acc) / (n-1)
+            cmma_var = population**2 * fpc * s2 / n
+
+        return {
+            'units': n,
+            'population': population,
+            'confidence': self.confidence,
+            'CMR': self.__bounds(cmr, cmr_var),
+            'CMMA': self.__bounds(cmma, cmma_var),
+        }
+
+
+def map_batches(map_data_reader, thread_group=None, events_done=0):
+    """group the map records in batches of concurrent accesses:
+    (time, accesses, number_of_records_read). If thread_group=(group,
+    threads_per_group) is given, only keep the accesses of the threads
+    in that group, but still yield (maybe empty) batches for all times.
+    events_done is the number of records already read by a previous run
+    (when resuming from a checkpoint)."""
+    eve_count = events_done
+    concurrent_acc = []
+    common_time = None
+    for record in map_data_reader:
+        # collect all accesses happening at the same time mark
+        if record.time != common_time:
+            if common_time is not None:
+                # send all accesses from time t-1
+                yield common_time, concurrent_acc, eve_count
+            concurrent_acc = []
+            common_time = record.time
+        eve_count += 1
+        if thread_group is None or \
+           record.thread // thread_group[1] == thread_group[0]:
+            concurrent_acc.append(record)
+
+    # send the remaining accesses to the cache
+    if common_time is not None:
+        yield common_time, concurrent_acc, eve_count
+    return
+
+
+def collapse_runs(batches, bits_off):
+    """pass the (time, accesses, progress) batches through, except that
+    consecutive batches of a single access, by the same thread and to the
+    same line (of 2**bits_off bytes) as the previous one, are collapsed into
+    the batch of the first access of the run, as a Run carrying the
+    following ones. The progress of a run is the one of its last batch."""
+    # first batch of the current run, its line, and the following accesses
+    head = None
+    head_line = None
+    repeats = []
+    done = 0
+    for common_time,concurrent_acc,batch_done in batches:
+        line = None
+        if len(concurrent_acc) == 1:
+            access = concurrent_acc[0]
+            line = access.addr >> bits_off
+            if (access.addr + access.size - 1) >> bits_off != line:
+                line = None
+        if head is not None:
+            if line == head_line and access.thread == head[1].thread:
+                repeats.append(access)
+                done = batch_done
+                continue
+            yield head[0], [Run(head[1], repeats) if repeats else head[1]], \
+                done
+            head = None
+        if line is not None:
+            head = (common_time, access)
+            head_line = line
+            repeats = []
+        else:
+            yield common_time, concurrent_acc, batch_done
+        done = batch_done
+    if head is not None:
+        yield head[0], [Run(head[1], repeats) if repeats else head[1]], done
+    return
+
+
+def line_fragments(access, fmt):
+    """the cache line fragments of an access in a cache level: a tuple
+    (tag, set index, offset, number of bytes, address) for each line it
+    touches, with the address relative to the aligned start of the map.
+    fmt holds the values of the level (see set_line_fragments()). Accesses
+    that went through split_lines() already carry them."""
+    if access.lines is not None:
+        return access.lines
+    bits_off, bits_set, base_addr, arch = fmt
+    addr = access.addr - base_addr
+    # check correct bit_length
+    if addr.bit_length() > arch:
+        raise ValueError(f'Error: Access issued to address '
+                         f'larger ({addr.bit_length()} bits) than '
+                         f'the architecture defined for this cache '
+                         f'({arch} bits).')
+    tag_shift = bits_set + bits_off
+    max_index = (1 << bits_set) - 1
+    line_size = 1 << bits_off
+    offset = addr & (line_size - 1)
+    if 0 < access.size <= line_size - offset:
+        return ((addr >> tag_shift, (addr >> bits_off) & max_index, offset,
+                 access.size, addr),)
+    fragments = []
+    end = addr + access.size
+    while addr < end:
+        offset = addr & (line_size - 1)
+        n_bytes = min(line_size - offset, end - addr)
+        fragments.append((addr >> tag_shift, (addr >> bits_off) & max_index,
+                          offset, n_bytes, addr))
+        addr += n_bytes
+    return fragments
+
+
+def set_line_fragments(accesses, fmt):
+    """compute the line fragments (see line_fragments()) of all the accesses
+    at once, and set them as their lines. fmt holds the values of the cache
+    level they are for: (bits_off, bits_set, aligned start address, arch).
+    Accesses beyond the architecture are left alone, so the cache reports
+    them when reached."""
+    if len(accesses) == 0:
+        return
+    bits_off, bits_set, base_addr, arch = fmt
+    n = len(accesses)
+    try:
+        addrs = np.fromiter((a.addr for a in accesses), dtype=np.int64,
+                            count=n) - base_addr
+    except OverflowError:
+        return
+    if int(addrs.max()).bit_length() > min(arch, 62):
+        return
+    ends = addrs + np.fromiter((a.size for a in accesses), dtype=np.int64,
+                               count=n)
+    first_line = addrs >> bits_off
+    num_lines = np.where(ends > addrs,
+                         ((ends - 1) >> bits_off) - first_line + 1, 0)
+
+    # one fragment per line, in order
+    single_line = bool(np.all(num_lines == 1))
+    if single_line:
+        lines = first_line
+        frag_addrs = addrs
+        frag_ends = ends
+    else:
+        acc_idx = np.repeat(np.arange(n), num_lines)
+        line_start = np.cumsum(num_lines) - num_lines
+        lines = first_line[acc_idx] + \
+            (np.arange(len(acc_idx)) - line_start[acc_idx])
+        frag_addrs = np.maximum(lines << bits_off, addrs[acc_idx])
+        frag_ends = np.minimum((lines + 1) << bits_off, ends[acc_idx])
+    fragments = zip((lines >> bits_set).tolist(),
+                    (lines & ((1 << bits_set) - 1)).tolist(),
+                    (frag_addrs & ((1 << bits_off) - 1)).tolist(),
+                    (frag_ends - frag_addrs).tolist(),
+                    frag_addrs.tolist())
+
+    if single_line:
+        for access,fragment in zip(accesses, fragments):
+            access.lines = (fragment,)
+        return
+    fragments = list(fragments)
+    start = 0
+    for access,count in zip(accesses, num_lines.tolist()):
+        access.lines = fragments[start:start+count]
+        start += count
+    return
+
+
+def split_lines(batches, chunk_size=4096):
+    """pass the (time, accesses, progress) batches through, setting the line
+    fragments of their accesses in the current level (see line_fragments()).
+    They are computed for chunks of batches at once, so the cache does not
+    decompose addresses access by access."""
+    # other levels may be selected while the batches are consumed (or they
+    # may be produced in another thread)
+    fmt = (st.Cache.bits_off, st.Cache.bits_set, st.Map.aligned_start_addr,
+           st.Cache.arch)
+
+    def split():
+        chunk = []
+        for batch in batches:
+            chunk.append(batch)
+            if len(chunk) == chunk_size:
+                set_line_fragments([a for _,acc,_ in chunk for a in acc],
+                                   fmt)
+                yield from chunk
+                chunk = []
+        set_line_fragments([a for _,acc,_ in chunk for a in acc], fmt)
+        yield from chunk
+        return
+    return split()
+
+
+def prefetch_batches(batches, buffer_size=1024, max_buffers=8):
+    """pass the (time, accesses, progress) batches through, producing them in
+    a separate thread, in buffers of buffer_size batches, at most
+    max_buffers ahead of the consumer. So reading and parsing the map
+    (while waiting for I/O or decompression) overlaps with the simulation.
+    Errors in the producer are raised to the consumer."""
+    buffers = queue.Queue(max_buffers)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer is gone
+        while not stop.is_set():
+            try:
+                buffers.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        return
+
+    def produce():
+        try:
+            buffer = []
+            for batch in batches:
+                buffer.append(batch)
+                if len(buffer) == buffer_size:
+                    put(buffer)
+                    buffer = []
+            put(buffer)
+            put(None)
+        except BaseException as e:
+            put(e)
+        return
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            buffer = buffers.get()
+            if buffer is None:
+                break
+            if isinstance(buffer, BaseException):
+                raise buffer
+            yield from buffer
+    finally:
+        # no thread outlives the simulation (e.g., when forking exporters)
+        stop.set()
+        producer.join()
+    return
+
+
+class BatchSpill:
+    """File of the (time, requests) batches that a job forwards to the next
+    cache level (e.g., the private levels of a thread group to the shared
+    ones), to be read back by another process as they are needed. Batches
+    are pickled in chunks of chunk_size, so neither the writer nor the
+    reader holds more than a chunk of them."""
+    chunk_size = 4096
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'wb')
+        self.chunk = []
+        # number of batches written
+        self.count = 0
+        return
+
+    def append(self, batch):
+        self.chunk.append(batch)
+        self.count += 1
+        if len(self.chunk) == self.chunk_size:
+            self.__dump()
+        return
+
+    def extend(self, batches):
+        for batch in batches:
+            self.append(batch)
+        return
+
+    def __dump(self):
+        pickle.dump(self.chunk, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.chunk = []
+        return
+
+    def close(self):
+        if self.chunk:
+            self.__dump()
+        self.file.close()
+        return
+
+    @staticmethod
+    def read(file_path):
+        """yield the batches of a spill file, in order, and remove it"""
+        with open(file_path, 'rb') as spill_file:
+            while True:
+                try:
+                    chunk = pickle.load(spill_file)
+                except EOFError:
+                    break
+                yield from chunk
+        os.remove(file_path)
+        return
+
+
+def simulate_set_shard(shard_args):
+    """Simulate the sets of a single-level cache such that
+    set_index % num_shards == shard, for shard_args = (map_pth, shard,
+    num_shards, probed_names). Return what the modules need from these sets
+    (see ShardProbes), or None if they cannot be simulated apart from the
+    others (see Cache.accesses_in_owned_sets())."""
+    map_pth, shard, num_shards, probed_names = shard_args
+    st.Cache.select_level(0)
+    owned_sets = [s % num_shards == shard for s in range(st.Cache.num_sets)]
+    probes = ShardProbes(probed_names)
+    cache = Cache(modules=probes, owned_sets=owned_sets)
+    for common_time,concurrent_acc,_ in \
+            split_lines(map_batches(MapDataReader(map_pth))):
+        if not cache.accesses_in_owned_sets(concurrent_acc, common_time):
+            return None
+    cache.flush()
+    cache.finish()
+    return probes.collected
+
+
+class CacheHierarchy:
+    """Chain of consecutive cache levels, starting at st.Cache.levels[
+    first_level]. The block fetches and write-backs of each level are the
+    accesses of the next one, so a single pass over the map simulates all
+    levels. Each level reports its metrics to its own modules manager.
+    If forward_last, the requests of the last level of the chain are
+    returned by the simulation, to be fed to a chain of farther levels."""
+    def __init__(self, managers, first_level=0, forward_last=False):
+        if first_level + len(managers) > len(st.Cache.levels):
+            raise ValueError('there are more modules managers than cache '
+                             'levels')
+        self.first_level = first_level
+        self.caches = []
+        last_idx = len(managers) - 1
+        for idx,modules in enumerate(managers):
+            st.Cache.select_level(first_level + idx)
+            self.caches.append(Cache(modules=modules,
+                                     forward=(idx < last_idx or forward_last)))
+        self.multilevel = len(st.Cache.levels) > 1
+        self.forward_last = forward_last
+        return
+
+    def __accesses(self, concurrent_access, common_time):
+        """effect the batch in the first level, and pass its requests down
+        to the next levels. Return the requests of the last level"""
+        for cache in self.caches:
+            cache.accesses(concurrent_access, common_time)
+            concurrent_access = cache.pop_requests()
+        return concurrent_access
+
+    def __repeats(self, run):
+        """effect the repeats of a run (see collapse_runs()) whose first
+        access was just effected. Return the (time, requests) of the last
+        level for each of them"""
+        if not self.caches[0].repeated_hits(run):
+            return [(r.time, self.__accesses([r], r.time))
+                    for r in run.repeats]
+        # hits issue no requests: the next levels only commit those times
+        for cache in self.caches[1:]:
+            for r in run.repeats:
+                cache.accesses([], r.time)
+        return [(r.time, []) for r in run.repeats]
+
+    def vectorizable(self):
+        """whether this is a single direct-mapped level whose simulation can
+        be vectorized (see DirectMappedSimulation)"""
+        if len(self.caches) != 1 or self.forward_last or \
+           st.Sampling.mode is not None or st.profile is not None:
+            return False
+        st.Cache.select_level(self.first_level)
+        return DirectMappedSimulation.supports(self.caches[0].modules)
+
+    def run_vectorized(self, records, show_progress=True):
+        """simulate the map records (in order) in one vectorized pass, if
+        possible (see vectorizable()). Return whether it was done"""
+        if not self.vectorizable():
+            return False
+        simulation = DirectMappedSimulation(self.caches[0].modules)
+        if simulation.run(records, show_progress):
+            return True
+        if show_progress:
+            UI.info('The direct-mapped cache cannot be simulated in one '
+                    'pass (e.g., concurrent accesses to the same set): '
+                    'simulating it access by access.', pre='')
+        return False
+
+    def run_simulation(self, map_data_reader, thread_group=None,
+                       show_progress=True, checkpoint=None, events_done=0,
+                       forwarded=None):
         """Run the simulation sending concurrent accesses to the cache
         in batches. At the end, flush the cache and send a last commit
-        to the cache."""
+        to the cache. If a checkpoint is given, snapshots of the simulation
+        are periodically saved to it. When resuming from one, the reader
+        starts at the saved offset, and events_done is the number of events
+        simulated before it. If forwarding the last level, its requests are
+        given to forwarded (see simulate_batches())."""
         # check cache alignment of the allocated memory
+        st.Cache.select_level(self.first_level)
         _,_,byte = st.AddrFmt.split(st.Map.start_addr)
-        if byte != 0:
+        if byte != 0 and show_progress:
             UI.info(f'Allocated memory is not cache aligned, first '
                     f'address is {byte} bytes into a cache line.')
 
-        # send batches with concurrent accesses to the cache.
-        tot_eve = st.Map.event_count
-        eve_count = -1
-        concurrent_acc = []
-        for record in map_data_reader:
-            eve_count += 1
-            # collect all accesses happening at the same time mark
-            if len(concurrent_acc) == 0 or concurrent_acc[-1].time == record.time:
-                concurrent_acc.append(record)
-                continue
-            self.__accesses(concurrent_acc) # send all accesses from time t-1
-            UI.progress(eve_count, tot_eve)
-            concurrent_acc = [record] # save first access of time t
+        if st.Sampling.mode is not None:
+            return self.__run_sampled(map_data_reader)
 
-        # send the remaining accesses to the cache
-        eve_count += 1
-        self.__accesses(concurrent_acc)
-        UI.progress(eve_count, tot_eve)
+        # the vectorized pass rebuilds the state of the modules from the
+        # whole map, so it cannot continue a resumed simulation
+        if checkpoint is None and thread_group is None and \
+           events_done == 0 and map_data_reader.start_offset is None and \
+           self.vectorizable():
+            if self.run_vectorized(map_data_reader, show_progress):
+                return None
+            map_data_reader = MapDataReader(
+                map_data_reader.file_path,
+                start_offset=map_data_reader.start_offset)
+
+        if checkpoint is not None:
+            map_data_reader.track_offsets = True
+        batches = map_batches(map_data_reader, thread_group, events_done)
+        # runs and lines are read ahead, so the reader is not at the next
+        # batch
+        if checkpoint is None:
+            if st.collapse_runs:
+                batches = collapse_runs(batches, st.Cache.bits_off)
+            batches = split_lines(batches)
+            if st.pipeline:
+                batches = prefetch_batches(batches)
+        return self.simulate_batches(batches, st.Map.event_count,
+                                     show_progress=show_progress,
+                                     checkpoint=checkpoint,
+                                     reader=map_data_reader,
+                                     forwarded=forwarded)
+
+    def __run_sampled(self, map_data_reader):
+        """Run the simulation of a single-level cache on a sample of the
+        trace: either only some sets, or only some time windows (preceded
+        by warm-up windows, in which the cache is updated but the modules are
+        not probed). The estimates are left in st.Sampling.estimates."""
+        if len(self.caches) != 1 or self.forward_last:
+            raise ValueError('only a single, last-level cache can be '
+                             'sampled')
+        cache = self.caches[0]
+        modules = cache.modules
+        sampled_sets = st.Sampling.mode == 'sets'
+        stats = SampleStats(by_set=sampled_sets)
+        cache.sample_stats = stats
+        if sampled_sets:
+            cache.owned_sets = [st.Sampling.is_sampled_set(s)
+                                for s in range(st.Cache.num_sets)]
+            for set_idx,owned in enumerate(cache.owned_sets):
+                if owned:
+                    stats.add_unit(set_idx)
+            population = st.Cache.num_sets
+        else:
+            population = st.Sampling.num_slots(st.Map.time_size)
+        # during warm-up only the modules that track the cache contents see
+        # the fills and evictions; the rest measure events and are silenced.
+        warmup_sink = ProbeSink()
+        for name in ('usage', 'roundtrip'):
+            setattr(warmup_sink, name, getattr(modules, name))
+
+        batches = split_lines(map_batches(map_data_reader))
+        if st.pipeline:
+            batches = prefetch_batches(batches)
+        for common_time,concurrent_acc,done in batches:
+            phase = 'measure' if sampled_sets else \
+                st.Sampling.time_phase(common_time)
+            if phase == 'measure':
+                if not sampled_sets:
+                    stats.unit = st.Sampling.window(common_time)
+                    stats.add_unit(stats.unit)
+                cache.accesses(concurrent_acc, common_time)
+            else:
+                if phase == 'warmup':
+                    cache.modules = warmup_sink
+                    cache.sample_stats = None
+                    cache.accesses(concurrent_acc, common_time)
+                    cache.modules = modules
+                    cache.sample_stats = stats
+                # modules keep their time series going
+                modules.commit(common_time)
+            UI.progress(done, st.Map.event_count)
         UI.nl()
-        # flush cache and commit for modules that care about eviction
-        self.__flush()
-        self.modules.commit(st.Map.time_size-1)
 
-        # signal to all modules that the simulation has finished
-        self.modules.finalize()
+        # the final write-backs do not belong to any measured time window
+        if not sampled_sets:
+            cache.sample_stats = None
+        cache.flush()
+        cache.finish()
+        st.Sampling.estimates = stats.estimates(population)
+        return None
+
+    def simulate_batches(self, batches, total, show_progress=True,
+                         checkpoint=None, reader=None, forwarded=None):
+        """Simulate (time, accesses, progress) batches, then flush the caches
+        and signal the end of the simulation. If forwarding the last level,
+        return its requests as (time, requests) batches, appended to
+        forwarded (a list by default, or e.g. a BatchSpill). If a checkpoint
+        is given, it saves the simulation state and the position of the
+        reader the batches come from."""
+        if forwarded is None:
+            forwarded = []
+        for common_time,concurrent_acc,done in batches:
+            requests = self.__accesses(concurrent_acc, common_time)
+            if self.forward_last:
+                forwarded.append((common_time, requests))
+            if len(concurrent_acc) == 1 and isinstance(concurrent_acc[0], Run):
+                repeats = self.__repeats(concurrent_acc[0])
+                if self.forward_last:
+                    forwarded.extend(repeats)
+            if checkpoint is not None:
+                checkpoint.maybe_save(self, reader, done, common_time)
+            if show_progress:
+                UI.progress(done, total)
+        if show_progress:
+            UI.nl()
+
+        # flush caches (the write-backs of one level go to the next one) and
+        # commit for modules that care about eviction. Then signal to all
+        # modules that the simulation has finished. The modules finalize with
+        # the settings of their level selected.
+        for idx,cache in enumerate(self.caches):
+            if self.multilevel:
+                st.Cache.select_level(self.first_level + idx)
+            if idx > 0:
+                write_backs = self.caches[idx-1].pop_requests()
+                if len(write_backs) > 0:
+                    cache.accesses(write_backs, st.Map.time_size-1)
+            cache.flush()
+            cache.finish()
+        if not self.forward_last:
+            return None
+        forwarded.append((st.Map.time_size-1, self.caches[-1].pop_requests()))
+        return forwarded
+
+    def run_set_partitioned(self, map_pth, num_jobs, show_progress=True):
+        """Run the simulation of a single-level cache splitting its sets
+        among parallel jobs. Sets are independent, so each job simulates the
+        accesses to its own sets, and sends back counters per time step and
+        the events whose order matters (see ShardProbes). These are merged
+        as the jobs finish, and then given to the modules. If concurrent
+        accesses straddle lines of sets of different jobs, their order
+        cannot be kept, and the cache is simulated in a single job."""
+        if len(self.caches) != 1 or self.forward_last:
+            raise ValueError('only a single, last-level cache can be '
+                             'partitioned by sets')
+        st.Cache.select_level(self.first_level)
+        num_shards = min(num_jobs, st.Cache.num_sets)
+        if show_progress:
+            UI.info(f'Simulating {st.Cache.num_sets} sets using {num_shards} '
+                    'jobs.', pre='')
+        probed_names = self.caches[0].modules.probed_names()
+        shards_args = [(map_pth, s, num_shards, probed_names)
+                       for s in range(num_shards)]
+        collected = None
+        partitioned = True
+        with multiprocessing.get_context('fork').Pool(num_shards) as pool:
+            for shard_collected in pool.imap(simulate_set_shard,
+                                             shards_args):
+                if shard_collected is None:
+                    partitioned = False
+                    break
+                if collected is None:
+                    collected = shard_collected
+                else:
+                    ShardProbes.merge(collected, shard_collected)
+        if not partitioned:
+            if show_progress:
+                UI.info('Concurrent accesses straddle lines of sets of '
+                        'different jobs: simulating all sets in a single '
+                        'job.', pre='')
+            self.run_simulation(MapDataReader(map_pth),
+                                show_progress=show_progress)
+            return
+        self.__replay_shards(map_pth, collected, show_progress)
+        return
+
+    def __replay_shards(self, map_pth, collected, show_progress):
+        """give the merged collections of the jobs of run_set_partitioned()
+        to the modules, committing each time step. The map and locality
+        modules see every access, so they are probed here, in a pass over
+        the map."""
+        cache = self.caches[0]
+        modules = cache.modules
+        usage = modules.usage
+        aliasing = modules.aliasing
+        observers = modules.access_observers
+        locality = modules.locality
+        batches = None
+        if observers or locality is not None:
+            batches = split_lines(map_batches(MapDataReader(map_pth)))
+        ranks = collected['ranks']
+
+        # fills and evictions only depend on the order within each set (and
+        # the roundtrip module does nothing on commit)
+        if modules.roundtrip is not None:
+            for time,set_idx,tag_in,tag_out in collected['fills_evictions']:
+                modules.roundtrip.probe(time, set_idx, tag_in, tag_out)
+
+        hits_misses = sorted(collected['hits_misses'])
+        fetches = sorted(collected['fetches'])
+        reads = collected['reads'].tolist()
+        writes = collected['writes'].tolist()
+        accessed = collected['accessed'].tolist()
+        valid = collected['valid'].tolist()
+        times = collected['times']
+        hm_idx = 0
+        fetch_idx = 0
+        # the last commit is the one after the flush (see Cache.finish())
+        total = len(times)
+        for step,time in enumerate(times):
+            if batches is not None and step < total-1:
+                _,concurrent_acc,_ = next(batches)
+                if len(concurrent_acc) > 1:
+                    # resident first lines first (see Cache.accesses())
+                    priority = []
+                    rest = []
+                    for i,a in enumerate(concurrent_acc):
+                        if ranks[(step,i)][0] == 0:
+                            priority.append(a)
+                        else:
+                            rest.append(a)
+                    concurrent_acc = priority+rest
+                for access in concurrent_acc:
+                    for observer in observers:
+                        observer.probe(access=access)
+                    if locality is not None:
+                        for _,_,_,n_bytes,addr in \
+                                line_fragments(access, cache.fmt):
+                            locality.probe(access.time, access.thread,
+                                           access.event, n_bytes, addr)
+            events = []
+            while hm_idx < len(hits_misses) and \
+                  hits_misses[hm_idx][0] == step:
+                events.append(hits_misses[hm_idx][2:])
+                hm_idx += 1
+            if aliasing is not None:
+                while fetch_idx < len(fetches) and \
+                      fetches[fetch_idx][0] == step:
+                    aliasing.probe(fetches[fetch_idx][2], time)
+                    fetch_idx += 1
+            if usage is not None:
+                usage.probe(delta_access=accessed[step],
+                            delta_valid=valid[step])
+            modules.commit_counts(time, events, reads[step], writes[step])
+            if show_progress:
+                UI.progress(step+1, total)
+        if show_progress:
+            UI.nl()
+        modules.finalize()
         return
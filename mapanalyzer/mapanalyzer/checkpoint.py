@@ -0,0 +1,109 @@
+import os, pickle, time, zlib
+from .settings import Settings as st
+from .ui import UI
+
+class Checkpoint:
+    """Periodic snapshots of a running simulation: the cache hierarchy
+    (cache contents and modules state) and the offset of the map reader.
+    The snapshot of a map is stored in the working directory as
+    <map ID>.checkpoint, and is overwritten atomically by every new one, so
+    an interrupted run can be resumed from the last complete snapshot.
+
+    The modules preallocate their per-time arrays for the whole trace, so
+    snapshots keep a constant size: they are pickled and compressed rather
+    than stored as differences between snapshots."""
+    # bump when the content of the snapshots changes
+    format_version = 5
+    ext = 'checkpoint'
+
+    def __init__(self, map_pth, interval):
+        self.map_pth = map_pth
+        # seconds between snapshots (None: only resume, saving nothing)
+        self.interval = interval
+        self.file_path = f'{st.Map.ID}.{self.ext}'
+        self.last_save = time.monotonic()
+        return
+
+    def fingerprint(self):
+        """identify the simulation: a checkpoint can only be resumed by the
+        same map, cache and metrics. The bg metric is computed as well, so
+        it is part of it."""
+        map_stat = os.stat(self.map_pth)
+        computed = set(st.Metrics.enabled)
+        if st.Metrics.bg is not None:
+            computed.add(st.Metrics.bg)
+        fingerprint = {
+            'version': self.format_version,
+            'map': (os.path.abspath(self.map_pth), map_stat.st_size,
+                    map_stat.st_mtime_ns),
+            'cache': st.Cache.levels,
+            'metrics': (sorted(computed), sorted(st.Metrics.streaming)),
+        }
+        # MAP samples the accesses into a matrix of the plot resolution
+        if 'MAP' in computed:
+            fingerprint['map_res'] = st.Plot.map_res
+        return fingerprint
+
+    def maybe_save(self, hierarchy, reader, done, common_time):
+        """save a snapshot if the interval has elapsed since the last one.
+        Must be called once the batch of common_time has been simulated.
+        Without interval (only resuming), no snapshot is saved."""
+        if self.interval is None or \
+           time.monotonic() - self.last_save < self.interval:
+            return
+        # at the end of the map there is nothing left to resume
+        if reader.file.closed:
+            return
+        self.save(hierarchy, reader.record_offset, done, common_time)
+        self.last_save = time.monotonic()
+        return
+
+    def save(self, hierarchy, offset, done, common_time):
+        state = {
+            'fingerprint': self.fingerprint(),
+            'offset': offset,
+            'done': done,
+            'time': common_time,
+            'hierarchy': hierarchy,
+        }
+        data = zlib.compress(pickle.dumps(state,
+                                          protocol=pickle.HIGHEST_PROTOCOL))
+        # write aside and replace, so that a crash while writing does not
+        # destroy the previous snapshot.
+        tmp_path = f'{self.file_path}.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.file_path)
+        return
+
+    def load(self):
+        """return the saved state of this simulation, or None if there is
+        no usable checkpoint"""
+        if not os.path.isfile(self.file_path):
+            UI.info(f'No checkpoint "{self.file_path}" found. Starting from '
+                    'the beginning.', pre='')
+            return None
+        try:
+            with open(self.file_path, 'rb') as ckpt_file:
+                state = pickle.loads(zlib.decompress(ckpt_file.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError) as e:
+            UI.warning(f'Could not read checkpoint "{self.file_path}" ({e}). '
+                       'Starting from the beginning.')
+            return None
+        if state.get('fingerprint') != self.fingerprint():
+            UI.warning(f'Checkpoint "{self.file_path}" belongs to a different '
+                       'map, cache or metrics configuration. Starting from '
+                       'the beginning.')
+            return None
+        UI.info(f'Resuming from checkpoint "{self.file_path}" (time '
+                f'{state["time"]}, {state["done"]}/{st.Map.event_count} '
+                'events).', pre='')
+        return state
+
+    def remove(self):
+        """remove the snapshot once the results have been exported"""
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+        return
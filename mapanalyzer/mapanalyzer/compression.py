@@ -0,0 +1,121 @@
+import bz2, gzip, io, lzma, os, queue, threading
+from .ui import UI
+
+# compression formats: (magic bytes, file extensions, opener)
+formats = {
+    'gzip': (b'\x1f\x8b', ('.gz', '.gzip'), gzip.open),
+    'xz': (b'\xfd7zXZ\x00', ('.xz', '.lzma'), lzma.open),
+    'bz2': (b'BZh', ('.bz2',), bz2.open),
+}
+
+def compression_of(file_path):
+    """the compression format of a file (by its first bytes, or else by its
+    extension), or None if it is not compressed"""
+    try:
+        with open(file_path, 'rb') as raw_file:
+            head = raw_file.read(8)
+    except OSError:
+        head = b''
+    for name,(magic,_,_) in formats.items():
+        if head.startswith(magic):
+            return name
+    ext = os.path.splitext(file_path)[1].lower()
+    for name,(_,extensions,_) in formats.items():
+        if ext in extensions:
+            return name
+    return None
+
+def strip_compression_ext(file_path):
+    """the file path without the extension of its compression format"""
+    root,ext = os.path.splitext(file_path)
+    if any(ext.lower() in exts for _,exts,_ in formats.values()):
+        return root
+    return file_path
+
+def open_map_file(file_path, binary=False):
+    """open a (maybe compressed) map file for reading. Compressed files are
+    decompressed as a stream (see DecompressionStream), so they can only be
+    read forward."""
+    compression = compression_of(file_path)
+    if compression is None:
+        return open(file_path, 'rb' if binary else 'r')
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError(file_path)
+    stream = io.BufferedReader(DecompressionStream(file_path, compression),
+                               buffer_size=1 << 16)
+    return stream if binary else io.TextIOWrapper(stream)
+
+
+class DecompressionStream(io.RawIOBase):
+    """The decompressed content of a file, produced by a separate thread (from
+    the first read on) in blocks, through a bounded queue. Decompression
+    releases the GIL, so it overlaps with the parsing and simulation of the
+    previous blocks."""
+    block_size = 1 << 20
+    queue_blocks = 8
+
+    def __init__(self, file_path, compression):
+        super().__init__()
+        self.file_path = file_path
+        self.opener = formats[compression][2]
+        self.blocks = queue.Queue(self.queue_blocks)
+        self.stop = threading.Event()
+        self.thread = None
+        self.block = memoryview(b'')
+        self.pos = 0
+        self.eof = False
+        return
+
+    def readable(self):
+        return True
+
+    def __decompress(self):
+        try:
+            with self.opener(self.file_path, 'rb') as comp_file:
+                while not self.stop.is_set():
+                    block = comp_file.read(self.block_size)
+                    if not block:
+                        break
+                    self.__put(block)
+        except Exception as e:
+            self.__put(e)
+        self.__put(None)
+        return
+
+    def __put(self, item):
+        # give up if the stream is closed (and nobody reads anymore)
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        return
+
+    def readinto(self, buffer):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__decompress,
+                                           daemon=True)
+            self.thread.start()
+        while self.pos == len(self.block):
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if item is None:
+                self.eof = True
+                return 0
+            if isinstance(item, Exception):
+                UI.error(f'While decompressing "{self.file_path}":\n{item}')
+            self.block = memoryview(item)
+            self.pos = 0
+        n = min(len(buffer), len(self.block) - self.pos)
+        buffer[:n] = self.block[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        super().close()
+        return
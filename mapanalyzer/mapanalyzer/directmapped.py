@@ -0,0 +1,335 @@
+from collections import deque
+import numpy as np
+
+from .settings import Settings as st
+from .ui import UI
+
+class DirectMappedSimulation:
+    """Simulation of a single direct-mapped cache level in one vectorized
+    pass, with the same results as simulating it access by access (see
+    Cache). In a direct-mapped cache, each set holds the block of the last
+    line that was brought to it, so an access hits if the previous
+    allocating access to its set had the same tag. Grouping the line
+    accesses by set (stable, keeping their order) and comparing each one to
+    the previous allocating one in its group gives all hits, fetches and
+    evictions at once.
+
+    CMR and CMMA are computed from these arrays. The modules of AD and
+    BPA/SMRI/MRID are only probed by fetches, which are replayed to them.
+    Other modules need every access, so they are not supported.
+
+    Within a batch of concurrent accesses, the cache effects the ones to
+    resident blocks first. That order matters only if several accesses of
+    the batch map to the same set: in that case the simulation is not
+    vectorized (run() returns False, as soon as the chunk of records with
+    such a batch is read)."""
+    supported_modules = ('missratio', 'memaccess', 'aliasing', 'roundtrip')
+    # number of records read and checked at once
+    chunk_size = 1 << 16
+
+    def __init__(self, modules):
+        self.modules = modules
+        self.write_back = st.Cache.write_policy == 'write-back'
+        self.write_allocate = st.Cache.write_allocate != 0
+        return
+
+    @classmethod
+    def supports(cls, modules):
+        """whether the current cache level is direct-mapped, and all the
+        modules can be fed by this simulation"""
+        if st.Cache.asso != 1 or modules.access_observers:
+            return False
+        return all(getattr(modules, name) is None
+                   for name in modules.module_names
+                   if name not in cls.supported_modules)
+
+    def run(self, records, show_progress=True):
+        """simulate the map records (e.g., a MapDataReader), flush the cache
+        and finalize the modules. Return False (with the modules untouched)
+        if the map cannot be simulated in one pass (see __read())"""
+        columns = self.__read(records, show_progress)
+        if columns is None:
+            return False
+        times, threads, writes, sizes, addrs = columns
+        if len(times) == 0:
+            return False
+
+        # batches of concurrent accesses: (first access, time)
+        batch_start = np.flatnonzero(np.diff(times, prepend=times[0]-1))
+
+        # split the accesses into line accesses, in order
+        acc_idx, sets, tags = self.__line_accesses(sizes, addrs)
+        writing = writes[acc_idx]
+
+        events = self.__line_events(sets, tags, writing)
+        self.__commit_series(events, times, threads, acc_idx, batch_start)
+        self.__replay_fetches(events, times, acc_idx, sets, tags)
+
+        self.modules.commit(st.Map.time_size-1)
+        self.modules.finalize()
+        return True
+
+    @staticmethod
+    def __group_ids(n, group_first):
+        """group of each of n positions, given the first one of each group"""
+        starts = np.zeros(n, dtype=np.int64)
+        starts[group_first] = 1
+        return np.cumsum(starts) - 1
+
+    @staticmethod
+    def __line_accesses(sizes, addrs):
+        """the access, set and tag of each line access, in order"""
+        first_line = addrs >> st.Cache.bits_off
+        last_line = (addrs + sizes - 1) >> st.Cache.bits_off
+        num_lines = last_line - first_line + 1
+        acc_idx = np.repeat(np.arange(len(addrs)), num_lines)
+        line_start = np.cumsum(num_lines) - num_lines
+        lines = first_line[acc_idx] + \
+            (np.arange(len(acc_idx)) - line_start[acc_idx])
+        return (acc_idx, lines & (st.Cache.num_sets - 1),
+                lines >> st.Cache.bits_set)
+
+    def __same_set_batches(self, times, sizes, addrs):
+        """whether different accesses of a batch of concurrent accesses map
+        to the same set"""
+        batch_start = np.flatnonzero(np.diff(times, prepend=times[0]-1))
+        acc_idx, sets, _ = self.__line_accesses(sizes, addrs)
+        batch = self.__group_ids(len(times), batch_start)[acc_idx]
+        batch_sets = batch * st.Cache.num_sets + sets
+        order = np.lexsort((acc_idx, batch_sets))
+        same = batch_sets[order][1:] == batch_sets[order][:-1]
+        return bool(np.any(same & (acc_idx[order][1:] !=
+                                   acc_idx[order][:-1])))
+
+    def __read(self, records, show_progress):
+        """read the records into int64 columns (time, thread, write, size,
+        address), chunk by chunk. Return None as soon as a chunk shows that
+        the map cannot be simulated in one pass: concurrent accesses to the
+        same set, times going back, or addresses that do not fit in 64 bits
+        (the cache reports them when reached)."""
+        chunks = []
+        # the last batch of the previous chunk, which may continue in this
+        # one
+        last_batch = None
+        done = 0
+        for chunk in self.__record_chunks(records):
+            try:
+                columns = [np.array([r.time for r in chunk], dtype=np.int64),
+                           np.array([r.thread for r in chunk],
+                                    dtype=np.int64),
+                           np.array([r.event == 'W' for r in chunk],
+                                    dtype=bool),
+                           np.array([r.size for r in chunk], dtype=np.int64),
+                           np.array([r.addr for r in chunk], dtype=np.int64)
+                           - st.Map.aligned_start_addr]
+            except OverflowError:
+                columns = None
+            if columns is not None:
+                max_addr = int(columns[4].max())
+                if max_addr.bit_length() > st.Cache.arch:
+                    raise ValueError(f'Error: Access issued to address '
+                                     f'larger ({max_addr.bit_length()} '
+                                     'bits) than the architecture defined '
+                                     f'for this cache ({st.Cache.arch} '
+                                     'bits).')
+                checked = columns
+                if last_batch is not None:
+                    checked = [np.concatenate(c)
+                               for c in zip(last_batch, columns)]
+                times, _, _, sizes, addrs = checked
+                if np.any(np.diff(times) < 0) or \
+                   self.__same_set_batches(times, sizes, addrs):
+                    columns = None
+            if columns is None:
+                if show_progress:
+                    UI.nl()
+                return None
+            chunks.append(columns)
+            start = np.searchsorted(columns[0], columns[0][-1])
+            last_batch = [c[start:] for c in columns]
+            done += len(chunk)
+            if show_progress:
+                UI.progress(done, st.Map.event_count)
+        if show_progress:
+            UI.progress(done, st.Map.event_count)
+            UI.nl()
+        if not chunks:
+            return [np.zeros(0, dtype=np.int64) for _ in range(5)]
+        return [np.concatenate(column) for column in zip(*chunks)]
+
+    @classmethod
+    def __record_chunks(cls, records):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == cls.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    def __line_events(self, sets, tags, writing):
+        """hits, fetches, evictions and main memory accesses of the line
+        accesses, in their (sequential) order"""
+        n = len(sets)
+        allocating = ~writing if not self.write_allocate else \
+            np.ones(n, dtype=bool)
+
+        # group by set, keeping the order of the accesses
+        order = np.argsort(sets, kind='stable')
+        g_sets = sets[order]
+        g_tags = tags[order]
+        pos = np.arange(n)
+        group_first = np.flatnonzero(np.diff(g_sets, prepend=-1))
+        group_start = group_first[self.__group_ids(n, group_first)]
+
+        # block in the set before each access: the one brought by the last
+        # allocating access. A write that misses without write-allocate
+        # does not bring it, and a write that hits already had it.
+        last_alloc = np.maximum.accumulate(
+            np.where(allocating[order], pos, -1))
+        prev_alloc = np.concatenate(([-1], last_alloc[:-1]))
+        valid = prev_alloc >= group_start
+        resident = np.where(valid, g_tags[np.maximum(prev_alloc, 0)], -1)
+        g_hit = valid & (resident == g_tags)
+        g_fetch = ~g_hit & allocating[order]
+        g_evict = g_fetch & valid
+
+        # writes around the cache (misses without write-allocate), and
+        # through it. The others dirty the block in cache.
+        g_writing = writing[order]
+        g_around = g_writing & ~g_hit & ~allocating[order]
+        g_through = g_writing & ~g_around & (not self.write_back)
+        g_dirtying = g_writing & ~g_around & self.write_back
+
+        # a block is written back when evicted if it was dirtied since it
+        # was fetched: all non-around accesses in between are to it.
+        dirtied = np.concatenate(([0], np.cumsum(g_dirtying)))
+        last_fetch = np.maximum.accumulate(np.where(g_fetch, pos, -1))
+        prev_fetch = np.concatenate(([-1], last_fetch[:-1]))
+        g_write_back = g_evict & \
+            (dirtied[pos] - dirtied[np.maximum(prev_fetch, 0)] > 0)
+
+        # blocks left in cache, flushed at the end
+        group_last = np.concatenate((group_first[1:], [n])) - 1
+        flush_fetch = last_fetch[group_last]
+        flushed = flush_fetch >= group_first
+        flush_sets = g_sets[group_last][flushed]
+        flush_tags = g_tags[flush_fetch[flushed]]
+        flush_dirty = (dirtied[group_last[flushed]+1] -
+                       dirtied[flush_fetch[flushed]]) > 0
+
+        # back to sequential order
+        def ungroup(values):
+            out = np.empty_like(values)
+            out[order] = values
+            return out
+        return {
+            'hit': ungroup(g_hit),
+            'fetch': ungroup(g_fetch),
+            'evicted': ungroup(np.where(g_evict, resident, -1)),
+            'reads': ungroup(g_fetch).astype(np.int64),
+            'writes': ungroup(g_around | g_through | g_write_back
+                              ).astype(np.int64),
+            'flush_sets': flush_sets,
+            'flush_tags': flush_tags,
+            'flush_writes': int(np.count_nonzero(flush_dirty)),
+        }
+
+    def __commit_series(self, events, times, threads, acc_idx, batch_start):
+        """fill the time series of CMR and CMMA as committed after each
+        batch (and after the flush, at the last time)"""
+        time_size = st.Map.time_size
+        batch_times = times[batch_start]
+        # number of line accesses done by the end of each batch
+        batch_end = np.searchsorted(acc_idx, np.append(batch_start[1:],
+                                                       len(times)))
+        # the batch committed last at each time, if any
+        last_batch = np.searchsorted(batch_times, np.arange(time_size),
+                                     side='right') - 1
+
+        memaccess = self.modules.memaccess
+        if memaccess is not None:
+            for name,counts,extra in (('read', events['reads'], 0),
+                                      ('write', events['writes'],
+                                       events['flush_writes'])):
+                done = np.concatenate(([0], np.cumsum(counts)))
+                series = np.where(last_batch >= 0,
+                                  done[batch_end[np.maximum(last_batch, 0)]],
+                                  0)
+                total = int(done[-1]) + extra
+                series[-1] = total
+                setattr(memaccess, name, total)
+                setattr(memaccess, f'{name}_dist', series.tolist())
+            memaccess.last_time = time_size - 1
+
+        missratio = self.modules.missratio
+        if missratio is not None:
+            self.__commit_miss_ratio(missratio, events['hit'],
+                                     threads[acc_idx], batch_times, batch_end)
+        return
+
+    def __commit_miss_ratio(self, missratio, hit, line_threads, batch_times,
+                            batch_end):
+        """per thread, the ratio of misses among its line accesses in the
+        window of the last cache_size line accesses, at each commit"""
+        from .Modules.module_missratio import ThreadMissRatio
+        time_size = st.Map.time_size
+        window = missratio.time_window_size
+        # the finish commit, at the last time
+        commit_times = np.append(batch_times, time_size-1)
+        commit_end = np.append(batch_end, len(hit))
+        window_start = np.maximum(commit_end - window, 0)
+        thread_ids, first = np.unique(line_threads, return_index=True)
+        missratio.thread_miss_ratio = {}
+        for i in np.argsort(first):
+            thread = thread_ids[i]
+            mine = line_threads == thread
+            hits = np.concatenate(([0], np.cumsum(mine & hit)))
+            misses = np.concatenate(([0], np.cumsum(mine & ~hit)))
+            h = hits[commit_end] - hits[window_start]
+            m = misses[commit_end] - misses[window_start]
+            # registered at its first access. Unset values stay integer 0,
+            # computed ones are float.
+            known = commit_end > first[i]
+            ratio = np.zeros(time_size, dtype=object)
+            counted = known & (h + m > 0)
+            ratio[commit_times[counted]] = \
+                (100 * m[counted] / (h[counted] + m[counted])).tolist()
+            ratio[commit_times[known & (h + m == 0)]] = 0
+            tmr = ThreadMissRatio.from_list(ratio.tolist())
+            tmr.hit_count = int(h[-1])
+            tmr.miss_count = int(m[-1])
+            missratio.thread_miss_ratio[int(thread)] = tmr
+        missratio.time_window = deque(
+            (int(t), (1,0) if h else (0,1))
+            for t,h in zip(line_threads[-window:], hit[-window:]))
+        return
+
+    def __replay_fetches(self, events, times, acc_idx, sets, tags):
+        """probe the modules that only see fetches, evictions and flushes,
+        committing the time of each fetch"""
+        aliasing = self.modules.aliasing
+        roundtrip = self.modules.roundtrip
+        if aliasing is None and roundtrip is None:
+            return
+        fetched = np.flatnonzero(events['fetch'])
+        fetch_times = times[acc_idx[fetched]].tolist()
+        fetch_sets = sets[fetched].tolist()
+        fetch_tags = tags[fetched].tolist()
+        evicted = events['evicted'][fetched].tolist()
+        for i,time in enumerate(fetch_times):
+            set_index = fetch_sets[i]
+            if aliasing is not None:
+                aliasing.probe(set_index, time)
+                if i+1 == len(fetch_times) or fetch_times[i+1] != time:
+                    aliasing.commit(time)
+            if roundtrip is not None:
+                tag_out = evicted[i] if evicted[i] >= 0 else None
+                roundtrip.probe(time, set_index, fetch_tags[i], tag_out)
+        if roundtrip is not None:
+            for set_index,tag in zip(events['flush_sets'].tolist(),
+                                     events['flush_tags'].tolist()):
+                roundtrip.probe(st.Map.time_size, set_index, None, tag)
+        return
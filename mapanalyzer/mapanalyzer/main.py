@@ -1,10 +1,15 @@
 #!/usr/bin/python3
-import runpy, sys
+import json, multiprocessing, os, runpy, sys, tempfile
+from time import perf_counter
 from .settings import Settings as st
-from .cache import Cache
+from .cache import BatchSpill, CacheHierarchy, map_batches
+from .checkpoint import Checkpoint
+from .compression import compression_of
+from .profiler import Profiler
+from .results import ResultStore
 from .ui import UI
-from .util import command_line_args_parser, MapDataReader, PdataFile, \
-    PlotFile, Palette, sample_list, MetricStrings
+from .util import command_line_args_parser, MapDataReader, OutputWriter, \
+    PdataFile, PlotFile, Palette, sample_list, MetricStrings, BatchManifest
 from . import Modules
 
 def simulate_mode(args):
@@ -12,49 +17,305 @@ def simulate_mode(args):
     cache_fname = args.cachefile if args.cachefile is not None else 'Defaults'
     UI.indent_in(title=f'CACHE PARAMETERS ({cache_fname})')
     st.Cache.from_file(args.cachefile)
-    st.Cache.describe()
+    for level_idx in range(len(st.Cache.levels)):
+        st.Cache.select_level(level_idx)
+        st.Cache.describe()
     UI.indent_out()
 
+    # sampling only applies to a single shared cache level
+    if st.Sampling.mode is not None:
+        if len(st.Cache.levels) > 1 or st.Cache.num_private_levels() > 0:
+            UI.error('Sampling is only supported for single-level caches '
+                     'shared by all threads.')
+        if st.jobs > 1:
+            UI.warning('Sampled simulations run in a single job. Ignoring '
+                       f'--jobs {st.jobs}.')
+        st.Sampling.describe()
+
+    # checkpoints snapshot a single sequential simulation
+    use_checkpoints = args.checkpoint is not None or args.resume
+    if use_checkpoints:
+        if args.checkpoint is not None and args.checkpoint < 1:
+            UI.error('The checkpoint interval must be at least 1 second.')
+        if st.Cache.num_private_levels() > 0 or st.Sampling.mode is not None:
+            UI.error('Checkpoints are only supported for simulations of '
+                     'caches shared by all threads, without sampling.')
+        if st.jobs > 1:
+            UI.warning('Checkpointed simulations run in a single job. '
+                       f'Ignoring --jobs {st.jobs}.')
+        if st.parse_jobs > 1:
+            UI.warning('Checkpointed simulations parse the map in a single '
+                       f'job. Ignoring --parse-jobs {st.parse_jobs}.')
+
+    # runs are collapsed while reading the map in a single pass
+    if st.collapse_runs:
+        if use_checkpoints or st.Sampling.mode is not None:
+            UI.warning('Runs are not collapsed in checkpointed or sampled '
+                       'simulations. Ignoring --collapse-runs.')
+            st.collapse_runs = False
+        elif st.jobs > 1 and len(st.Cache.levels) == 1 and \
+             st.Cache.num_private_levels() == 0:
+            UI.warning('Runs are not collapsed when the sets of a cache are '
+                       'simulated in multiple jobs. Ignoring '
+                       '--collapse-runs.')
+            st.collapse_runs = False
+
+    # the modules are profiled in this process
+    if Profiler.enabled():
+        if use_checkpoints:
+            UI.warning('Profiling is not supported with checkpoints. Ignoring '
+                       '--profile.')
+            st.profile = None
+        elif st.Cache.num_private_levels() > 0 and st.jobs > 1:
+            UI.warning('Profiled private caches are simulated in a single '
+                       f'job. Ignoring --jobs {st.jobs}.')
+            st.jobs = 1
+
+    # stored results skip the simulation of the shared levels
+    store = None
+    if st.result_cache is not None:
+        if st.Cache.num_private_levels() > 0:
+            UI.warning('Results of private caches are not stored. Ignoring '
+                       '--result-cache.')
+        elif Profiler.enabled():
+            UI.warning('Profiling needs the simulation to run. Ignoring '
+                       '--result-cache.')
+        else:
+            store = ResultStore(st.result_cache, st.result_cache_limit)
+
     map_paths = args.input_files
     st.Map.set_path_prefix(map_paths)
     if len(map_paths) == 0:
         UI.error('In "simulate" or "sim-plot" mode you must at least '
                  'provide one MAP file.')
 
+    # output files are written while the next ones are produced
+    if st.pipeline:
+        OutputWriter.start()
+
     # Run one simulation/export per map file given
     for map_pth in map_paths:
         UI.indent_in(f'RETRACING MEMORY ACCESS PATTERN ({map_pth})')
+        UI.progress_label = map_pth
 
         # init map settings
         UI.indent_in(title=f'MAP SETTINGS')
+        st.Cache.select_level(0)
         st.Map.from_file(map_pth)
         st.Map.describe()
         UI.indent_out()
 
-        # init modules
-        UI.indent_in(title='MAPANALYZER METRICS')
+        # simulate the levels with private copies per thread group (if any),
+        # and then the shared levels, fed by the requests of the private ones.
+        num_levels = len(st.Cache.levels)
+        num_private = st.Cache.num_private_levels()
+        if Profiler.enabled():
+            Profiler.start()
+        UI.indent_in('SIMULATING CACHE')
+        if num_private == 0:
+            module_mngrs,checkpoint = None,None
+            if store is not None:
+                result_key = store.key(map_pth)
+                module_mngrs = store.load(result_key)
+            if module_mngrs is None:
+                if use_checkpoints:
+                    module_mngrs,checkpoint = simulate_checkpointed(
+                        map_pth, args.checkpoint, args.resume)
+                else:
+                    module_mngrs = create_managers(0, num_levels)
+                    cache = CacheHierarchy(module_mngrs)
+                    if st.jobs > 1 and num_levels == 1 and \
+                       st.Sampling.mode is None and \
+                       not cache.vectorizable():
+                        cache.run_set_partitioned(map_pth, st.jobs)
+                    else:
+                        cache.run_simulation(MapDataReader(map_pth))
+                if store is not None:
+                    store.save(result_key, module_mngrs)
+            if st.Sampling.mode is not None:
+                describe_estimates()
+            export_levels(module_mngrs, 0)
+            if checkpoint is not None:
+                checkpoint.remove()
+        else:
+            with tempfile.TemporaryDirectory(
+                    prefix='mapanalyzer-spill-') as spill_dir:
+                spill_paths,num_batches = simulate_private_shards(map_pth,
+                                                                  spill_dir)
+                if num_private < num_levels:
+                    module_mngrs = create_managers(num_private,
+                                                   num_levels-num_private)
+                    cache = CacheHierarchy(module_mngrs,
+                                           first_level=num_private)
+                    cache.simulate_batches(merge_shards_requests(spill_paths),
+                                           num_batches)
+                    export_levels(module_mngrs, num_private)
+        UI.indent_out()
+
+        if Profiler.enabled():
+            Profiler.report()
+
+        UI.indent_out()
+    OutputWriter.finish()
+    return
+
+def simulate_checkpointed(map_pth, interval, resume):
+    """simulate all the (shared) levels saving periodic checkpoints, and
+    maybe starting from the last one. Return the modules managers and the
+    checkpoint, to be removed once the results are exported"""
+    if compression_of(map_pth) is not None:
+        UI.warning(f'Compressed MAP file "{map_pth}" is read as a stream, '
+                   'so it is simulated without checkpoints.')
+        module_mngrs = create_managers(0, len(st.Cache.levels))
+        CacheHierarchy(module_mngrs).run_simulation(MapDataReader(map_pth))
+        return module_mngrs, None
+    checkpoint = Checkpoint(map_pth, interval)
+    state = checkpoint.load() if resume else None
+    if state is None:
+        # without interval, a fresh run does not save snapshots
+        saver = checkpoint if interval is not None else None
+        module_mngrs = create_managers(0, len(st.Cache.levels))
+        cache = CacheHierarchy(module_mngrs)
+        cache.run_simulation(MapDataReader(map_pth), checkpoint=saver)
+    else:
+        # a resumed run always gets the checkpoint (which saves nothing
+        # without interval), so it is told apart from a fresh one
+        cache = state['hierarchy']
+        module_mngrs = [c.modules for c in cache.caches]
+        cache.run_simulation(MapDataReader(map_pth,
+                                           start_offset=state['offset']),
+                             checkpoint=checkpoint, events_done=state['done'])
+    return module_mngrs, checkpoint
+
+def describe_estimates():
+    """print the extrapolated metrics of a sampled simulation"""
+    est = st.Sampling.estimates
+    UI.indent_in(title=f'SAMPLED ESTIMATES ({est["units"]} of '
+                 f'{est["population"]} units, '
+                 f'{100*est["confidence"]:.0f}% confidence)')
+    names,values,bounds = ['Metric'],['Estimate'],['Bounds']
+    for code,fmt in (('CMR', '{:.2f}%'), ('CMMA', '{:.0f}')):
+        names.append(code)
+        values.append(fmt.format(est[code]['estimate']))
+        if est[code]['low'] is None:
+            bounds.append('n/a')
+        else:
+            bounds.append(f'[{fmt.format(est[code]["low"])}, '
+                          f'{fmt.format(est[code]["high"])}]')
+    UI.columns((names, values, bounds), sep='  ', header=True)
+    UI.indent_out()
+    return
+
+def level_tags(level_name, group=None):
+    """tags that tell apart the results of a cache level and thread group"""
+    tags = []
+    if level_name is not None:
+        tags.append(level_name)
+    if group is not None:
+        tags.append(f'g{group}')
+    return tags
+
+def level_title(title, level_name, group=None):
+    """add the cache level name and thread group (if any) to a section
+    title"""
+    tags = level_tags(level_name, group)
+    if len(tags) == 0:
+        return title
+    return f'{title} [{" ".join(tags)}]'
+
+def create_managers(first_level, num_levels, group=None):
+    """create one modules manager per cache level"""
+    module_mngrs = []
+    for level_idx in range(first_level, first_level+num_levels):
+        st.Cache.select_level(level_idx)
+        level_name = st.Cache.level
+        UI.indent_in(title=level_title('MAPANALYZER METRICS', level_name,
+                                       group))
         module_mngr = Modules.Manager()
         module_mngr.describe()
         UI.indent_out()
+        if Profiler.enabled():
+            Profiler.instrument(module_mngr,
+                                '-'.join(level_tags(level_name, group)))
+        module_mngrs.append(module_mngr)
+    return module_mngrs
 
-        # run simulation
-        UI.indent_in('SIMULATING CACHE')
-        cache = Cache(modules=module_mngr)
-        cache.run_simulation(MapDataReader(map_pth))
-        UI.indent_out()
+def export_levels(module_mngrs, first_level, group=None):
+    """export the pdatas and plots of each level. Levels (and thread groups)
+    are told apart by a suffix in the map ID."""
+    map_id = st.Map.ID
+    for level_idx,module_mngr in enumerate(module_mngrs, start=first_level):
+        st.Cache.select_level(level_idx)
+        level_name = st.Cache.level
+        suffix = '-'.join(level_tags(level_name, group))
+        if suffix:
+            st.Map.ID = f'{map_id}-{suffix}' if map_id else suffix
 
         # export pdatas
-        UI.indent_in(title=f'EXPORTING PDATAS (bg: {st.Metrics.bg})')
+        UI.indent_in(title=level_title(
+            f'EXPORTING PDATAS (bg: {st.Metrics.bg})', level_name, group))
         module_mngr.export_all_pdatas()
         UI.indent_out()
 
         # export plots
         if st.mode == 'sim-plot':
-            UI.indent_in(title=f'EXPORTING PLOTS (bg: {st.Metrics.bg})')
+            UI.indent_in(title=level_title(
+                f'EXPORTING PLOTS (bg: {st.Metrics.bg})', level_name, group))
             module_mngr.export_all_plots()
             UI.indent_out()
+    st.Map.ID = map_id
+    return
 
-        UI.indent_out()
+def simulate_private_shard(map_pth, group, spill_path):
+    """simulate the private levels of one thread group and export their
+    results. If there are shared levels, the requests to them are written
+    to spill_path (see BatchSpill): return the number of batches written"""
+    num_private = st.Cache.num_private_levels()
+    threads_per_cache = st.Cache.levels[0][1]['threads_per_cache']
+    module_mngrs = create_managers(0, num_private, group)
+    shared = num_private < len(st.Cache.levels)
+    cache = CacheHierarchy(module_mngrs, forward_last=shared)
+    spill = BatchSpill(spill_path) if shared else None
+    cache.run_simulation(MapDataReader(map_pth),
+                         thread_group=(group, threads_per_cache),
+                         show_progress=(st.jobs == 1), forwarded=spill)
+    num_batches = 0
+    if spill is not None:
+        spill.close()
+        num_batches = spill.count
+    export_levels(module_mngrs, 0, group)
+    return num_batches
+
+def simulate_private_shards(map_pth, spill_dir):
+    """simulate the private levels of all thread groups. These are
+    independent, so they run in parallel if multiple jobs were requested.
+    Their requests to the shared levels are not kept in memory, but spilled
+    to a file per group in spill_dir. Return the paths of these files and
+    their number of batches (the same for all groups)"""
+    threads_per_cache = st.Cache.levels[0][1]['threads_per_cache']
+    num_groups = max(1, -(-st.Map.thread_count // threads_per_cache))
+    spill_paths = [os.path.join(spill_dir, f'g{g}.spill')
+                   for g in range(num_groups)]
+    shards_args = [(map_pth, g, spill_paths[g]) for g in range(num_groups)]
+    num_jobs = min(st.jobs, num_groups)
+    if num_jobs == 1:
+        num_batches = [simulate_private_shard(*a) for a in shards_args]
+    else:
+        UI.info(f'Simulating {num_groups} private caches using {num_jobs} '
+                'jobs.', pre='')
+        with multiprocessing.get_context('fork').Pool(num_jobs) as pool:
+            num_batches = pool.starmap(simulate_private_shard, shards_args)
+    return spill_paths, num_batches[0]
+
+def merge_shards_requests(spill_paths):
+    """merge the (time, requests) batches spilled by all thread groups into
+    (time, requests, progress) batches for the shared levels, reading them
+    in lockstep. All shards produce batches for the same times."""
+    shards_requests = [BatchSpill.read(p) for p in spill_paths]
+    for done,time_batches in enumerate(zip(*shards_requests), start=1):
+        common_time = time_batches[0][0]
+        requests = [r for _,reqs in time_batches for r in reqs]
+        yield common_time, requests, done
     return
 
 def plot_mode(args):
@@ -64,6 +325,10 @@ def plot_mode(args):
         UI.error('In "plot" mode you must at least provide one PDATA file.')
 
     for pd_path in pdata_paths:
+        # bg sidecars are read through the pdatas referencing them
+        if PdataFile.is_bg_file(pd_path):
+            UI.info(f'Skipping background data file "{pd_path}"', pre='')
+            continue
         UI.indent_in(title=f'PLOTTING FROM PDATA ({pd_path})')
         # obtain data from the pdata file
         file_dict = PdataFile.load(pd_path)
@@ -83,6 +348,11 @@ def plot_mode(args):
         map_dict = file_dict['map']
         pdata_dict = file_dict['metrics']
         st.Metrics.from_dict(pdata_dict)
+        st.Sampling.from_dict(meta_dict.get('sampling'))
+        if st.Sampling.mode is not None:
+            UI.info('This pdata comes from a sampled simulation '
+                    f'({st.Sampling.__str__()}): its values are estimates.',
+                    pre='')
 
         # init cache settings
         UI.indent_in(title=f'CACHE PARAMETERS')
@@ -119,17 +389,33 @@ def aggregate_mode(args):
 
     # Classify metrics_dict by the foreground metric code
     classified_pdata_dicts = {}
+    sampled_paths = []
     for pd_path in pdata_paths:
-        file_dict = PdataFile.load(pd_path)
+        # the bg metric is not aggregated
+        if PdataFile.is_bg_file(pd_path):
+            continue
+        file_dict = PdataFile.load(pd_path, resolve_bg=False)
+        if file_dict['meta'].get('sampling') is not None:
+            sampled_paths.append(pd_path)
         pdata_dict = file_dict['metrics']
         fg_code = pdata_dict['fg']['code']
         if fg_code not in classified_pdata_dicts:
             classified_pdata_dicts[fg_code] = []
         classified_pdata_dicts[fg_code].append(pdata_dict)
 
+    # aggregating estimates is fine, but mixing them with exact values is
+    # likely a mistake
+    if 0 < len(sampled_paths) < len(pdata_paths):
+        UI.warning('Aggregating sampled (estimated) and non-sampled pdata '
+                   'files. Sampled ones: ' + ', '.join(sampled_paths))
+    elif len(sampled_paths) > 0:
+        UI.info('All the aggregated pdata files come from sampled '
+                'simulations: results are estimates.', pre='')
+
     # inform st.Metrics about the available modules
-    st.Metrics.set_available(Modules.Manager.available_module_classes,
-                             supp_metrics_name='supported_aggr_metrics')
+    st.Metrics.set_available(
+        Modules.Manager.module_classes(classified_pdata_dicts.keys()),
+        supp_metrics_name='supported_aggr_metrics')
 
     # Aggregate all same-code metrics
     for metric_code,pdata_dicts in classified_pdata_dicts.items():
@@ -140,6 +426,142 @@ def aggregate_mode(args):
         UI.indent_out()
     return
 
+# columns of the map being simulated in batch mode, parsed once and shared
+# (through fork) with the processes that simulate each cache configuration,
+# which make their records and batches from them.
+batch_map = {}
+
+def batch_mode(args):
+    if args.input_files is None or len(args.input_files) != 1:
+        UI.error('In "batch" mode you must provide exactly one manifest '
+                 'file.')
+    manifest_pth = args.input_files[0]
+    map_paths, caches, output = BatchManifest.load(manifest_pth)
+    if st.Sampling.mode is not None:
+        UI.warning('Sampling is not supported in batch mode. Ignoring '
+                   '--sampling.')
+        st.Sampling.mode = None
+    if args.checkpoint is not None or args.resume:
+        UI.warning('Checkpoints are not supported in batch mode. Ignoring '
+                   '--checkpoint and --resume.')
+    if Profiler.enabled():
+        UI.warning('Profiling is not supported in batch mode. Ignoring '
+                   '--profile.')
+        st.profile = None
+    if st.result_cache is not None:
+        UI.warning('The result cache is not used in batch mode. Ignoring '
+                   '--result-cache.')
+    for cache_name,cache_pth in caches.items():
+        if not os.path.isfile(cache_pth):
+            UI.error(f'Cache file "{cache_pth}" ({cache_name}) does not '
+                     'exist.')
+    UI.info(f'{len(map_paths)} maps x {len(caches)} caches. Output: '
+            f'{output}', pre='')
+
+    st.Map.set_path_prefix(map_paths)
+    runs = []
+    for map_pth in map_paths:
+        UI.indent_in(f'PARSING MEMORY ACCESS PATTERN ({map_pth})')
+        # records do not depend on the cache (their addresses are absolute),
+        # so any cache settings are good to parse the map.
+        st.Cache.from_file(None)
+        st.Map.from_file(map_pth)
+        batch_map['columns'] = MapDataReader(map_pth).read_columns()
+        batch_map['total'] = st.Map.event_count
+        map_id = st.Map.ID if st.Map.ID else os.path.splitext(
+            os.path.basename(map_pth))[0]
+        UI.indent_out()
+
+        UI.indent_in(f'SIMULATING {len(caches)} CACHES ({map_id})')
+        runs_args = [(map_pth, name, cache_pth,
+                      os.path.join(output, map_id, name))
+                     for name,cache_pth in caches.items()]
+        num_jobs = min(st.jobs, len(runs_args))
+        if num_jobs == 1:
+            map_runs = [batch_run(*a) for a in runs_args]
+        else:
+            with multiprocessing.get_context('fork').Pool(
+                    num_jobs, initializer=batch_worker_init) as pool:
+                map_runs = pool.starmap(batch_run, runs_args)
+        for run in map_runs:
+            run['map_id'] = map_id
+            run['dir'] = os.path.relpath(run['dir'], output)
+            if run['status'] != 'ok':
+                UI.warning(f'{map_id} x {run["cache"]}: {run["error"]}')
+        runs.extend(map_runs)
+        batch_map.clear()
+        UI.indent_out()
+
+    # summary index of all the runs and their pdatas
+    os.makedirs(output, exist_ok=True)
+    index_pth = os.path.join(output, 'index.json')
+    index = {
+        'meta': st.to_dict(),
+        'manifest': os.path.abspath(manifest_pth),
+        'metrics': list(st.Metrics.enabled),
+        'runs': runs,
+    }
+    with open(index_pth, 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+
+    UI.indent_in(title='BATCH SUMMARY')
+    UI.columns((['Map'] + [r['map_id'] for r in runs],
+                ['Cache'] + [r['cache'] for r in runs],
+                ['Status'] + [r['status'] for r in runs],
+                ['Pdatas'] + [len(r['pdatas']) for r in runs],
+                ['Time (s)'] + [f'{r["seconds"]:.2f}' for r in runs]),
+               sep='  ', cols_align='lllrr', header=True)
+    UI.text(f'Index: {index_pth}')
+    UI.indent_out()
+    return
+
+def batch_worker_init():
+    """batch workers only report warnings and errors (on stderr)"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    return
+
+def batch_run(map_pth, cache_name, cache_pth, run_dir):
+    """simulate the parsed map (batch_map) with one cache configuration, and
+    export its pdatas to run_dir. Return a summary of the run."""
+    run = {'map': map_pth, 'cache': cache_name, 'cache_file': cache_pth,
+           'dir': run_dir, 'status': 'ok', 'error': None, 'pdatas': [],
+           'seconds': 0}
+    start = perf_counter()
+    cwd = os.getcwd()
+    try:
+        st.Cache.from_file(cache_pth)
+        if st.Cache.num_private_levels() > 0:
+            raise ValueError('caches with private levels are not supported '
+                             'in batch mode')
+        st.Map.from_file(map_pth)
+        module_mngrs = []
+        for level_idx in range(len(st.Cache.levels)):
+            st.Cache.select_level(level_idx)
+            module_mngrs.append(Modules.Manager())
+        cache = CacheHierarchy(module_mngrs)
+        records = MapDataReader.column_records(*batch_map['columns'])
+        if not cache.run_vectorized(records, show_progress=False):
+            records = MapDataReader.column_records(*batch_map['columns'])
+            cache.simulate_batches(map_batches(records), batch_map['total'],
+                                   show_progress=False)
+        os.makedirs(run_dir, exist_ok=True)
+        os.chdir(run_dir)
+        UI.indent_in(title=f'{cache_name.upper()} ({cache_pth})')
+        export_levels(module_mngrs, 0)
+        UI.indent_out()
+        run['pdatas'] = sorted(f for f in os.listdir('.')
+                               if f'.{PdataFile.fmt_name}_' in f)
+    except (Exception, SystemExit) as e:
+        # UI.error() exits: keep running the rest of the batch
+        run['status'] = 'error'
+        run['error'] = str(e) if not isinstance(e, SystemExit) else \
+            'aborted (see error above)'
+    finally:
+        os.chdir(cwd)
+    run['seconds'] = perf_counter() - start
+    return run
+
 def widget_mode(common_args, widget_argv):
     if not common_args.script:
         UI.error(f'No widget script provided!')
@@ -170,8 +592,16 @@ def mode_dispatcher():
     # parse command line arguments
     args, other_args = command_line_args_parser()
     st.set_mode(args)
+    st.set_jobs(args)
+    st.set_parse_jobs(args)
+    st.set_profile(args)
+    st.set_collapse_runs(args)
+    st.set_pipeline(args)
+    st.set_result_cache(args)
+    UI.set_progress_output(args.progress_file)
     st.Plot.from_args(args)
     st.Metrics.from_args(args)
+    st.Sampling.from_args(args)
 
     if st.mode == 'simulate' or st.mode == 'sim-plot':
         simulate_mode(args)
@@ -179,6 +609,8 @@ def mode_dispatcher():
         plot_mode(args)
     elif st.mode == 'aggregate':
         aggregate_mode(args)
+    elif st.mode == 'batch':
+        batch_mode(args)
     elif st.mode == 'widget':
         widget_mode(args, other_args)
     else:
@@ -0,0 +1,154 @@
+import json, tracemalloc
+from time import perf_counter
+from .settings import Settings as st
+from .ui import UI
+
+def reset_peak():
+    """make the peak of traced memory start from the current traced memory.
+    Return the bytes to add to the peak reported by tracemalloc: before
+    Python 3.9 there is no tracemalloc.reset_peak(), so the traces are
+    cleared instead, and the memory traced until then is the baseline"""
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+        return 0
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.clear_traces()
+    return baseline
+
+class Profiler:
+    """Cumulative time and number of calls of the methods of each module,
+    per phase: probe, commit, finalize, to_dict (pdata export) and to_plot.
+    If memory is also profiled, the peak of traced memory reached during
+    each phase is recorded (tracing memory slows down the whole run).
+
+    Nothing is measured unless instrument() is called on a modules manager:
+    it replaces the methods of its module instances by timed wrappers. So
+    when profiling is disabled, the modules run untouched."""
+    phases = ['probe', 'commit', 'finalize', 'to_dict', 'to_plot']
+    ext = 'profile.json'
+
+    # {module name -> {phase -> [calls, seconds]}}
+    stats = {}
+    # {phase -> peak bytes}
+    peaks = {}
+
+    @classmethod
+    def enabled(cls):
+        return st.profile is not None
+
+    @classmethod
+    def start(cls):
+        """forget previous measurements (e.g., of the previous map)"""
+        cls.stats = {}
+        cls.peaks = {p:0 for p in cls.phases}
+        if st.profile == 'memory' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return
+
+    @classmethod
+    def __phase(cls, method_name):
+        if method_name in ('probe', 'commit', 'finalize'):
+            return method_name
+        for phase in ('to_dict', 'to_plot'):
+            if method_name.endswith(f'_{phase}'):
+                return phase
+        return None
+
+    @classmethod
+    def instrument(cls, module_mngr, tag=''):
+        """wrap the methods of the modules of a manager. The tag (e.g., the
+        cache level) tells apart the modules of different managers"""
+        for mod in module_mngr.available_module_instances:
+            mod_name = f'{tag}:{mod.__class__.__name__}' if tag else \
+                mod.__class__.__name__
+            mod_stats = cls.stats.setdefault(mod_name, {})
+            for attr in dir(mod):
+                phase = cls.__phase(attr)
+                if phase is None or attr.startswith('_'):
+                    continue
+                method = getattr(mod, attr)
+                if not callable(method):
+                    continue
+                acc = mod_stats.setdefault(phase, [0, 0.0])
+                setattr(mod, attr, cls.__wrap(method, acc, phase))
+        return
+
+    @classmethod
+    def __wrap(cls, method, acc, phase):
+        if st.profile == 'memory':
+            peaks = cls.peaks
+            def wrapper(*args, **kwargs):
+                baseline = reset_peak()
+                t0 = perf_counter()
+                ret = method(*args, **kwargs)
+                acc[1] += perf_counter() - t0
+                acc[0] += 1
+                peak = baseline + tracemalloc.get_traced_memory()[1]
+                if peak > peaks[phase]:
+                    peaks[phase] = peak
+                return ret
+        else:
+            def wrapper(*args, **kwargs):
+                t0 = perf_counter()
+                ret = method(*args, **kwargs)
+                acc[1] += perf_counter() - t0
+                acc[0] += 1
+                return ret
+        return wrapper
+
+    @classmethod
+    def to_dict(cls):
+        data = {
+            'meta': st.to_dict(),
+            'map': st.Map.ID,
+            'memory': st.profile == 'memory',
+            'modules': {mod: {ph: {'calls': phases[ph][0],
+                                   'seconds': phases[ph][1]}
+                              for ph in cls.phases if ph in phases}
+                        for mod,phases in cls.stats.items()},
+            'phases': {},
+        }
+        for phase in cls.phases:
+            calls = sum(m[phase][0] for m in cls.stats.values() if phase in m)
+            secs = sum(m[phase][1] for m in cls.stats.values() if phase in m)
+            data['phases'][phase] = {'calls': calls, 'seconds': secs}
+            if st.profile == 'memory':
+                data['phases'][phase]['peak_bytes'] = cls.peaks[phase]
+        return data
+
+    @classmethod
+    def report(cls):
+        """print the measurements and save them as JSON, next to the
+        pdata files"""
+        data = cls.to_dict()
+        UI.indent_in(title='PROFILE')
+        names, phases, calls, secs, per_call = ['Module'], ['Phase'], \
+            ['Calls'], ['Time (s)'], ['Per call (us)']
+        for mod,mod_phases in data['modules'].items():
+            for phase,vals in mod_phases.items():
+                if vals['calls'] == 0:
+                    continue
+                names.append(mod)
+                phases.append(phase)
+                calls.append(vals['calls'])
+                secs.append(f'{vals["seconds"]:.4f}')
+                per_call.append(f'{1e6*vals["seconds"]/vals["calls"]:.2f}')
+        UI.columns((names, phases, calls, secs, per_call), sep='  ',
+                   cols_align='llrrr', header=True)
+        UI.nl()
+        cols = (['Phase'], ['Calls'], ['Time (s)'], ['Peak memory (KiB)'])
+        for phase,vals in data['phases'].items():
+            cols[0].append(phase)
+            cols[1].append(vals['calls'])
+            cols[2].append(f'{vals["seconds"]:.4f}')
+            cols[3].append(f'{vals["peak_bytes"]/1024:.1f}'
+                           if 'peak_bytes' in vals else '-')
+        UI.columns(cols, sep='  ', cols_align='lrrr', header=True)
+
+        prefix = f'{st.Map.ID}.' if st.Map.ID else ''
+        filename = f'{prefix}{cls.ext}'
+        with open(filename, 'w') as prof_file:
+            json.dump(data, prof_file, indent=2)
+        UI.text(f'Saved: {filename}')
+        UI.indent_out()
+        return
@@ -0,0 +1,153 @@
+import hashlib, json, os, pickle, zlib
+from .settings import Settings as st
+from .ui import UI
+
+class ResultStore:
+    """Content-addressed store of simulation results, so that re-running a
+    map with the same cache (e.g., only to change plot options) skips the
+    simulation. Each entry holds the finalized modules managers of all the
+    cache levels, and is named after a hash of everything the simulation
+    depends on: the content of the map file, the cache levels, the computed
+    metrics, the settings their modules read while simulating (the MAP
+    resolution), the sampling and the source code of the tool (so that any
+    change to the simulation invalidates the results stored before it).
+
+    Entries are pickled and compressed like checkpoints. When the store
+    grows beyond its size limit, the least recently used entries (by
+    modification time, refreshed on every hit) are removed."""
+    # bump when the format of the entries changes
+    format_version = 5
+    ext = 'result'
+    # digest of the .py files of the package (computed once)
+    sources = None
+
+    def __init__(self, directory, limit_mib):
+        self.directory = directory
+        self.limit = limit_mib * 1024 * 1024
+        os.makedirs(directory, exist_ok=True)
+        return
+
+    @classmethod
+    def source_digest(cls):
+        """hash of the path and content of every .py file of the package.
+        The version in setup.py is not bumped by every change."""
+        if cls.sources is None:
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            sources = []
+            for dirpath,dirnames,filenames in os.walk(package_dir):
+                dirnames.sort()
+                sources += [os.path.join(dirpath, name)
+                            for name in sorted(filenames)
+                            if name.endswith('.py')]
+            digest = hashlib.sha256()
+            for source in sources:
+                digest.update(os.path.relpath(source, package_dir).encode())
+                with open(source, 'rb') as source_file:
+                    digest.update(hashlib.sha256(source_file.read()).digest())
+            cls.sources = digest.hexdigest()
+        return cls.sources
+
+    @classmethod
+    def map_digest(cls, map_pth):
+        digest = hashlib.sha256()
+        with open(map_pth, 'rb') as map_file:
+            for chunk in iter(lambda: map_file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, map_pth):
+        """hash of the inputs of the simulation of map_pth with the current
+        settings. The bg metric is computed as well, so it is part of it."""
+        computed = set(st.Metrics.enabled)
+        if st.Metrics.bg is not None:
+            computed.add(st.Metrics.bg)
+        inputs = {
+            'format': self.format_version,
+            'sources': self.source_digest(),
+            'map': self.map_digest(map_pth),
+            'cache': st.Cache.levels,
+            'metrics': sorted(computed),
+            'streaming': sorted(st.Metrics.streaming),
+            'sampling': (st.Sampling.to_dict()
+                         if st.Sampling.mode is not None else None),
+        }
+        # MAP samples the accesses into a matrix of the plot resolution
+        if 'MAP' in computed:
+            inputs['map_res'] = st.Plot.map_res
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()
+                              ).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.directory, f'{key}.{self.ext}')
+
+    def load(self, key):
+        """return the modules managers stored under key, or None"""
+        path = self.__path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as entry_file:
+                entry = pickle.loads(zlib.decompress(entry_file.read()))
+        except Exception as e:
+            # e.g., written by a version whose modules have changed
+            UI.warning(f'Could not read stored result "{path}" ({e}). '
+                       'Removing it.')
+            self.__remove(path)
+            return None
+        # mark as recently used
+        os.utime(path)
+        if entry['estimates'] is not None:
+            st.Sampling.estimates = entry['estimates']
+        UI.info(f'Using stored simulation results ({key[:12]}).', pre='')
+        return entry['modules']
+
+    def save(self, key, module_mngrs):
+        entry = {
+            'modules': module_mngrs,
+            'estimates': (st.Sampling.estimates
+                          if st.Sampling.mode is not None else None),
+        }
+        data = zlib.compress(pickle.dumps(entry,
+                                          protocol=pickle.HIGHEST_PROTOCOL))
+        if len(data) > self.limit:
+            UI.warning(f'Simulation results ({len(data)//(1024*1024)} MiB) '
+                       'exceed the size of the result cache. Not storing '
+                       'them.')
+            return
+        path = self.__path(key)
+        # other runs may share the store: write aside and replace.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+        return
+
+    def evict(self):
+        """remove the least recently used entries until the store fits in
+        its size limit"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(f'.{self.ext}'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _,size,_ in entries)
+        for _,size,path in entries:
+            if total <= self.limit:
+                break
+            self.__remove(path)
+            total -= size
+        return
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
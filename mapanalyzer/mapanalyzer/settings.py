@@ -3,9 +3,24 @@ from datetime import datetime
 from itertools import zip_longest
 
 from .ui import UI
+from .compression import open_map_file, strip_compression_ext
 
 class Settings:
     mode = 'sim-plot'
+    # number of worker processes used to simulate in parallel
+    jobs = 1
+    # number of worker processes used to parse the map
+    parse_jobs = 1
+    # None (no profiling), 'time' or 'memory' (time and memory)
+    profile = None
+    # directory of the stored simulation results (None: do not store them),
+    # and its size limit in MiB
+    result_cache = None
+    result_cache_limit = 1024
+    # collapse runs of accesses of a thread to the same cache line
+    collapse_runs = False
+    # read the map and write the output files in separate threads
+    pipeline = False
     timestamp = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
     # used to check enabled codes and to create help message
     ALL_METRIC_CODES = {
@@ -27,11 +42,61 @@ class Settings:
             cls.mode = args.mode
         return
 
+    @classmethod
+    def set_jobs(cls, args):
+        if args.jobs is not None:
+            if args.jobs < 1:
+                UI.error('The number of jobs must be at least 1.')
+            cls.jobs = args.jobs
+        return
+
+    @classmethod
+    def set_parse_jobs(cls, args):
+        if args.parse_jobs is not None:
+            if args.parse_jobs < 1:
+                UI.error('The number of parse jobs must be at least 1.')
+            cls.parse_jobs = args.parse_jobs
+        return
+
+    @classmethod
+    def set_profile(cls, args):
+        cls.profile = args.profile
+        return
+
+    @classmethod
+    def set_collapse_runs(cls, args):
+        cls.collapse_runs = args.collapse_runs
+        return
+
+    @classmethod
+    def set_pipeline(cls, args):
+        cls.pipeline = args.pipeline
+        return
+
+    @classmethod
+    def set_result_cache(cls, args):
+        if args.result_cache_limit is not None:
+            if args.result_cache_limit < 1:
+                UI.error('The result cache limit must be at least 1 MiB.')
+            cls.result_cache_limit = args.result_cache_limit
+        if args.result_cache is None:
+            return
+        if args.result_cache == 'default':
+            cache_home = os.environ.get('XDG_CACHE_HOME') or \
+                os.path.join(os.path.expanduser('~'), '.cache')
+            cls.result_cache = os.path.join(cache_home, 'mapanalyzer')
+        else:
+            cls.result_cache = args.result_cache
+        return
+
     @classmethod
     def to_dict(cls):
         data = {
             'timestamp': cls.timestamp
         }
+        # sampled results are estimates: say so, and how they were taken
+        if cls.Sampling.mode is not None:
+            data['sampling'] = cls.Sampling.to_dict()
         return data
 
     @classmethod
@@ -54,6 +119,19 @@ class Settings:
             'line_size_bytes' : 'line_size',
             'associativity'   : 'asso',
         }
+        # properties that can be omitted from the file
+        optional_key_map = {
+            'threads_per_cache': 'threads_per_cache',
+            'replacement_policy': 'policy',
+            'replacement_seed': 'policy_seed',
+            'write_policy': 'write_policy',
+            'write_allocate': 'write_allocate',
+        }
+        # properties whose value is a (case-insensitive) word, not an integer
+        str_keys = {'replacement_policy', 'write_policy'}
+        # supported replacement policies (see cache.replacement_policies)
+        policies = ['lru', 'fifo', 'plru', 'random', 'srrip']
+        write_policies = ['write-back', 'write-through']
 
         ############################################################
         #### BASIC VALUES
@@ -61,6 +139,24 @@ class Settings:
         cache_size = 32768
         line_size = 64
         asso = 8
+        # if not 0, each group of this many threads has its own private copy
+        # of this cache level. Otherwise, the level is shared by all threads.
+        threads_per_cache = 0
+        # replacement policy, and seed for the 'random' one
+        policy = 'lru'
+        policy_seed = 0
+        # what happens on writes: whether they reach the next level only on
+        # eviction (write-back) or always (write-through); and whether a
+        # write miss fetches the block (write_allocate: 1) or not (0).
+        write_policy = 'write-back'
+        write_allocate = 1
+
+        # Cache levels, in order from the closest to the processor to the
+        # farthest one: [(name, {class_name -> value})]. A cache file without
+        # level sections describes a single level named None.
+        levels = None
+        # name of the level currently described by this class.
+        level = None
 
         initialized = False
 
@@ -73,6 +169,12 @@ class Settings:
 
         @classmethod
         def from_file(cls, filename=None):
+            # default basics, used if no file is given
+            all_key_map = {**cls.key_map, **cls.optional_key_map}
+            default_vals = {name: getattr(cls, cls_name)
+                            for name,cls_name in all_key_map.items()}
+            levels_vals = [(None, default_vals)]
+
             # if no file, compute derived values from default basics
             if filename is None:
                 pass
@@ -84,7 +186,11 @@ class Settings:
             # If cache file exists, then use it.
             else:
                 with open(filename, 'r') as cache_config_file:
-                    name_vals = {}
+                    # properties before the first [<level>] section are
+                    # shared by all levels.
+                    shared_vals = {}
+                    name_vals = shared_vals
+                    levels_vals = []
                     for line in cache_config_file:
                         # skip empty or comment
                         if line == '\n' or line[0] == '#':
@@ -93,6 +199,19 @@ class Settings:
                         content_comment = line.split('#')
                         line = content_comment[0]
 
+                        # a [<level>] line starts the section of a new level
+                        section = line.strip()
+                        if section[:1] == '[' and section[-1:] == ']':
+                            level_name = section[1:-1].strip()
+                            if level_name == '' or level_name in \
+                               [n for n,_ in levels_vals]:
+                                UI.error(f'While reading "{filename}":\n'
+                                         'Empty or repeated cache level name:'
+                                         f'\n>>> {line}')
+                            name_vals = {}
+                            levels_vals.append((level_name, name_vals))
+                            continue
+
                         # parse <name>:<value>
                         key_val_arr = [x.strip() for x in line.split(':')]
 
@@ -104,14 +223,17 @@ class Settings:
                         name,val = key_val_arr[0], key_val_arr[1]
 
                         # ignore invalid property names
-                        if name not in cls.key_map:
+                        if name not in all_key_map:
                             UI.warning(f'Ignoring invalid property:\n'
                                        f'>>> {line}')
                             continue
 
                         # ignore invalid values
                         try:
-                            val = int(val)
+                            if name in cls.str_keys:
+                                val = val.lower()
+                            else:
+                                val = int(val)
                         except Exception:
                             UI.warning(f'Ignoring invalid value:\n'
                                        f'>>> {line}')
@@ -119,26 +241,103 @@ class Settings:
 
                         name_vals[name] = val
 
-                    # error if cache file was given but it is incomplete.
-                    if len(cls.key_map) != len(name_vals):
+                # without level sections, the file describes a single cache
+                if len(levels_vals) == 0:
+                    levels_vals = [(None, shared_vals)]
+                else:
+                    levels_vals = [(n, {**shared_vals, **v})
+                                   for n,v in levels_vals]
+
+                # error if cache file was given but it is incomplete.
+                for level_name,name_vals in levels_vals:
+                    if any(name not in name_vals for name in cls.key_map):
+                        in_level = '' if level_name is None else \
+                            f' for level "{level_name}"'
                         UI.error('Cache file given does not have all '
-                                 'necessary properties.\n'
+                                 f'necessary properties{in_level}.\n'
                                  'See mapanalyzer --help.')
 
-                    # apply values
-                    for key,val in name_vals.items():
-                        setattr(cls, cls.key_map[key], val)
+            # store the values of each level with their class names
+            cls.levels = [(n, {all_key_map[k]: v
+                               for k,v in {**default_vals, **vals}.items()})
+                          for n,vals in levels_vals]
+            cls.__check_levels()
+
+            # compute derived values and address formatter of the first level
+            cls.select_level(0)
+            return
 
-            # compute derived values and address formatter
+        @classmethod
+        def __check_levels(cls):
+            """all levels must share the address size, and lines cannot
+            shrink in farther levels (otherwise the blocks requested by one
+            level would include padding bytes of the next one)"""
+            for (name_a,vals_a),(name_b,vals_b) in zip(cls.levels,
+                                                       cls.levels[1:]):
+                if vals_a['arch'] != vals_b['arch']:
+                    UI.error(f'Cache levels "{name_a}" and "{name_b}" have '
+                             'different arch_size_bits.')
+                if vals_a['line_size'] > vals_b['line_size']:
+                    UI.error(f'Cache level "{name_b}" has a line size smaller '
+                             f'than the one of the previous level "{name_a}".')
+                # private levels are the closest to the processor, and they
+                # are all split among the same thread groups.
+                if vals_a['threads_per_cache'] == 0 and \
+                   vals_b['threads_per_cache'] != 0:
+                    UI.error(f'Private cache level "{name_b}" cannot come '
+                             f'after the shared level "{name_a}".')
+                if vals_b['threads_per_cache'] != 0 and \
+                   vals_a['threads_per_cache'] != vals_b['threads_per_cache']:
+                    UI.error(f'Private cache levels "{name_a}" and "{name_b}" '
+                             'have different threads_per_cache.')
+            for name,vals in cls.levels:
+                if vals['threads_per_cache'] < 0:
+                    UI.error(f'Cache level "{name}" has a negative '
+                             'threads_per_cache.')
+                if vals['policy'] not in cls.policies:
+                    UI.error(f'Unknown replacement policy "{vals["policy"]}"'
+                             f'. Supported: {", ".join(cls.policies)}.')
+                asso = vals['asso']
+                if vals['policy'] == 'plru' and asso & (asso-1) != 0:
+                    UI.error('The plru replacement policy needs a power of two '
+                             f'associativity (given: {asso}).')
+                if vals['write_policy'] not in cls.write_policies:
+                    UI.error('Unknown write policy '
+                             f'"{vals["write_policy"]}". Supported: '
+                             f'{", ".join(cls.write_policies)}.')
+                if vals['write_allocate'] not in (0, 1):
+                    UI.error('write_allocate must be either 0 or 1 (given: '
+                             f'{vals["write_allocate"]}).')
+            return
+
+        @classmethod
+        def num_private_levels(cls):
+            """number of (leading) levels with private copies per thread
+            group"""
+            return sum(1 for _,vals in cls.levels
+                       if vals['threads_per_cache'] != 0)
+
+        @classmethod
+        def select_level(cls, level_idx):
+            """Make this class (and the address formatter and the map
+            padding, which depend on it) describe the given cache level."""
+            cls.level, vals = cls.levels[level_idx]
+            for cls_name,val in vals.items():
+                setattr(cls, cls_name, val)
             cls.__init_derived_values()
             cls.initialized = True
             Settings.AddrFmt.init()
+            if Settings.Map.initialized:
+                Settings.Map.realign()
             return
 
         @classmethod
         def from_dict(cls, cache_dict):
             # load data from the cache section of the metric file
             cls.__dict_to_basics(cache_dict)
+            all_key_map = {**cls.key_map, **cls.optional_key_map}
+            cls.levels = [(cls.level, {cls_name: getattr(cls, cls_name)
+                                       for cls_name in all_key_map.values()})]
 
             # compute derived values
             cls.__init_derived_values()
@@ -160,18 +359,35 @@ class Settings:
             cls.asso = cache_dict['associativity']
             cls.cache_size = cache_dict['cache_size_bytes']
             cls.arch = cache_dict['arch_size_bits']
+            cls.level = cache_dict.get('level', None)
+            cls.threads_per_cache = cache_dict.get('threads_per_cache', 0)
+            cls.policy = cache_dict.get('replacement_policy', 'lru')
+            cls.policy_seed = cache_dict.get('replacement_seed', 0)
+            cls.write_policy = cache_dict.get('write_policy', 'write-back')
+            cls.write_allocate = cache_dict.get('write_allocate', 1)
             return
 
         @classmethod
         def to_dict(cls):
             if not cls.initialized:
                 UI.error('Cache.to_dict: Cache not initialized, cannot export.')
-            return {
+            cache_dict = {
                 'line_size_bytes': cls.line_size,
                 'associativity': cls.asso,
                 'cache_size_bytes': cls.cache_size,
                 'arch_size_bits': cls.arch
             }
+            if cls.level is not None:
+                cache_dict['level'] = cls.level
+            if cls.threads_per_cache != 0:
+                cache_dict['threads_per_cache'] = cls.threads_per_cache
+            if cls.policy != 'lru':
+                cache_dict['replacement_policy'] = cls.policy
+                cache_dict['replacement_seed'] = cls.policy_seed
+            if cls.write_policy != 'write-back' or cls.write_allocate != 1:
+                cache_dict['write_policy'] = cls.write_policy
+                cache_dict['write_allocate'] = cls.write_allocate
+            return cache_dict
 
         @classmethod
         def __str__(cls):
@@ -199,6 +415,20 @@ class Settings:
                 f'{cls.line_size} bytes',
                 f'{cls.asso}-way'
             ]
+            if cls.level is not None:
+                names.insert(0, 'Cache Level')
+                vals.insert(0, cls.level)
+            if cls.policy != 'lru':
+                names.append('Replacement')
+                vals.append(cls.policy.upper() if cls.policy != 'random' else
+                            f'RANDOM (seed: {cls.policy_seed})')
+            if cls.write_policy != 'write-back' or cls.write_allocate != 1:
+                names.append('Write Policy')
+                allocate = 'allocate' if cls.write_allocate else 'no-allocate'
+                vals.append(f'{cls.write_policy}, write-{allocate}')
+            if cls.threads_per_cache != 0:
+                names.append('Private Copies')
+                vals.append(f'one per {cls.threads_per_cache} thread(s)')
             UI.columns((names, vals), sep=' : ')
             return
 
@@ -212,6 +442,7 @@ class Settings:
         max_tag = None
         max_index = None
         max_offset = None
+        tag_shift = None
 
         @classmethod
         def init(cls):
@@ -227,6 +458,7 @@ class Settings:
             cls.max_tag = 2**cls.bits_tag - 1
             cls.max_index = 2**cls.bits_set - 1
             cls.max_offset = 2**cls.bits_off - 1
+            cls.tag_shift = cls.bits_set + cls.bits_off
 
         @classmethod
         def bin(cls, address):
@@ -252,13 +484,11 @@ class Settings:
 
         @classmethod
         def split(cls, address):
-            """Splits an address into its tag, index, and offset parts."""
-            offset_mask = (1 << cls.bits_off) - 1
-            offset = address & offset_mask
-            index_mask = (1 << cls.bits_set) - 1
-            index = (address >> cls.bits_off) & index_mask
-            tag = address >> (cls.bits_set + cls.bits_off)
-            return tag, index, offset
+            """Splits an address into its tag, index, and offset parts.
+            The max values are the masks of the index and offset."""
+            return (address >> cls.tag_shift,
+                    (address >> cls.bits_off) & cls.max_index,
+                    address & cls.max_offset)
 
         @classmethod
         def __pad(cls, number, base, max_val):
@@ -317,6 +547,13 @@ class Settings:
         bg = None
         bg_user_set = None
 
+        # Metrics computed in streaming mode: their modules keep bounded
+        # state during the simulation instead of full histories (the result
+        # may be an approximation). Set of metric codes.
+        streaming = set()
+        # metrics whose modules have a streaming mode
+        streamable = ('MRID', 'TLD')
+
         initialized = False
 
         @classmethod
@@ -328,6 +565,7 @@ class Settings:
                                    list(Settings.ALL_METRIC_CODES.keys()),
                                    'MAP')
             cls.bg_user_set = args.bg_metric
+            cls.streaming = cls.__init_streaming(args.stream_codes)
             cls.initialized = True
             return
 
@@ -373,6 +611,22 @@ class Settings:
                 cls.enabled_explicit = True
             return
 
+        @classmethod
+        def __init_streaming(cls, stream_codes):
+            # If omitted or explicitly asked for 'none', nothing is streamed.
+            if stream_codes is None or stream_codes.upper() == 'NONE':
+                return set()
+            codes = {m.strip().upper() for m in stream_codes.split(',')}
+            for code in codes:
+                if code not in Settings.ALL_METRIC_CODES.keys():
+                    UI.error('Invalid metric code given to streaming metrics: '
+                             f'"{code}".')
+                if code not in cls.streamable:
+                    UI.error(f'Metric "{code}" has no streaming mode. Only '
+                             f'"{", ".join(cls.streamable)}" can be computed '
+                             'in streaming mode.')
+            return codes
+
         @classmethod
         def __init_bg(cls, bg_code, bg_options, fallback_code):
             # If omitted or explicitly asked for 'none', set to None.
@@ -440,6 +694,10 @@ class Settings:
 
             # sort by metric number and extract key,value for the dictionary
             num_met_mod.sort()
+            if len(num_met_mod) == 0:
+                cls.available = {}
+                cls.enabled = []
+                return
             _, sup_met_codes, sup_modules = zip(*num_met_mod)
 
             # check that there are no duplicated metric codes
@@ -482,7 +740,8 @@ class Settings:
 
         @classmethod
         def describe(cls):
-            attrs = ['enabled', 'available', 'bg', 'bg_user_set', 'initialized']
+            attrs = ['enabled', 'available', 'bg', 'bg_user_set', 'streaming',
+                     'initialized']
             vals = [getattr(cls, at) for at in attrs]
             UI.indent_in(title='METRICS SETTINGS')
             UI.columns((attrs, vals), sep=' : ')
@@ -490,6 +749,122 @@ class Settings:
             return
 
 
+    class Sampling:
+        ############################################################
+        #### BASIC VALUES
+        # None (simulate everything), 'time' or 'sets'
+        mode = None
+        # time sampling: in each period of this many time steps, simulate
+        # 'warmup' steps without probing the modules, then measure 'on' steps.
+        on = 0
+        period = 0
+        warmup = 0
+        # set sampling: only simulate 1 every k sets
+        k = 0
+
+        ############################################################
+        # DERIVED VALUES
+        # extrapolated CMR and CMMA with their confidence bounds, as given by
+        # cache.SampleStats.estimates()
+        estimates = None
+
+        @classmethod
+        def from_args(cls, args):
+            if args.sampling is None or args.sampling.lower() == 'none':
+                cls.mode = None
+                return
+            fields = args.sampling.lower().split(':')
+            try:
+                values = [int(f) for f in fields[1:]]
+            except ValueError:
+                UI.error(f'Invalid sampling specification "{args.sampling}": '
+                         'values must be integers.')
+            if fields[0] == 'time' and len(values) in (2,3):
+                cls.mode = 'time'
+                cls.on, cls.period = values[:2]
+                cls.warmup = values[2] if len(values) == 3 else 0
+                if cls.on < 1 or cls.warmup < 0 or \
+                   cls.warmup + cls.on > cls.period:
+                    UI.error('Invalid time sampling: 1 <= ON and '
+                             'WARMUP+ON <= PERIOD must hold.')
+            elif fields[0] == 'sets' and len(values) == 1:
+                cls.mode = 'sets'
+                cls.k = values[0]
+                if cls.k < 1:
+                    UI.error('Invalid set sampling: K must be at least 1.')
+            else:
+                UI.error(f'Invalid sampling specification "{args.sampling}". '
+                         'Use "time:<ON>:<PERIOD>[:<WARMUP>]" or "sets:<K>".')
+            return
+
+        @classmethod
+        def from_dict(cls, sampling_dict):
+            if sampling_dict is None:
+                cls.mode = None
+                cls.estimates = None
+                return
+            cls.mode = sampling_dict['mode']
+            cls.on = sampling_dict.get('on', 0)
+            cls.period = sampling_dict.get('period', 0)
+            cls.warmup = sampling_dict.get('warmup', 0)
+            cls.k = sampling_dict.get('k', 0)
+            cls.estimates = sampling_dict.get('estimates')
+            return
+
+        @classmethod
+        def time_phase(cls, time):
+            """Return 'warmup', 'measure' or 'skip' for the given time."""
+            offset = time % cls.period
+            if offset < cls.warmup:
+                return 'warmup'
+            if offset < cls.warmup + cls.on:
+                return 'measure'
+            return 'skip'
+
+        @classmethod
+        def window(cls, time):
+            return time // cls.period
+
+        @classmethod
+        def num_slots(cls, time_size):
+            """number of measurement windows that would fit in the whole
+            trace, that is the population the measured ones are drawn from"""
+            return time_size / cls.on
+
+        @classmethod
+        def is_sampled_set(cls, set_index):
+            return set_index % cls.k == 0
+
+        @classmethod
+        def __str__(cls):
+            if cls.mode == 'time':
+                return (f'time (measure {cls.on} of every {cls.period} '
+                        f'steps, {cls.warmup} warm-up)')
+            if cls.mode == 'sets':
+                return f'sets (1 of every {cls.k} sets)'
+            return 'none'
+
+        @classmethod
+        def to_dict(cls):
+            if cls.mode is None:
+                return None
+            data = {'mode': cls.mode}
+            if cls.mode == 'time':
+                data.update({'on': cls.on, 'period': cls.period,
+                             'warmup': cls.warmup})
+            else:
+                data['k'] = cls.k
+            data['estimates'] = cls.estimates
+            return data
+
+        @classmethod
+        def describe(cls):
+            UI.indent_in(title='SAMPLING SETTINGS')
+            UI.columns((['Sampling'], [cls.__str__()]), sep=' : ')
+            UI.indent_out()
+            return
+
+
     class Map:
         ############################################################
         #### CONSTANT VALUES
@@ -559,7 +934,7 @@ class Settings:
                 UI.error('You must specify a MAP file.')
             cls.file_path = map_filepath
             try:
-                file = open(cls.file_path, 'r')
+                file = open_map_file(cls.file_path)
             except:
                 UI.error(f'While reading MAP file "{cls.file_path}":\n'
                          'File does not exist or cannot be read.')
@@ -715,7 +1090,8 @@ class Settings:
             # among all paths (of a given character length) and the common
             # prefix among them (at least as long as the common path)
             common_prefix = os.path.commonprefix(input_files_paths)
-            basename = os.path.relpath(common_prefix, cls.path_prefix)
+            basename = os.path.relpath(common_prefix, cls.path_prefix) \
+                if common_prefix else ''
 
             # keep removing awkward characters from end or beginning until
             # the id is nice :)
@@ -726,10 +1102,10 @@ class Settings:
                 almost_id = almost_id_new
                 almost_id_new = almost_id.strip(unwanted)
             # avoid hidden files
-            while almost_id[0] == '.':
+            while almost_id and almost_id[0] == '.':
                 almost_id = almost_id[1:]
             # avoid ending with dash
-            while almost_id[-1] == '-':
+            while almost_id and almost_id[-1] == '-':
                 almost_id = almost_id[:-1]
             cls.ID = almost_id
             return
@@ -741,6 +1117,8 @@ class Settings:
             cls.path_prefix.
             """
             relative_path = os.path.relpath(cls.file_path, cls.path_prefix)
+            if not cls.initd_from_dict:
+                relative_path = strip_compression_ext(relative_path)
             basename, _ = os.path.splitext(relative_path)
 
             # if initialized from dictionary, then that dictionary came from
@@ -762,6 +1140,13 @@ class Settings:
             cls.ID = cls.__generate_id()
             cls.__init_mem_padding()
 
+        @classmethod
+        def realign(cls):
+            """recompute the memory padding after the cache line size
+            changed (e.g., when selecting another cache level)"""
+            cls.__init_mem_padding()
+            return
+
         @classmethod
         def __init_mem_padding(cls):
             # compute padding bytes to make the memory chunk block-aligned.
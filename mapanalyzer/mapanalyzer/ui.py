@@ -1,4 +1,6 @@
+import json, os # to write machine-readable progress
 from sys import stdout, stderr # to define where to write output
+from time import monotonic # to rate-limit the progress
 from colorama import Fore, Style # for colored messages
 from itertools import zip_longest # to print columns of different lengths
 
@@ -10,6 +12,17 @@ class UI:
     iw = 4 # indentation width
     ind = '' # the actual indentation string
 
+    # progress is shown at most once per progress_interval seconds. If
+    # progress_out is set, it is also written there as JSON lines.
+    progress_interval = 0.25
+    progress_out = None
+    progress_label = None
+    # state of the current progress
+    __prog_start = None # (time, count) when the progress started
+    __prog_last = -1 # count of the last call
+    __prog_next_check = 0 # count at which the clock is checked again
+    __prog_next_time = 0 # time at which to show the progress again
+
     @classmethod
     def __color_msg(cls, msg='', symb='', indent=True, ind_str='', pre='',
                     msg_color=Fore.RESET, end='\n', out=stdout):
@@ -131,13 +144,69 @@ class UI:
         cls.__color_msg(out=out)
         return
 
+    @classmethod
+    def set_progress_output(cls, target):
+        """write machine-readable progress to a file path, or to an already
+        open file descriptor given as 'fd:<N>'"""
+        if target is None:
+            cls.progress_out = None
+            return
+        try:
+            if target.startswith('fd:'):
+                cls.progress_out = os.fdopen(int(target[3:]), 'w',
+                                             buffering=1)
+            else:
+                cls.progress_out = open(target, 'w', buffering=1)
+        except (OSError, ValueError) as e:
+            cls.error(f'Cannot write progress to "{target}": {e}')
+        return
+
     @classmethod
     def progress(cls, count, total):
-        """print a progress ratio that overwrites the same (current) line"""
-        step = max(total // 200, 1)
-        if count % step == 0 or count == total:
-            cls.__color_msg(msg=f'{(100*count/total):5.1f}% {count:8d}/{total}',
-                            ind_str=f'\033[2K\r{cls.ind}', end='', out=stdout)
+        """print a progress ratio, throughput and ETA that overwrites the same
+        (current) line. It is cheap to call after every step: the clock is
+        only checked every few steps, and the line is only updated once
+        every progress_interval seconds (and at the end)."""
+        # a count that does not advance means a new progress has started
+        if count <= cls.__prog_last:
+            cls.__prog_start = None
+            cls.__prog_next_check = 0
+        cls.__prog_last = count
+        if count < cls.__prog_next_check and count != total:
+            return
+
+        now = monotonic()
+        if cls.__prog_start is None:
+            cls.__prog_start = (now, count)
+            cls.__prog_next_time = now
+        start_time,start_count = cls.__prog_start
+        elapsed = now - start_time
+        # check the clock about ten times per interval
+        rate = (count - start_count) / elapsed if elapsed > 0 else 0
+        cls.__prog_next_check = count + max(1, int(rate *
+                                                   cls.progress_interval / 10))
+        if now < cls.__prog_next_time and count != total:
+            return
+        cls.__prog_next_time = now + cls.progress_interval
+
+        eta = (total - count) / rate if rate > 0 else None
+        eta_str = '--:--:--' if eta is None else \
+            f'{int(eta)//3600}:{int(eta)%3600//60:02d}:{int(eta)%60:02d}'
+        rate_str = f'{rate/1000:.1f}k' if rate >= 1000 else f'{rate:.0f}'
+        cls.__color_msg(msg=f'{(100*count/total):5.1f}% {count:8d}/{total} '
+                        f'{rate_str:>7} ev/s  ETA {eta_str}',
+                        ind_str=f'\033[2K\r{cls.ind}', end='', out=stdout)
+        if cls.progress_out is not None:
+            record = {'label': cls.progress_label, 'done': count,
+                      'total': total, 'percent': 100*count/total,
+                      'elapsed': elapsed, 'events_per_second': rate,
+                      'eta': eta}
+            cls.progress_out.write(json.dumps(record) + '\n')
+        # once finished, the next call starts a new progress
+        if count >= total:
+            cls.__prog_last = -1
+            cls.__prog_start = None
+            cls.__prog_next_check = 0
         return
 
     @classmethod
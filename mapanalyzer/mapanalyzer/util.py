@@ -1,10 +1,15 @@
-import sys, os, json
+import sys, os, io, json, multiprocessing, queue, threading
+from bisect import bisect_right
+from collections import deque
+from itertools import starmap
+import numpy as np
 import colorsys # to convert from hls to rgb
 import matplotlib.pyplot as plt
 import argparse # to get command line arguments
 from jsonschema import validate, ValidationError # to validate pdata files
 from .settings import Settings as st
 from .ui import UI
+from .compression import compression_of, open_map_file
 
 class MetricStrings:
     def __init__(self, about='About this metric', title='Title',
@@ -158,9 +163,21 @@ class Palette:
         return len(self.col)
 
 class MapDataReader:
-    """iterates over the map file, reading one record at the time."""
+    """iterates over the map file, reading one record at the time.
+    If multiple parse jobs were requested, the data section is split in
+    chunks of lines that worker processes parse in parallel, and their
+    records are yielded in the order of the file.
+    Compressed map files are decompressed as they are read (see
+    open_map_file()), so they cannot be read from a given offset."""
+    # size of the chunks (in bytes) parsed by each worker, and number of
+    # chunks being parsed (or waiting to be read) per worker
+    chunk_size = 4 * 1024 * 1024
+    chunks_per_job = 2
     class __Record:
         """One record from the map file."""
+        # cache line fragments, if already computed (see split_lines())
+        lines = None
+
         def __init__(self, time, thread, event, size, addr):
             # almost all members are integers.
             try:
@@ -178,27 +195,50 @@ class MapDataReader:
                       f'addr  : {addr}')
             return
 
+        @classmethod
+        def parsed(cls, time, thread, event, size, addr):
+            """record of values already parsed (by a parse worker), without
+            validating them again"""
+            record = cls.__new__(cls)
+            record.time = time
+            record.thread = thread
+            record.event = event
+            record.size = size
+            record.addr = addr
+            return record
+
         def __str__(self):
             return (f'tim:{self.time}, thr:{self.thread}, '
                     f'eve:{self.event}, addr:{self.addr}, '
                     f'siz:{self.size}')
 
-    def __init__(self, map_filepath):
+    def __init__(self, map_filepath, start_offset=None, track_offsets=False):
         self.file_path = map_filepath
+        # if given, iteration starts at this offset of the file (which must
+        # be the start of a record in the data section) instead of at the
+        # beginning of the data section.
+        self.start_offset = start_offset
+        # if track_offsets, keep the offset of the last record read. Used to
+        # resume a simulation from a checkpoint.
+        self.track_offsets = track_offsets
+        self.record_offset = None
 
         # Open file
         self.file = None
         try:
-            self.file = open(self.file_path, 'r')
+            self.file = open_map_file(self.file_path)
         except FileNotFoundError:
             UI.error(f'While reading "{self.file_path}":\n'
                      'File does not exist or cannot be read.')
         return
 
     def __go_to_section(self, header):
-        if self.file.closed:
-            self.file = open(self.file_path, 'r')
-        self.file.seek(0)
+        if self.file.closed or not self.file.seekable():
+            # compressed streams are decompressed again from the start
+            self.file.close()
+            self.file = open_map_file(self.file_path)
+        else:
+            self.file.seek(0)
 
         while True:
             line = self.file.readline()
@@ -215,6 +255,17 @@ class MapDataReader:
         return
 
     def __iter__(self):
+        # the offsets of the records are only known when reading them in
+        # order, and pool workers cannot have workers of their own.
+        if st.parse_jobs > 1 and self.start_offset is None and \
+           not self.track_offsets and \
+           not multiprocessing.current_process().daemon:
+            return self.__parallel_records(st.parse_jobs)
+        if self.start_offset is not None:
+            if self.file.closed:
+                self.file = open_map_file(self.file_path)
+            self.file.seek(self.start_offset)
+            return self
         self.__go_to_section(st.Map.header_data)
         # consume the first line after the header, which
         # contains the columns names.
@@ -225,6 +276,8 @@ class MapDataReader:
         line = ''
         # read lines until a useful one appears
         while True:
+            if self.track_offsets:
+                self.record_offset = self.file.tell()
             line = self.file.readline()
             # EOF found
             if line == '':
@@ -255,15 +308,265 @@ class MapDataReader:
                      f'>>> {off}')
             exit(1)
 
-        # Transform the (relative) offset to (absolute) address.
-        # I was probably drunk when I thought this... I am pretty sure
-        # I am adding and subtracting the same shit somewhere else...
-        addr = st.Map.aligned_start_addr + st.Map.left_pad + off
+        # Transform the (relative) offset to (absolute) address. The padding
+        # changes with the cache level, but aligned_start_addr + left_pad is
+        # always start_addr (and records may be read in another thread
+        # while a level is selected).
+        addr = st.Map.start_addr + off
         return self.__Record(time, thr, ev, size, addr)
 
+    def __skip_to_data(self, map_file):
+        """move a map file opened in binary mode to the first record line of
+        its data section"""
+        header = st.Map.header_data.encode()
+        for line in iter(map_file.readline, b''):
+            if line.strip() == header:
+                # skip the line with the columns names
+                map_file.readline()
+                return
+        UI.error(f'While reading {self.file_path}: '
+                 f'File has no section "{st.Map.header_data}".')
+
+    def __parse_tasks(self):
+        """the (function, arguments) that parse the chunks of the data
+        section, in order. Workers read the byte ranges of plain files
+        themselves, while compressed files are decompressed here and their
+        chunks are sent to the workers."""
+        if compression_of(self.file_path) is None:
+            with open(self.file_path, 'rb') as map_file:
+                self.__skip_to_data(map_file)
+                start = map_file.tell()
+            end = os.path.getsize(self.file_path)
+            for c in range(start, end, self.chunk_size):
+                yield (MapDataReader.parse_chunk,
+                       (self.file_path, c, min(c + self.chunk_size, end)))
+            return
+        with open_map_file(self.file_path, binary=True) as map_file:
+            self.__skip_to_data(map_file)
+            while True:
+                chunk = map_file.read(self.chunk_size)
+                if not chunk:
+                    break
+                if not chunk.endswith(b'\n'):
+                    chunk += map_file.readline()
+                yield MapDataReader.parse_data, (chunk,)
+        return
+
+    def __parsed_chunks(self, jobs):
+        """the parsed chunks of the data section (see parse_data()), in
+        order. With multiple jobs, they are parsed by a pool of workers."""
+        self.file.close()
+        tasks = self.__parse_tasks()
+        if jobs == 1:
+            for func,args in tasks:
+                yield func(*args)
+            return
+        pending = deque()
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            while True:
+                # keep a bounded number of chunks in flight
+                for func,args in tasks:
+                    pending.append(pool.apply_async(func, args))
+                    if len(pending) == jobs * self.chunks_per_job:
+                        break
+                if not pending:
+                    break
+                yield pending.popleft().get()
+        return
+
+    def __parallel_records(self, jobs):
+        for columns,events,error in self.__parsed_chunks(jobs):
+            yield from self.column_records(columns, events)
+            if error is not None:
+                UI.error(f'While reading "{self.file_path}":\n{error}')
+        return
+
+    def read_columns(self):
+        """read all the records of the data section as columns (time,
+        thread, event, size, offset), with the events as indices in a list
+        of their names (see parse_data()). Return the columns and the
+        list. Columns take much less memory than records."""
+        jobs = st.parse_jobs
+        if multiprocessing.current_process().daemon:
+            jobs = 1
+        chunks = []
+        events = {}
+        for columns,chunk_events,error in self.__parsed_chunks(jobs):
+            if error is not None:
+                UI.error(f'While reading "{self.file_path}":\n{error}')
+            # the event indices of each chunk refer to its own list
+            ids = np.array([events.setdefault(ev, len(events))
+                            for ev in chunk_events], dtype=np.int64)
+            columns[2] = ids[columns[2]]
+            chunks.append(columns)
+        if not chunks:
+            return [np.zeros(0, dtype=np.int64) for _ in range(5)], []
+        return [np.concatenate(column) for column in zip(*chunks)], \
+            list(events)
+
+    @classmethod
+    def column_records(cls, columns, events):
+        """the records of columns read by read_columns() or parse_data()"""
+        times,threads,event_ids,sizes,offsets = columns
+        # the addresses are computed in bulk when they fit in 64 bits
+        if offsets.dtype == np.int64 and 0 <= st.Map.start_addr and \
+           st.Map.start_addr + int(offsets.max(initial=0)) < 1 << 63:
+            addrs = (offsets + st.Map.start_addr).tolist()
+        else:
+            addrs = [st.Map.start_addr + off for off in offsets.tolist()]
+        yield from starmap(cls.__Record.parsed, zip(
+            times.tolist(), threads.tolist(),
+            [events[ev] for ev in event_ids.tolist()],
+            sizes.tolist(), addrs))
+        return
+
+    @staticmethod
+    def parse_chunk(file_path, start, end):
+        """parse the data lines of a (plain) map file that start in the byte
+        range [start, end). See parse_data()."""
+        with open(file_path, 'rb') as map_file:
+            at_line_start = True
+            if start > 0:
+                map_file.seek(start - 1)
+                at_line_start = map_file.read(1) == b'\n'
+            chunk = map_file.read(end - start)
+            # the last line may end beyond the range, and the first one
+            # belongs to the previous range if it started before.
+            if not chunk.endswith(b'\n'):
+                chunk += map_file.readline()
+        if not at_line_start:
+            chunk = chunk[chunk.find(b'\n')+1:] if b'\n' in chunk else b''
+        return MapDataReader.parse_data(chunk)
+
+    @staticmethod
+    def parse_data(chunk):
+        """parse the data lines of a chunk of bytes, the same way as
+        __next__(). Return the columns of the records as arrays (time,
+        thread, event, size, offset), with the events as indices in a list
+        of their names, and an error message if a line is invalid (the
+        records before it are still returned)."""
+        times, threads, events, sizes, offsets = [], [], [], [], []
+        event_names = {}
+        error = None
+        for line in chunk.decode().split('\n'):
+            line = line.strip()
+
+            # ignore empty or comment lines
+            if line == '' or line[0] == '#':
+                continue
+
+            # remove trailing comments
+            line = line.split('#')[0].strip()
+            try:
+                time,thr,ev,size,off = line.split(',')
+            except:
+                error = f'Incorrect number of fields:\n>>> {line}'
+                break
+            try:
+                off = int(off)
+            except:
+                error = f'Incorrect value for offset:\n>>> {off}'
+                break
+            try:
+                time,thr,size = int(time),int(thr),int(size)
+            except:
+                error = ('Incorrect values to create __MemRecord:\n'
+                         f'time  : {time}\n'
+                         f'thread: {thr}\n'
+                         f'event : {ev}\n'
+                         f'size  : {size}\n'
+                         f'offset: {off}')
+                break
+            times.append(time)
+            threads.append(thr)
+            events.append(event_names.setdefault(ev, len(event_names)))
+            sizes.append(size)
+            offsets.append(off)
+
+        # values that do not fit in 64 bits are kept as python integers
+        columns = []
+        for values in (times, threads, events, sizes, offsets):
+            try:
+                columns.append(np.array(values, dtype=np.int64))
+            except OverflowError:
+                columns.append(np.array(values, dtype=object))
+        return columns, list(event_names), error
+
+class OutputWriter:
+    """Writes the output files in a separate thread, so that writing them
+    (e.g., to a network file system) overlaps with rendering the next plots
+    and simulating the next maps. Files are encoded by the caller, and
+    queued with their absolute path (the working directory may change
+    before they are written). The queue is bounded, so the caller waits if
+    the writes fall behind. Forked workers do not have the thread, so they
+    write their files themselves."""
+    max_pending = 16
+    files = None
+    thread = None
+    pid = None
+    errors = []
+
+    @classmethod
+    def start(cls):
+        cls.files = queue.Queue(cls.max_pending)
+        cls.errors = []
+        cls.pid = os.getpid()
+        cls.thread = threading.Thread(target=cls.__write_files, daemon=True)
+        cls.thread.start()
+        return
+
+    @classmethod
+    def running(cls):
+        return cls.thread is not None and cls.pid == os.getpid()
+
+    @classmethod
+    def write(cls, filename, content):
+        """queue content (str or bytes) to be written to filename"""
+        cls.files.put((os.path.abspath(filename), content))
+        return
+
+    @classmethod
+    def __write_files(cls):
+        while True:
+            item = cls.files.get()
+            if item is None:
+                return
+            filename,content = item
+            try:
+                with open(filename, 'wb' if isinstance(content, bytes)
+                          else 'w') as f:
+                    f.write(content)
+            except Exception as e:
+                cls.errors.append((filename, e))
+
+    @classmethod
+    def finish(cls):
+        """wait until all the queued files are written"""
+        if not cls.running():
+            return
+        cls.files.put(None)
+        cls.thread.join()
+        cls.thread = None
+        if cls.errors:
+            UI.error('\n'.join(f'While trying to save {filename}.\n\n{e}'
+                               for filename,e in cls.errors))
+        return
+
+
 class PdataFile:
+    """The bg metric is the same in all the pdatas of a run, so it is stored
+    once and referenced by them: .metrics.bg is {"code": ..., "file": ...},
+    where "file" (relative to the pdata) is either the pdata of the bg metric
+    (if it was enabled too), or a sidecar file with only the bg data:
+    <map ID>.pdata_bg_<code>.json. load() resolves these references (also
+    the ones of older pdatas, that embed the bg data)."""
     fmt_name = 'pdata'
     ext = 'json'
+    # key of bg references, and infix of bg sidecar files
+    bg_ref = 'file'
+    bg_infix = 'bg'
+    # {absolute path of a referenced file -> bg metric data}
+    bg_cache = {}
     schema = {
         'type' : 'object',
         'properties' : {
@@ -293,24 +596,69 @@ class PdataFile:
         },
         'required' : ['meta', 'map', 'cache', 'metrics']
     }
+    bg_schema = {
+        'type' : 'object',
+        'properties' : {
+            'meta' : {'type' : 'object'},
+            'bg' : {
+                'type' : 'object',
+                'properties' : {
+                    'code' : {'type' : 'string'}
+                },
+                'required' : ['code']
+            }
+        },
+        'required' : ['meta', 'bg']
+    }
 
     @classmethod
-    def save(cls, data:dict, metric_code):
-        # obtain metrics strings
+    def filename(cls, metric_code):
+        """name of the pdata file of a metric"""
         met_str = st.Metrics.available[metric_code].\
             supported_metrics[metric_code]
+        prefix = f'{st.Map.ID}.' if st.Map.ID else ''
+        return f'{prefix}{cls.fmt_name}_{met_str.number}_{metric_code}.' \
+            f'{cls.ext}'
 
-        # number for consistent sorting of output files
-        number = met_str.number
-
-        # map ID computed from the input map file(s)
+    @classmethod
+    def bg_filename(cls, metric_code):
+        """name of the sidecar file of a bg metric"""
         prefix = f'{st.Map.ID}.' if st.Map.ID else ''
+        return f'{prefix}{cls.fmt_name}_{cls.bg_infix}_{metric_code}.{cls.ext}'
 
-        # file extension
-        ext = cls.ext
+    @classmethod
+    def is_bg_file(cls, filepath):
+        return f'.{cls.fmt_name}_{cls.bg_infix}_' in \
+            f'.{os.path.basename(filepath)}'
 
+    @classmethod
+    def save_bg(cls, meta_data, bg_data):
+        """save the bg metric data in its sidecar file. Return the reference
+        to it, to be stored in the pdatas"""
+        filename = cls.bg_filename(bg_data['code'])
+        UI.text(f'{cls.bg_infix.ljust(UI.metric_code_hpad)}: ', end='')
+        try:
+            if OutputWriter.running():
+                OutputWriter.write(filename, json.dumps(
+                    {'meta': meta_data, 'bg': bg_data}))
+            else:
+                with open(filename, 'w') as f:
+                    json.dump({'meta': meta_data, 'bg': bg_data}, f)
+        except Exception as e:
+            UI.nl()
+            UI.error(f'While trying to save {filename}.\n\n'
+                     f'{e}')
+        UI.text(filename, indent=False)
+        return cls.bg_reference(bg_data['code'], filename)
+
+    @classmethod
+    def bg_reference(cls, metric_code, filename):
+        return {'code': metric_code, cls.bg_ref: filename}
+
+    @classmethod
+    def save(cls, data:dict, metric_code):
         # assembly the final file name
-        filename = f'{prefix}{cls.fmt_name}_{number}_{metric_code}.{cls.ext}'
+        filename = cls.filename(metric_code)
 
         UI.text(f'{metric_code.ljust(UI.metric_code_hpad)}: ', end='')
 
@@ -330,8 +678,11 @@ class PdataFile:
 
         # save file
         try:
-            with open(filename, 'w') as f:
-                json.dump(data, f)
+            if OutputWriter.running():
+                OutputWriter.write(filename, json.dumps(data))
+            else:
+                with open(filename, 'w') as f:
+                    json.dump(data, f)
         except Exception as e:
             UI.nl()
             UI.error(f'While trying to save {filename}.\n\n'
@@ -340,9 +691,7 @@ class PdataFile:
         return
 
     @classmethod
-    def load(cls, filepath):
-        if filepath is None:
-            UI.error(f'While reading pdata file. No file path provided.')
+    def __read(cls, filepath, schema, fmt_name):
         try:
             open_file = open(filepath, 'r')
         except (FileNotFoundError, IOError):
@@ -355,16 +704,123 @@ class PdataFile:
                      f'be a valid {cls.ext} file.')
         open_file.close()
 
-        # Verify this is a valid pdata file
+        # Verify this is a valid file
         try:
-            validate(instance=file_dict, schema=cls.schema)
+            validate(instance=file_dict, schema=schema)
         except ValidationError as e:
             UI.error(f'While reading "{filepath}". This seems to be a '
-                     f'malformed {cls.fmt_name} file:\n'
+                     f'malformed {fmt_name} file:\n'
                      f'{e}')
+        return file_dict
 
+    @classmethod
+    def load(cls, filepath, resolve_bg=True):
+        if filepath is None:
+            UI.error(f'While reading pdata file. No file path provided.')
+        file_dict = cls.__read(filepath, cls.schema, cls.fmt_name)
+        bg = file_dict['metrics'].get('bg')
+        if resolve_bg and bg is not None and cls.bg_ref in bg:
+            file_dict['metrics']['bg'] = cls.__load_bg(filepath, bg)
         return file_dict
 
+    @classmethod
+    def __load_bg(cls, filepath, bg_ref):
+        """obtain the bg data referenced by a pdata. The pdatas of a run
+        reference the same file, so it is read only once."""
+        bg_path = os.path.abspath(os.path.join(os.path.dirname(filepath),
+                                               bg_ref[cls.bg_ref]))
+        if bg_path in cls.bg_cache:
+            return cls.bg_cache[bg_path]
+        if not os.path.isfile(bg_path):
+            UI.error(f'While reading "{filepath}". The background data file '
+                     f'"{bg_ref[cls.bg_ref]}" it refers to does not exist. It '
+                     'must be in the same directory.')
+        if cls.is_bg_file(bg_path):
+            bg_data = cls.__read(bg_path, cls.bg_schema,
+                                 f'{cls.fmt_name} background')['bg']
+        else:
+            bg_data = cls.__read(bg_path, cls.schema,
+                                 cls.fmt_name)['metrics']['fg']
+        if bg_data['code'] != bg_ref['code']:
+            UI.error(f'While reading "{filepath}". The background data file '
+                     f'"{bg_ref[cls.bg_ref]}" does not contain '
+                     f'"{bg_ref["code"]}" data.')
+        # keep only the last one: runs are usually plotted one after another
+        cls.bg_cache = {bg_path: bg_data}
+        return bg_data
+
+class BatchManifest:
+    """Description of a batch of simulations: every map is simulated with
+    every cache configuration. Relative paths are relative to the manifest.
+    {
+      "maps"   : ["a.map", "b.map"],
+      "caches" : {"small": "small.conf", "big": "big.conf"},
+      "output" : "results"
+    }
+    "caches" may also be a list of paths, named after their file names.
+    "output" is optional (default: "batch")."""
+    fmt_name = 'batch manifest'
+    default_output = 'batch'
+    schema = {
+        'type' : 'object',
+        'properties' : {
+            'maps' : {
+                'type' : 'array',
+                'items' : {'type' : 'string'},
+                'minItems' : 1
+            },
+            'caches' : {
+                'anyOf' : [
+                    {'type' : 'array', 'items' : {'type' : 'string'},
+                     'minItems' : 1},
+                    {'type' : 'object',
+                     'additionalProperties' : {'type' : 'string'},
+                     'minProperties' : 1},
+                ]
+            },
+            'output' : {'type' : 'string'},
+        },
+        'required' : ['maps', 'caches'],
+    }
+
+    @classmethod
+    def load(cls, filepath):
+        """return (map paths, {cache name -> cache path}, output dir)"""
+        try:
+            with open(filepath, 'r') as open_file:
+                manifest = json.load(open_file)
+        except (FileNotFoundError, IOError):
+            UI.error(f'While reading "{filepath}". File does not exist or '
+                     'cannot be read.')
+        except json.JSONDecodeError as e:
+            UI.error(f'While reading "{filepath}". File is not valid JSON:\n'
+                     f'{e}')
+        try:
+            validate(instance=manifest, schema=cls.schema)
+        except ValidationError as e:
+            UI.error(f'While reading "{filepath}". This seems to be a '
+                     f'malformed {cls.fmt_name}:\n'
+                     f'{e.message}')
+
+        base_dir = os.path.dirname(filepath)
+        def resolve(path):
+            return os.path.normpath(os.path.join(base_dir, path))
+
+        maps = [resolve(m) for m in manifest['maps']]
+        if len(set(maps)) != len(maps):
+            UI.error(f'While reading "{filepath}". Repeated map files.')
+        caches = manifest['caches']
+        if isinstance(caches, list):
+            names = [os.path.splitext(os.path.basename(c))[0] for c in caches]
+            if len(set(names)) != len(names):
+                UI.error(f'While reading "{filepath}". Cache files must have '
+                         'different names, or be given as a {name: path} '
+                         'object.')
+            caches = dict(zip(names, caches))
+        caches = {name: resolve(path) for name,path in caches.items()}
+        output = resolve(manifest.get('output', cls.default_output))
+        return maps, caches, output
+
 class PlotFile:
     fmt_plot = 'plot'
     fmt_aggr = 'aggr'
@@ -396,8 +852,16 @@ class PlotFile:
         # print UI message and actually save figure
         UI.text(f'{metric_code.ljust(UI.metric_code_hpad)}: ', end='')
         try:
-            mpl_fig.savefig(filename, dpi=st.Plot.dpi, bbox_inches='tight',
-                            pad_inches=st.Plot.img_border_pad)
+            if OutputWriter.running():
+                image = io.BytesIO()
+                mpl_fig.savefig(image, format=ext, dpi=st.Plot.dpi,
+                                bbox_inches='tight',
+                                pad_inches=st.Plot.img_border_pad)
+                OutputWriter.write(filename, image.getvalue())
+            else:
+                mpl_fig.savefig(filename, dpi=st.Plot.dpi,
+                                bbox_inches='tight',
+                                pad_inches=st.Plot.img_border_pad)
             plt.close(mpl_fig)
         except Exception as e:
             UI.nl()
@@ -449,7 +913,9 @@ def sample_list(full_list, base=10, n=10, include_last=False):
 
     return tick_list
 
-def command_line_args_parser():
+def command_line_args_parser(argv=None):
+    """parse the command line arguments (sys.argv, unless another argv list
+    is given)"""
     synopsis = ('MAP Analyzer, a tool to study the cache friendliness of '
                 'memory access patterns.')
     cache_conf = ('cache.conf\n'
@@ -463,7 +929,41 @@ def command_line_args_parser():
                   f'   cache_size_bytes    : <value> # default: '
                   f'{st.Cache.cache_size}\n'
                   f'   arch_size_bits      : <value> # default: '
-                  f'{st.Cache.arch}\n')
+                  f'{st.Cache.arch}\n'
+                  '\n'
+                  '  Optionally:\n'
+                  '\n'
+                  f'   replacement_policy  : <value> # default: '
+                  f'{st.Cache.policy}\n'
+                  f'                                 # '
+                  f'{" | ".join(st.Cache.policies)}\n'
+                  f'   replacement_seed    : <value> # default: '
+                  f'{st.Cache.policy_seed} (for random)\n'
+                  f'   write_policy        : <value> # default: '
+                  f'{st.Cache.write_policy}\n'
+                  f'                                 # '
+                  f'{" | ".join(st.Cache.write_policies)}\n'
+                  f'   write_allocate      : <value> # default: '
+                  f'{st.Cache.write_allocate} (0 | 1)\n'
+                  f'   threads_per_cache   : <value> # default: '
+                  f'{st.Cache.threads_per_cache} (shared)\n'
+                  '\n'
+                  '  To simulate a cache hierarchy, describe each level (from\n'
+                  '  the closest to the processor to the farthest one) in its\n'
+                  '  own [<level>] section. Properties given before the first\n'
+                  '  section are shared by all levels. The block fetches and\n'
+                  '  write-backs of each level are the accesses of the next\n'
+                  '  one, and each level produces its own set of results:\n'
+                  '\n'
+                  '   arch_size_bits      : 64\n'
+                  '   [L1]\n'
+                  '   line_size_bytes     : 64\n'
+                  '   associativity       : 8\n'
+                  '   cache_size_bytes    : 32768\n'
+                  '   [L2]\n'
+                  '   line_size_bytes     : 64\n'
+                  '   associativity       : 16\n'
+                  '   cache_size_bytes    : 1048576\n')
 
     examples = ('examples:\n'
                 '  Run cache simulation with a given configuration and \n'
@@ -478,6 +978,14 @@ def command_line_args_parser():
                 '  a single plot:\n'
                 '      mapanalyzer --mode aggregate -- A.json B.json C.json\n'
                 '\n'
+                '  Simulate every map of a manifest with every cache, using\n'
+                '  four processes:\n'
+                '      mapanalyzer --mode batch -j 4 -- manifest.json\n'
+                '      where manifest.json is:\n'
+                '      {"maps": ["a.map", "b.map"],\n'
+                '       "caches": {"small": "s.conf", "big": "b.conf"},\n'
+                '       "output": "results"}\n'
+                '\n'
                 '  Run your own script in mapanalyzer runtime environment:\n'
                 '      mapanalyzer --mode widget --script my_widget.py '
                 '--widgetArg 123 -- widget_input.txt')
@@ -494,7 +1002,8 @@ def command_line_args_parser():
     # Adding arguments
     parser.add_argument(
         '--mode', metavar='MODE', dest='mode',
-        choices=['simulate', 'plot', 'sim-plot', 'aggregate', 'widget'],
+        choices=['simulate', 'plot', 'sim-plot', 'aggregate', 'batch',
+                 'widget'],
         type=str, default='sim-plot',
         help=(
             'Defines the operation mode of the tool:\n'
@@ -511,6 +1020,12 @@ def command_line_args_parser():
             '            aggregating the ones of the same kind.\n'
             '              Input : list of PDATA files.\n'
             '              Output: Aggregated PLOT files.\n'
+            'batch     : Simulate every MAP file with every cache file of a\n'
+            '            manifest, parsing each MAP file once and using\n'
+            '            --jobs processes.\n'
+            '              Input : batch manifest (JSON). See examples.\n'
+            '              Output: <output>/<map ID>/<cache name>/ PDATA\n'
+            '                      files, and <output>/index.json.\n'
             'widget    : Run custom script using the tool\'s runtime.\n'
             '            Experimental, you shouldn\'t need to use this.')
     )
@@ -522,6 +1037,105 @@ def command_line_args_parser():
         help='Python file with the widget (used only in widget mode).'
     )
 
+    parser.add_argument(
+        '-j', '--jobs', metavar='JOBS', dest='jobs',
+        type=int, default=None,
+        help=('Number of worker processes used to simulate independent parts\n'
+              'of the cache in parallel: the private caches of different\n'
+              'thread groups, or the sets of a single-level cache. The\n'
+              'sets are simulated in a single process if concurrent\n'
+              'accesses straddle lines of sets of different workers.\n'
+              'Format: <integer>')
+    )
+
+    parser.add_argument(
+        '-pj', '--parse-jobs', metavar='JOBS', dest='parse_jobs',
+        type=int, default=None,
+        help=('Number of worker processes that parse chunks of the map in\n'
+              'parallel. Their records are simulated in the order of the\n'
+              'file. Not used with checkpoints, nor within the jobs of\n'
+              '--jobs.\n'
+              'Format: <integer>')
+    )
+
+    parser.add_argument(
+        '-pg', '--progress-file', metavar='TARGET', dest='progress_file',
+        type=str, default=None,
+        help=('Also write the simulation progress as JSON lines (done, total,\n'
+              'percent, elapsed, events_per_second, eta) to a file, or to an\n'
+              'open file descriptor.\n'
+              'Format : <path> | fd:<N>\n'
+              'Example: fd:3')
+    )
+
+    parser.add_argument(
+        '-pf', '--profile', metavar='LEVEL', dest='profile',
+        nargs='?', const='time', choices=['time', 'memory'], default=None,
+        help=('Measure the time and calls of each module per phase (probe,\n'
+              'commit, finalize, to_dict, to_plot). Print them and save\n'
+              'them to "<map ID>.profile.json". With "memory", also record\n'
+              'the peak memory of each phase (much slower).\n'
+              'Format: [time | memory]')
+    )
+
+    parser.add_argument(
+        '-cp', '--checkpoint', metavar='SECONDS', dest='checkpoint',
+        type=int, default=None,
+        help=('Every SECONDS of simulation, save a snapshot of the cache and\n'
+              'metrics state to "<map ID>.checkpoint" in the working\n'
+              'directory. It is removed once the results are exported.\n'
+              'Format: <integer>')
+    )
+
+    parser.add_argument(
+        '-re', '--resume', dest='resume',
+        action='store_true',
+        help=('If set, resume the simulation of each map from its\n'
+              'checkpoint (see --checkpoint), if there is one.')
+    )
+
+    parser.add_argument(
+        '-cr', '--collapse-runs', dest='collapse_runs',
+        action='store_true',
+        help=('If set, consecutive accesses of a thread to the cache line\n'
+              'it has just accessed are simulated as a single access\n'
+              'followed by hits, skipping their cache lookups. Results are\n'
+              'the same. Not used with checkpoints, sampling, or multiple\n'
+              'jobs on a single cache level.')
+    )
+
+    parser.add_argument(
+        '-pl', '--pipeline', dest='pipeline',
+        action='store_true',
+        help=('If set, the map is read and parsed in a separate thread, ahead\n'
+              'of the simulation; the pdatas and plots of the metrics are\n'
+              'produced in parallel by one worker process per CPU; and the\n'
+              'rest of the output files are written in another thread\n'
+              'while the next ones are produced. The map is not read ahead\n'
+              'in checkpointed simulations, and the metrics are exported\n'
+              'one by one within the jobs of --jobs and batch mode.')
+    )
+
+    parser.add_argument(
+        '-rc', '--result-cache', metavar='DIR', dest='result_cache',
+        nargs='?', const='default', type=str, default=None,
+        help=('Store the simulation results of each map in DIR (default:\n'
+              '"$XDG_CACHE_HOME/mapanalyzer", or "~/.cache/mapanalyzer"),\n'
+              'and reuse them instead of simulating again when the map\n'
+              'file, cache, metrics and tool version are the same. Useful to\n'
+              'only change plot options.\n'
+              'Not supported for private caches.\n'
+              'Format: [<path>]')
+    )
+
+    parser.add_argument(
+        '-rl', '--result-cache-limit', metavar='MIB', dest='result_cache_limit',
+        type=int, default=None,
+        help=('Size limit of the result cache, in MiB. The least recently\n'
+              'used results are removed to fit in it (default: 1024).\n'
+              'Format: <integer>')
+    )
+
     parser.add_argument(
         '-ca', '--cache', metavar='CACHE', dest='cachefile',
         type=str, default=None,
@@ -577,6 +1191,28 @@ def command_line_args_parser():
               "Example: MAP")
     )
 
+    parser.add_argument(
+        '-sm', '--streaming-metrics', metavar='CODES', dest='stream_codes',
+        type=str, default=None,
+        help=('Metrics to compute in streaming mode, keeping bounded memory\n'
+              'during the simulation (results may be approximated).\n'
+              'Supported: MRID, TLD\n'
+              'Format : none | <CODE>{,<CODE>}\n'
+              'Example: MRID')
+    )
+
+    parser.add_argument(
+        '-sa', '--sampling', metavar='SPEC', dest='sampling',
+        type=str, default=None,
+        help=('Simulate only a sample of the trace, and extrapolate CMR and\n'
+              'CMMA with confidence bounds (single-level caches only).\n'
+              '- time: in every PERIOD time steps, warm the cache up for\n'
+              '  WARMUP steps and then measure ON steps.\n'
+              '- sets: only simulate 1 of every K cache sets.\n'
+              'Format : none | time:<ON>:<PERIOD>[:<WARMUP>] | sets:<K>\n'
+              'Example: time:1000:10000:500')
+    )
+
     parser.add_argument(
         '-Lx', '--no-plot-last-x', dest='aggr_last_x',
         action='store_false',
@@ -654,12 +1290,14 @@ def command_line_args_parser():
     )
 
     # split before and after '--'
-    if '--' in sys.argv:
-        sep_index = sys.argv.index('--')
-        before_double_dash = sys.argv[1:sep_index]
-        after_double_dash = sys.argv[sep_index + 1:]
+    if argv is None:
+        argv = sys.argv
+    if '--' in argv:
+        sep_index = argv.index('--')
+        before_double_dash = argv[1:sep_index]
+        after_double_dash = argv[sep_index + 1:]
     else:
-        before_double_dash = sys.argv[1:]
+        before_double_dash = argv[1:]
         after_double_dash = None
 
     # parse arguments before '--'
@@ -684,3 +1322,89 @@ def median(full_list:list):
     else:
         med = full_list[med_idx]
     return med
+
+class StreamingQuantile:
+    """
+    Estimate the p-quantile of a stream of values in constant memory, using
+    the P-square algorithm (Jain & Chlamtac, 1985). The first 'exact_size'
+    values are kept, so small streams get the exact quantile. After that, only
+    five markers are kept, whose heights approximate the min, p/2, p, (1+p)/2
+    quantiles and the max.
+    """
+    def __init__(self, p=0.5, exact_size=256):
+        self.p = p
+        self.exact_size = max(5, exact_size)
+        self.count = 0
+        # sorted values, until the markers are initialized
+        self.values = []
+        # marker heights, actual positions, and desired positions
+        self.q = None
+        self.n = None
+        self.np = None
+        self.dn = [0, p/2, p, (1+p)/2, 1]
+        return
+
+    def __init_markers(self):
+        """place the markers at the quantiles of the values seen so far"""
+        last = self.count - 1
+        self.np = [d*last for d in self.dn]
+        self.n = [round(d) for d in self.np]
+        self.q = [self.values[i] for i in self.n]
+        self.values = None
+        return
+
+    def add(self, x):
+        self.count += 1
+
+        # the first values are just stored (sorted)
+        if self.values is not None:
+            self.values.insert(bisect_right(self.values, x), x)
+            if self.count == self.exact_size:
+                self.__init_markers()
+            return
+        q,n = self.q,self.n
+
+        # find the cell k such that q[k] <= x < q[k+1], extending the extreme
+        # markers if needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = min(bisect_right(q, x) - 1, 3)
+
+        # shift positions of the markers above x, and all desired positions
+        for i in range(k+1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+
+        # adjust the heights of the three middle markers if they are off
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+                d = 1 if d > 0 else -1
+                # piecewise-parabolic prediction
+                qp = q[i] + d / (n[i+1]-n[i-1]) * (
+                    (n[i]-n[i-1]+d) * (q[i+1]-q[i]) / (n[i+1]-n[i]) +
+                    (n[i+1]-n[i]-d) * (q[i]-q[i-1]) / (n[i]-n[i-1]))
+                if not q[i-1] < qp < q[i+1]:
+                    # fall back to linear prediction
+                    qp = q[i] + d * (q[i+d]-q[i]) / (n[i+d]-n[i])
+                q[i] = qp
+                n[i] += d
+        return
+
+    def value(self):
+        """Current estimation of the quantile, or None if no value was seen"""
+        if self.count == 0:
+            return None
+        if self.values is None:
+            return self.q[2]
+        # exact quantile (interpolated) over the stored values
+        pos = self.p * (self.count-1)
+        lo = int(pos)
+        hi = min(lo+1, self.count-1)
+        return self.values[lo] + (pos-lo) * (self.values[hi]-self.values[lo])
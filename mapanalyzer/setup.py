@@ -17,6 +17,7 @@ setup(
         "wheel",
         # program dependencies
         "matplotlib",
+        "numpy",
         "jsonschema",
         "colorama"
     ],